@@ -1,7 +1,45 @@
-from ._wrapper import (  # noqa
-    EncryptionError,
-    encrypt,
-    reencrypt,
-    get_seckey,
-    get_pubkey,
-)
+import importlib
+
+# Public names, by the submodule defining them. Submodules are imported when
+# one of their names is first used, as most of them load the crypt4gh and
+# cryptography packages, which slows down programs that do not need them.
+_EXPORTS = {
+    "EncryptionError": "_wrapper",
+    "encrypt": "_wrapper",
+    "reencrypt": "_wrapper",
+    "reencrypt_header": "_wrapper",
+    "get_seckey": "_wrapper",
+    "get_pubkey": "_wrapper",
+    "iter_views": "_io",
+    "KeyRegistry": "_keys",
+    "key_registry": "_keys",
+    "CIPHER_SEGMENT_SIZE": "_stream",
+    "Decryptor": "_stream",
+    "decrypt_stream": "_stream",
+    "Encryptor": "_stream",
+    "encrypt_parallel": "_stream",
+    "encrypt_stream": "_stream",
+    "header_length": "_stream",
+    "plaintext_size": "_stream",
+    "SEGMENT_SIZE": "_stream",
+    "HeaderReencryptor": "_reencrypt",
+    "reencrypt_many": "_reencrypt",
+    "ReencryptionResult": "_reencrypt",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    try:
+        module = _EXPORTS[name]
+    except KeyError:
+        raise AttributeError(
+            f"module {__name__!r} has no attribute {name!r}") from None
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value  # Later lookups skip __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,96 @@
+"""Zero-copy reading of file data."""
+
+import mmap
+import os
+import stat
+
+
+def iter_views(file_fp, size, reuse_buffer=True):
+    """Yield the rest of a binary stream as memoryviews of `size` bytes.
+
+    Regular files are memory-mapped, and read without being copied into
+    Python buffers; the views stay valid for as long as they are referenced.
+    Other streams (pipes, sockets, file-like objects without a file
+    descriptor) and files that cannot be mapped, e.g. on some network file
+    systems, are read into a buffer instead.
+
+    Every view but the last holds exactly `size` bytes, even when reading
+    from pipes. Once iteration is over, the stream is positioned after the
+    data that was read.
+
+    Args:
+        file_fp: File handle for file data (opened for reading in binary
+            mode).
+        size (int): Number of bytes per view.
+        reuse_buffer (bool): Whether streams that are not mapped may be read
+            into a single buffer, which makes each view valid only until the
+            next one is requested. Pass False to keep views around.
+
+    """
+    mapped = _map(file_fp)
+    if mapped is None:
+        yield from _iter_read(file_fp, size, reuse_buffer)
+        return
+
+    mm, position = mapped
+    view = memoryview(mm)
+    chunk = None
+    try:
+        while position < len(mm):
+            chunk = view[position:position + size]
+            position += len(chunk)
+            yield chunk
+    finally:
+        file_fp.seek(position)
+        del view, chunk
+        try:
+            mm.close()
+        except BufferError:
+            pass  # Views are still in use; closed when they are released
+
+
+def _map(file_fp):
+    """Map a regular file, returning the map and the current position."""
+    try:
+        fd = file_fp.fileno()
+        status = os.fstat(fd)
+        if not stat.S_ISREG(status.st_mode):
+            return None
+        position = file_fp.tell()
+        if position >= status.st_size:
+            return None
+        mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        return None
+    if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm, position
+
+
+def _iter_read(file_fp, size, reuse_buffer):
+    buf = bytearray(size)
+    while True:
+        nbytes = _readfull(file_fp, buf)
+        if nbytes:
+            yield memoryview(buf)[:nbytes]
+        if nbytes < size:
+            break
+        if not reuse_buffer:
+            buf = bytearray(size)
+
+
+def _readfull(fp, buf):
+    """Fill buf from fp, unless the stream ends first.
+
+    Pipes may return short reads, which would otherwise produce short
+    segments in the middle of the stream.
+
+    """
+    view = memoryview(buf)
+    total = 0
+    while total < len(buf):
+        nbytes = fp.readinto(view[total:])
+        if not nbytes:
+            break
+        total += nbytes
+    return total
@@ -0,0 +1,102 @@
+"""Loading and caching of crypt4gh key material."""
+
+import os
+import threading
+import time
+
+from ._wrapper import EncryptionError, get_pubkey, get_seckey
+
+DEFAULT_TTL = 3600.0
+
+# X25519 keys, secret or public.
+_KEY_SIZE = 32
+
+
+class KeyRegistry:
+    """Load, validate and memoize crypt4gh keys.
+
+    Key files are parsed once, and parsed again only if they change on
+    disk. Keys fetched from elsewhere (e.g. a server public key advertised
+    by a service) are kept for a limited time. A registry may be shared by
+    several threads.
+
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        """Create an empty registry.
+
+        Args:
+            ttl (float): Default number of seconds fetched keys are kept.
+
+        """
+        self._ttl = ttl
+        self._files = {}
+        self._fetched = {}
+        self._lock = threading.Lock()
+
+    def seckey(self, filepath):
+        """Load a private key (without passphrase) from file."""
+        return self._load(filepath, get_seckey)
+
+    def pubkey(self, filepath):
+        """Load a public key from file."""
+        return self._load(filepath, get_pubkey)
+
+    def peek(self, name):
+        """Return a fetched key if it is still fresh, or None otherwise."""
+        with self._lock:
+            cached = self._fetched.get(name)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        return None
+
+    def fetch(self, name, fetch, ttl=None):
+        """Return a key kept under a name, fetching it if missing or old.
+
+        Args:
+            name (hashable): Name of the key, e.g. the URL it comes from.
+            fetch (callable): Called without arguments to fetch the key.
+            ttl (float, optional): Number of seconds to keep the key;
+                defaults to that of the registry.
+
+        """
+        key = self.peek(name)
+        if key is not None:
+            return key
+
+        key = _validate(fetch(), name)
+        expires = time.monotonic() + (self._ttl if ttl is None else ttl)
+        with self._lock:
+            self._fetched[name] = (key, expires)
+        return key
+
+    def clear(self):
+        """Forget all keys."""
+        with self._lock:
+            self._files.clear()
+            self._fetched.clear()
+
+    def _load(self, filepath, loader):
+        path = os.path.abspath(os.fspath(filepath))
+        stat = os.stat(path)
+        cache_key = (path, loader)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._files.get(cache_key)
+        if cached is not None and cached[1] == version:
+            return cached[0]
+
+        key = _validate(loader(path), path)
+        with self._lock:
+            self._files[cache_key] = (key, version)
+        return key
+
+
+# Registry shared by all users in a process.
+key_registry = KeyRegistry()
+
+
+def _validate(key, origin):
+    if not isinstance(key, bytes) or len(key) != _KEY_SIZE:
+        raise EncryptionError(f"Invalid crypt4gh key from {origin}")
+    return key
@@ -0,0 +1,198 @@
+"""Reencryption of crypt4gh headers for many objects and recipients."""
+
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from dataclasses import dataclass, field
+import hashlib
+import os
+import threading
+import time
+from typing import List
+
+from crypt4gh import header
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.asymmetric.x25519 import (
+    X25519PrivateKey, X25519PublicKey)
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, PublicFormat)
+
+from ._wrapper import EncryptionError
+
+DEFAULT_WORKERS = 8
+
+# Header packets encrypted with X25519 and ChaCha20-Poly1305.
+_METHOD_X25519 = (0).to_bytes(4, "little")
+
+
+@dataclass
+class ReencryptionResult:
+    """Outcome of reencrypting the header of a single object."""
+    object_id: str
+    headers: List[bytes] = field(default_factory=list)  # One per recipient
+    payload_offset: int = None  # Length of the original header
+    elapsed: float = 0.0  # Time spent on the object, in seconds
+    error: Exception = None  # Set if the object could not be reencrypted
+
+
+class HeaderReencryptor:
+    """Reencrypt crypt4gh headers with a server key, for many recipients.
+
+    The X25519 shared keys derived for each sender and recipient are cached
+    by the reencryptor, so granting access to many objects written by the
+    same client, or for the same recipient, derives each key only once. As
+    they derive from the server key, they are freed with the reencryptor.
+    The headers produced are the same as those of `reencrypt_header`, and a
+    reencryptor may be used from several threads at once.
+
+    """
+
+    def __init__(self, server_seckey):
+        """Create a new reencryptor.
+
+        Args:
+            server_seckey (bytes): Crypt4gh private key (of the server).
+
+        """
+        self._seckey = server_seckey
+        try:
+            self._pubkey = _derive_pubkey(server_seckey)
+        except Exception as e:
+            raise EncryptionError() from e
+        self._keys = {}  # Shared keys, by (peer, reader) public keys
+        self._keys_lock = threading.Lock()
+
+    def reencrypt_header(self, recipient_pubkeys, encrypted_fp):
+        """Reencrypt the header at the start of a stream for recipients.
+
+        Args:
+            recipient_pubkeys (list of bytes): Crypt4gh public keys of the
+                recipients.
+            encrypted_fp: File handle for file data (opened for reading).
+                Only the header is read.
+
+        Returns:
+            (headers, payload_offset) (list of bytes, int): One header per
+                recipient, and the length of the original header.
+
+        """
+        try:
+            packets = list(header.parse(encrypted_fp))
+        except Exception as e:
+            raise EncryptionError() from e
+
+        decrypted, ignored = [], []
+        for packet in packets:
+            data = self._decrypt_packet(packet)
+            if data is None:
+                ignored.append(packet)
+            else:
+                decrypted.append(data)
+        if not decrypted:
+            raise EncryptionError("No header packet could be decrypted")
+
+        headers = [
+            header.serialize(
+                [self._encrypt_packet(data, pubkey) for data in decrypted]
+                + ignored)
+            for pubkey in recipient_pubkeys
+        ]
+        # Magic number, version and packet count, then length-prefixed
+        # packets.
+        payload_offset = 16 + sum(4 + len(packet) for packet in packets)
+        return headers, payload_offset
+
+    def _decrypt_packet(self, packet):
+        if packet[:4] != _METHOD_X25519:
+            return None
+        sender_pubkey = bytes(packet[4:36])
+        try:
+            key = self._shared_key(sender_pubkey, self._pubkey)
+            return ChaCha20Poly1305(key).decrypt(
+                bytes(packet[36:48]), bytes(packet[48:]), None)
+        except (InvalidTag, ValueError):
+            return None
+
+    def _encrypt_packet(self, data, recipient_pubkey):
+        try:
+            key = self._shared_key(recipient_pubkey, recipient_pubkey)
+        except ValueError as e:
+            raise EncryptionError("Invalid recipient public key") from e
+        nonce = os.urandom(12)
+        return (_METHOD_X25519 + self._pubkey + nonce
+                + ChaCha20Poly1305(key).encrypt(nonce, data, None))
+
+    def _shared_key(self, peer_pubkey, reader_pubkey):
+        """Return the key of packets exchanged with a peer, read by reader.
+
+        The writer of the packets is the other party.
+
+        """
+        writer_pubkey = peer_pubkey if reader_pubkey == self._pubkey \
+            else self._pubkey
+        with self._keys_lock:
+            key = self._keys.get((peer_pubkey, reader_pubkey))
+            if key is None:
+                key = self._keys[peer_pubkey, reader_pubkey] = _shared_key(
+                    self._seckey, peer_pubkey, reader_pubkey, writer_pubkey)
+        return key
+
+
+def reencrypt_many(server_seckey, recipient_pubkeys, sources,
+                   workers=DEFAULT_WORKERS):
+    """Reencrypt the headers of many objects for many recipients.
+
+    Objects are processed concurrently; failures are reported per object and
+    do not stop the others.
+
+    Args:
+        server_seckey (bytes): Crypt4gh private key (of the server).
+        recipient_pubkeys (list of bytes): Crypt4gh public keys of the
+            recipients.
+        sources (iterable of (str, callable)): Pairs of an object ID and a
+            function returning a file handle to read its header from, e.g.
+            an open file or the response to a ranged GET.
+        workers (int): Number of objects processed at the same time.
+
+    Yields:
+        result (ReencryptionResult): One per object, as they complete.
+
+    """
+    reencryptor = HeaderReencryptor(server_seckey)
+    recipient_pubkeys = list(recipient_pubkeys)
+
+    def reencrypt(object_id, open_source):
+        start = time.perf_counter()
+        result = ReencryptionResult(object_id)
+        try:
+            with open_source() as encrypted_fp:
+                result.headers, result.payload_offset = \
+                    reencryptor.reencrypt_header(
+                        recipient_pubkeys, encrypted_fp)
+        except Exception as e:
+            result.error = e
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(reencrypt, object_id, open_source)
+                   for object_id, open_source in sources]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _derive_pubkey(seckey):
+    return X25519PrivateKey.from_private_bytes(seckey).public_key() \
+        .public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+
+def _shared_key(seckey, peer_pubkey, reader_pubkey, writer_pubkey):
+    """Derive the key of a header packet, as libsodium's crypto_kx does.
+
+    The key is the first half of BLAKE2b-512 over the X25519 shared secret,
+    the public key of the packet's reader and that of its writer.
+
+    """
+    secret = X25519PrivateKey.from_private_bytes(seckey).exchange(
+        X25519PublicKey.from_public_bytes(peer_pubkey))
+    return hashlib.blake2b(
+        secret + reader_pubkey + writer_pubkey, digest_size=64).digest()[:32]
@@ -0,0 +1,398 @@
+"""Segment-level streaming crypt4gh encryption and decryption."""
+
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+
+from crypt4gh import header, SEGMENT_SIZE, CIPHER_SEGMENT_SIZE
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+from ._io import _readfull, iter_views
+from ._wrapper import EncryptionError
+
+NONCE_PREFIX_SIZE = 4
+
+# Nonce and authentication tag of each encrypted segment.
+SEGMENT_OVERHEAD = CIPHER_SEGMENT_SIZE - SEGMENT_SIZE
+
+# Segments encrypted per task in parallel mode (1 MiB of plaintext).
+BATCH_SEGMENTS = 16
+
+# Encryptor of a worker process, see `_init_worker`.
+_worker_encryptor = None
+
+# Magic number, version and number of packets.
+_PREAMBLE_SIZE = 16
+
+
+class Encryptor:
+    """Produce a crypt4gh stream one segment at a time.
+
+    The output of an encryptor is its header, followed by the encrypted
+    segments of the plaintext, in order. It is readable by stock crypt4gh.
+
+    Segment nonces are a random per-encryptor prefix followed by the segment
+    index, so an encryptor recreated from its `state` produces exactly the
+    same output for the same plaintext. This allows interrupted uploads to
+    be resumed without re-uploading what was already sent.
+
+    """
+
+    def __init__(self, client_seckey, recipient_pubkey):
+        """Create a new encryptor with a fresh session key.
+
+        Args:
+            client_seckey (bytes): Crypt4gh private key (of the client).
+            recipient_pubkey (bytes): Crypt4gh public key of the recipient.
+
+        """
+        session_key = os.urandom(32)
+        try:
+            header_bytes = _make_header(
+                session_key, client_seckey, recipient_pubkey)
+        except Exception as e:
+            raise EncryptionError() from e
+        self._setup(session_key, os.urandom(NONCE_PREFIX_SIZE), header_bytes)
+
+    @classmethod
+    def from_state(cls, state):
+        """Recreate an encryptor from the `state` of an earlier one.
+
+        No keys are needed: the header and session key are part of the state.
+
+        """
+        encryptor = cls.__new__(cls)
+        try:
+            encryptor._setup(bytes.fromhex(state["session_key"]),
+                             bytes.fromhex(state["nonce_prefix"]),
+                             bytes.fromhex(state["header"]))
+        except Exception as e:
+            raise EncryptionError() from e
+        return encryptor
+
+    def _setup(self, session_key, nonce_prefix, header_bytes):
+        if len(nonce_prefix) != NONCE_PREFIX_SIZE:
+            raise ValueError("Invalid nonce prefix")
+        self.session_key = session_key
+        self.header = header_bytes
+        self._nonce_prefix = nonce_prefix
+        self._cipher = ChaCha20Poly1305(session_key)
+
+    @property
+    def state(self):
+        """Everything needed to reproduce this encryptor's output.
+
+        Contains the session key: store it as carefully as a secret key.
+
+        Returns:
+            state (dict): JSON-serializable dictionary of hex strings.
+
+        """
+        return {
+            "session_key": self.session_key.hex(),
+            "nonce_prefix": self._nonce_prefix.hex(),
+            "header": self.header.hex(),
+        }
+
+    def encrypt_segment(self, index, segment):
+        """Encrypt a single plaintext segment (at most SEGMENT_SIZE bytes).
+
+        Args:
+            index (int): Position of the segment in the plaintext.
+            segment (bytes): The plaintext segment.
+
+        Returns:
+            ciphersegment (bytes): The nonce, followed by the ciphertext
+                and its authentication tag.
+
+        """
+        nonce = self._nonce_prefix + index.to_bytes(8, "little")
+        return nonce + self._cipher.encrypt(nonce, segment, None)
+
+    def encrypt_segments(self, index, data):
+        """Encrypt consecutive plaintext segments.
+
+        Args:
+            index (int): Position of the first segment in the plaintext.
+            data (bytes): Whole segments, except possibly for the last
+                segment of the plaintext, which may be shorter.
+
+        """
+        view = memoryview(data)
+        return b"".join(
+            self.encrypt_segment(index + i, view[start:start + SEGMENT_SIZE])
+            for i, start in enumerate(range(0, len(view), SEGMENT_SIZE)))
+
+    def iter_encrypted(self, file_fp, workers=1, processes=False,
+                       progress=None):
+        """Yield the header and encrypted segments of a plaintext stream.
+
+        With several workers, batches of segments are encrypted in parallel
+        and yielded in order. The output is the same either way.
+
+        Args:
+            file_fp: File handle for file data (opened for reading).
+            workers (int): Number of threads (or processes) encrypting.
+            processes (bool): Whether to encrypt in worker processes rather
+                than threads, for interpreters where encryption holds the
+                GIL. Plaintext is then copied to the workers.
+            progress (callable, optional): Called with the number of
+                plaintext bytes encrypted, before yielding their segments.
+
+        """
+        yield self.header
+        if workers > 1:
+            yield from self._iter_encrypted_parallel(
+                file_fp, workers, processes, progress)
+            return
+
+        for index, segment in enumerate(iter_views(file_fp, SEGMENT_SIZE)):
+            ciphersegment = self.encrypt_segment(index, segment)
+            if progress is not None:
+                progress(len(segment))
+            yield ciphersegment
+
+    def _iter_encrypted_parallel(self, file_fp, workers, processes,
+                                 progress):
+        if processes:
+            executor = ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(self.state,))
+            encrypt_segments = _encrypt_segments_in_worker
+        else:
+            executor = ThreadPoolExecutor(workers)
+            encrypt_segments = self.encrypt_segments
+
+        def result(pending):
+            future, nbytes = pending.popleft()
+            ciphertext = future.result()
+            if progress is not None:
+                progress(nbytes)
+            return ciphertext
+
+        # Bound the number of batches held in memory ahead of the consumer.
+        pending = collections.deque()
+        with executor:
+            try:
+                for index, batch in _iter_batches(file_fp):
+                    if processes:
+                        batch = bytes(batch)  # Views cannot be pickled
+                    if len(pending) >= 2 * workers:
+                        yield result(pending)
+                    pending.append((
+                        executor.submit(encrypt_segments, index, batch),
+                        len(batch)))
+                while pending:
+                    yield result(pending)
+            finally:
+                for future, _ in pending:
+                    future.cancel()
+
+
+class Decryptor:
+    """Decrypt a crypt4gh stream one segment at a time.
+
+    The header must be read first, with `read_header`. After that, segments
+    are independent, and may be decrypted in any order (and from several
+    threads at once).
+
+    """
+
+    def __init__(self, seckey, sender_pubkey=None):
+        """Create a new decryptor.
+
+        Args:
+            seckey (bytes): Crypt4gh private key of the recipient.
+            sender_pubkey (bytes, optional): If set, only accept streams
+                encrypted by the owner of this public key.
+
+        """
+        self._keys = [(0, seckey, None)]
+        self._sender_pubkey = sender_pubkey
+        self._ciphers = None
+
+    def read_header(self, encrypted_fp):
+        """Read and decrypt the header at the start of a stream.
+
+        Leaves the stream positioned at the first segment.
+
+        """
+        try:
+            session_keys, edit_list = header.deconstruct(
+                encrypted_fp, self._keys, sender_pubkey=self._sender_pubkey)
+        except Exception as e:
+            raise EncryptionError() from e
+        if edit_list is not None:
+            raise EncryptionError("Streams with edit lists are not supported")
+        self._ciphers = [ChaCha20Poly1305(key) for key in session_keys]
+
+    def decrypt_segment(self, ciphersegment):
+        """Decrypt a single encrypted segment.
+
+        Returns:
+            segment (bytes): The plaintext segment.
+
+        """
+        if self._ciphers is None:
+            raise EncryptionError("The header has not been read yet")
+        nonce, ciphertext = ciphersegment[:12], ciphersegment[12:]
+        for cipher in self._ciphers:
+            try:
+                return cipher.decrypt(nonce, ciphertext, None)
+            except InvalidTag:
+                continue
+        raise EncryptionError("Could not decrypt segment")
+
+    def decrypt_segments(self, data):
+        """Decrypt consecutive encrypted segments.
+
+        Args:
+            data (bytes): Whole encrypted segments, except possibly for the
+                last segment of the stream, which may be shorter.
+
+        """
+        view = memoryview(data)
+        return b"".join(
+            self.decrypt_segment(view[start:start + CIPHER_SEGMENT_SIZE])
+            for start in range(0, len(view), CIPHER_SEGMENT_SIZE))
+
+    def iter_decrypted(self, encrypted_fp):
+        """Yield the plaintext segments of an encrypted stream.
+
+        Args:
+            encrypted_fp: File handle for encrypted data (opened for reading).
+
+        """
+        self.read_header(encrypted_fp)
+        ciphersegment = bytearray(CIPHER_SEGMENT_SIZE)
+        view = memoryview(ciphersegment)
+        while True:
+            nbytes = _readfull(encrypted_fp, ciphersegment)
+            if nbytes:
+                yield self.decrypt_segment(view[:nbytes])
+            if nbytes < CIPHER_SEGMENT_SIZE:
+                break
+
+
+def encrypt_stream(client_seckey, recipient_pubkey, file_fp, progress=None):
+    """Encrypt file for given recipient, yielding the output in chunks.
+
+    Unlike `encrypt`, nothing is written: callers consume the header and
+    encrypted segments as they are produced, e.g. to upload them.
+
+    Args:
+        client_seckey (bytes): Crypt4gh private key (of the client).
+        recipient_pubkey (bytes): Crypt4gh public key of the recipient.
+        file_fp: File handle for file data (opened for reading).
+        progress (callable, optional): Called with the number of plaintext
+            bytes encrypted, as encryption proceeds.
+
+    Returns:
+        An iterator over bytes objects.
+
+    """
+    return Encryptor(client_seckey, recipient_pubkey).iter_encrypted(
+        file_fp, progress=progress)
+
+
+def encrypt_parallel(client_seckey, recipient_pubkey, file_fp, encrypted_fp,
+                     workers=None, processes=False, progress=None):
+    """Encrypt file for given recipient, on several cores.
+
+    Produces the same format as `encrypt`, readable by stock crypt4gh.
+
+    Args:
+        client_seckey (bytes): Crypt4gh private key (of the client).
+        recipient_pubkey (bytes): Crypt4gh public key of the recipient.
+        file_fp: File handle for file data (opened for reading).
+        encrypted_fp: File handle to write encrypted data to.
+        workers (int, optional): Number of workers; defaults to the number
+            of CPUs.
+        processes (bool): Whether to use processes rather than threads.
+        progress (callable, optional): Called with the number of plaintext
+            bytes encrypted, as encryption proceeds.
+
+    """
+    encryptor = Encryptor(client_seckey, recipient_pubkey)
+    chunks = encryptor.iter_encrypted(
+        file_fp, workers=workers or os.cpu_count() or 1, processes=processes,
+        progress=progress)
+    for chunk in chunks:
+        encrypted_fp.write(chunk)
+
+
+def decrypt_stream(seckey, encrypted_fp):
+    """Decrypt a crypt4gh stream, yielding the plaintext in chunks.
+
+    Args:
+        seckey (bytes): Crypt4gh private key of the recipient.
+        encrypted_fp: File handle for encrypted data (opened for reading).
+
+    Returns:
+        An iterator over bytes objects.
+
+    """
+    return Decryptor(seckey).iter_decrypted(encrypted_fp)
+
+
+def header_length(data):
+    """Return the length of the crypt4gh header at the start of some data.
+
+    Only the framing of the header is inspected; nothing is decrypted.
+
+    Args:
+        data (bytes): The start of a crypt4gh stream.
+
+    Returns:
+        length (int): The length of the header, in bytes, or None if the
+            data is too short to contain the whole header.
+
+    """
+    if len(data) < _PREAMBLE_SIZE:
+        return None
+    if bytes(data[:len(header.MAGIC_NUMBER)]) != header.MAGIC_NUMBER:
+        raise EncryptionError("Not a crypt4gh stream")
+    packets_count = int.from_bytes(data[12:16], "little")
+    length = _PREAMBLE_SIZE
+    for _ in range(packets_count):
+        if len(data) < length + 4:
+            return None
+        # Packet lengths include the length field itself.
+        length += int.from_bytes(data[length:length + 4], "little")
+    return length if length <= len(data) else None
+
+
+def plaintext_size(segments_size):
+    """Return the size of the plaintext held by some encrypted segments.
+
+    Args:
+        segments_size (int): Size of a crypt4gh stream, minus its header.
+
+    """
+    full, rest = divmod(segments_size, CIPHER_SEGMENT_SIZE)
+    if 0 < rest <= SEGMENT_OVERHEAD:
+        raise EncryptionError("Truncated crypt4gh segment")
+    return full * SEGMENT_SIZE + max(rest - SEGMENT_OVERHEAD, 0)
+
+
+def _make_header(session_key, client_seckey, recipient_pubkey):
+    keys = [(0, client_seckey, recipient_pubkey)]
+    packet = header.make_packet_data_enc(0, session_key)
+    return header.serialize(header.encrypt(packet, keys))
+
+
+def _iter_batches(fp):
+    """Yield (index of first segment, data) for batches of plaintext."""
+    batches = iter_views(fp, BATCH_SEGMENTS * SEGMENT_SIZE,
+                         reuse_buffer=False)
+    for batch_number, batch in enumerate(batches):
+        yield batch_number * BATCH_SEGMENTS, batch
+
+
+def _init_worker(state):
+    global _worker_encryptor
+    _worker_encryptor = Encryptor.from_state(state)
+
+
+def _encrypt_segments_in_worker(index, data):
+    return _worker_encryptor.encrypt_segments(index, data)
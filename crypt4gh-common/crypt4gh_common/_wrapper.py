@@ -1,11 +1,12 @@
 """Convenience wrappers around common crypt4gh functionality."""
 
+from crypt4gh import header
 from crypt4gh.keys import get_private_key, get_public_key
 from crypt4gh.lib import encrypt as _encrypt, reencrypt as _reencrypt
 
 
 class EncryptionError(Exception):
-    """Generic exception to raise upon (re)encryption error."""
+    """Generic exception to raise upon (re/de)cryption error."""
 
 
 def encrypt(client_seckey, recipient_pubkey, file_fp, encrypted_fp):
@@ -45,6 +46,36 @@ def reencrypt(server_seckey, recipient_pubkey, encrypted_fp, reencrypted_fp):
         raise EncryptionError() from e
 
 
+def reencrypt_header(server_seckey, recipient_pubkey, encrypted_fp):
+    """Reencrypt only the header of a crypt4gh file for a new recipient.
+
+    Reencryption leaves the encrypted segments unchanged, so the new header
+    may be spliced in front of the original payload (from the returned
+    offset on), without reading or copying it.
+
+    Args:
+        server_seckey (bytes): Crypt4gh private key (of the server).
+        recipient_pubkey (bytes): Crypt4gh public key of the recipient.
+        encrypted_fp: File handle for file data (opened for reading). Only
+            the header is read.
+
+    Returns:
+        (new_header, payload_offset) (bytes, int): The header for the
+            recipient, and the length of the original header.
+
+    """
+    keys = [(0, server_seckey, None)]
+    recipients = [(0, server_seckey, recipient_pubkey)]
+    try:
+        packets = list(header.parse(encrypted_fp))
+        new_packets = header.reencrypt(packets, keys, recipients)
+    except Exception as e:
+        raise EncryptionError() from e
+    # Magic number, version and packet count, then length-prefixed packets.
+    payload_offset = 16 + sum(4 + len(packet) for packet in packets)
+    return header.serialize(new_packets), payload_offset
+
+
 def get_seckey(filepath):
     """Load private key from file.
 
@@ -0,0 +1,34 @@
+import subprocess
+import sys
+
+import pytest
+
+import crypt4gh_common
+
+
+def test_exports_resolve():
+    # When
+    names = {name: getattr(crypt4gh_common, name)
+             for name in crypt4gh_common.__all__}
+
+    # Then
+    assert names["Encryptor"].__module__ == "crypt4gh_common._stream"
+    assert set(crypt4gh_common.__all__) <= set(dir(crypt4gh_common))
+
+
+def test_unknown_name():
+    with pytest.raises(AttributeError, match="no_such_name"):
+        crypt4gh_common.no_such_name
+
+
+def test_import_is_lazy():
+    # When
+    result = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, crypt4gh_common; "
+         "print(sorted(m for m in ('crypt4gh', 'cryptography') "
+         "if m in sys.modules))"],
+        check=True, capture_output=True, text=True)
+
+    # Then (crypt4gh is only loaded once one of its users is)
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,43 @@
+from io import BytesIO
+
+from crypt4gh_common import iter_views
+
+
+def test_iter_views_maps_regular_files(tmp_path):
+    # Given (a file read from some offset)
+    fname = tmp_path / "data"
+    fname.write_bytes(bytes(range(256)) * 40)
+
+    # When
+    with open(fname, "rb") as fp:
+        fp.read(100)
+        views = list(iter_views(fp, 4096))
+        position = fp.tell()
+
+    # Then (the rest of the file, in whole views, then the stream's end)
+    assert [len(view) for view in views] == [4096, 4096, 1948]
+    assert b"".join(views) == fname.read_bytes()[100:]
+    assert position == 10240
+
+
+def test_iter_views_reads_other_streams():
+    # Given (a stream without a file descriptor)
+    data = b"x" * 10000
+
+    # When
+    kept = list(iter_views(BytesIO(data), 4096, reuse_buffer=False))
+    reused = [bytes(view) for view in iter_views(BytesIO(data), 4096)]
+
+    # Then
+    assert b"".join(kept) == b"".join(reused) == data
+    assert [len(view) for view in kept] == [4096, 4096, 1808]
+
+
+def test_iter_views_empty_file(tmp_path):
+    # Given
+    fname = tmp_path / "empty"
+    fname.write_bytes(b"")
+
+    # When/Then
+    with open(fname, "rb") as fp:
+        assert list(iter_views(fp, 4096)) == []
@@ -0,0 +1,61 @@
+import os
+import pathlib
+import shutil
+
+import pytest
+
+from crypt4gh_common import EncryptionError, get_seckey, KeyRegistry
+
+DATA_DIR = pathlib.Path(__file__).parent / "data"
+
+
+def test_key_registry_memoizes_files(keys, tmp_path, monkeypatch):
+    # Given (a registry, and a key file)
+    registry = KeyRegistry()
+    key_file = tmp_path / "client.sk"
+    shutil.copy(DATA_DIR / "client-sk.key", key_file)
+    calls = []
+    monkeypatch.setattr("crypt4gh_common._keys.get_seckey",
+                        lambda path: calls.append(path) or get_seckey(path))
+
+    # When (the key is loaded twice)
+    first = registry.seckey(key_file)
+    second = registry.seckey(str(key_file))
+
+    # Then (it was parsed once)
+    assert first == second == keys.CLIENT_SK
+    assert len(calls) == 1
+
+    # When (the key file changes)
+    shutil.copy(DATA_DIR / "server-sk.key", key_file)
+    os.utime(key_file, ns=(0, 0))
+
+    # Then (it is parsed again)
+    assert registry.seckey(key_file) == keys.SERVER_SK
+    assert len(calls) == 2
+
+
+def test_key_registry_fetch_ttl(keys):
+    # Given
+    registry = KeyRegistry()
+    fetched = []
+
+    def fetch():
+        fetched.append(1)
+        return keys.SERVER_PK
+
+    # When/Then (kept until the TTL expires)
+    assert registry.peek("server") is None
+    assert registry.fetch("server", fetch) == keys.SERVER_PK
+    assert registry.peek("server") == keys.SERVER_PK
+    assert registry.fetch("server", fetch) == keys.SERVER_PK
+    assert len(fetched) == 1
+    assert registry.fetch("other", fetch, ttl=0) == keys.SERVER_PK
+    assert registry.fetch("other", fetch, ttl=0) == keys.SERVER_PK
+    assert len(fetched) == 3
+
+
+def test_key_registry_rejects_invalid_keys():
+    # When/Then
+    with pytest.raises(EncryptionError):
+        KeyRegistry().fetch("server", lambda: b"xyz")
@@ -0,0 +1,74 @@
+from io import BytesIO
+
+import crypt4gh
+
+from crypt4gh_common import (
+    encrypt, EncryptionError, header_length, HeaderReencryptor,
+    reencrypt_many)
+from crypt4gh_common import _reencrypt
+
+
+def test_reencrypt_header(keys):
+    # Given (data encrypted by client for server)
+    encrypted = _encrypt(b"test data", keys)
+
+    # When (reencrypt the header for third party and client)
+    reencryptor = HeaderReencryptor(keys.SERVER_SK)
+    headers, offset = reencryptor.reencrypt_header(
+        [keys.RECIPIENT_PK, keys.CLIENT_PK], BytesIO(encrypted))
+
+    # Then (either recipient can decrypt the spliced stream)
+    assert offset == header_length(encrypted)
+    payload = encrypted[offset:]
+    assert _decrypt(headers[0] + payload, keys.RECIPIENT_SK) == b"test data"
+    assert _decrypt(headers[1] + payload, keys.CLIENT_SK) == b"test data"
+
+
+def test_reencrypt_many(keys, monkeypatch):
+    # Given (several objects, one of which is not encrypted)
+    objects = {
+        "a": _encrypt(b"data a", keys),
+        "b": _encrypt(b"data b", keys),
+        "plain": b"plain data",
+    }
+    sources = [(object_id, lambda data=data: BytesIO(data))
+               for object_id, data in objects.items()]
+    derived = []
+
+    def shared_key(*args):
+        derived.append(args)
+        return shared_key.derive(*args)
+
+    shared_key.derive = _reencrypt._shared_key
+    monkeypatch.setattr(_reencrypt, "_shared_key", shared_key)
+
+    # When
+    results = {r.object_id: r for r in reencrypt_many(
+        keys.SERVER_SK, [keys.RECIPIENT_PK], sources, workers=2)}
+
+    # Then (a) the encrypted objects were reencrypted
+    for object_id in ("a", "b"):
+        result = results[object_id]
+        assert result.error is None
+        assert result.elapsed > 0
+        data = result.headers[0] + objects[object_id][result.payload_offset:]
+        assert _decrypt(data, keys.RECIPIENT_SK) == b"data " + \
+            object_id.encode()
+
+    # Then (b) the failure was reported for its object only
+    assert isinstance(results["plain"].error, EncryptionError)
+
+    # Then (c) shared keys were derived once per sender and recipient
+    assert len(derived) == 2
+
+
+def _encrypt(data, keys):
+    encrypted = BytesIO()
+    encrypt(keys.CLIENT_SK, keys.SERVER_PK, BytesIO(data), encrypted)
+    return encrypted.getvalue()
+
+
+def _decrypt(data, seckey):
+    buf_out = BytesIO()
+    crypt4gh.lib.decrypt([(0, seckey, None)], BytesIO(data), buf_out)
+    return buf_out.getvalue()
@@ -0,0 +1,202 @@
+from io import BytesIO
+import os
+
+import crypt4gh
+import pytest
+
+from crypt4gh_common import (
+    CIPHER_SEGMENT_SIZE, decrypt_stream, Decryptor, encrypt, encrypt_parallel,
+    encrypt_stream, Encryptor, EncryptionError, header_length,
+    plaintext_size)
+
+
+def test_encrypt_stream(keys):
+    # Given (data spanning several segments)
+    data = b"x" * (2 * crypt4gh.SEGMENT_SIZE + 10)
+
+    # When (collect the encrypted chunks)
+    chunks = list(encrypt_stream(keys.CLIENT_SK, keys.RECIPIENT_PK,
+                                 BytesIO(data)))
+
+    # Then (header + three segments, decryptable by the recipient)
+    assert len(chunks) == 4
+    assert _decrypt(BytesIO(b"".join(chunks)), keys.RECIPIENT_SK) == data
+
+
+def test_encrypt_stream_segment_aligned(keys):
+    # Given (data that is an exact multiple of the segment size)
+    data = b"x" * crypt4gh.SEGMENT_SIZE
+
+    # When
+    chunks = list(encrypt_stream(keys.CLIENT_SK, keys.RECIPIENT_PK,
+                                 BytesIO(data)))
+
+    # Then (no empty trailing segment)
+    assert len(chunks) == 2
+    assert _decrypt(BytesIO(b"".join(chunks)), keys.RECIPIENT_SK) == data
+
+
+def test_encryptor_fails_gracefully(keys):
+    with pytest.raises(EncryptionError):
+        Encryptor(b"xyz", keys.RECIPIENT_PK)
+
+
+def test_encryptor_from_state(keys):
+    # Given (an encryptor and its output)
+    data = b"x" * (crypt4gh.SEGMENT_SIZE + 10)
+    encryptor = Encryptor(keys.CLIENT_SK, keys.RECIPIENT_PK)
+    expected = b"".join(encryptor.iter_encrypted(BytesIO(data)))
+
+    # When (recreate the encryptor from its state)
+    resumed = Encryptor.from_state(encryptor.state)
+
+    # Then (it reproduces the output exactly)
+    assert b"".join(resumed.iter_encrypted(BytesIO(data))) == expected
+    assert _decrypt(BytesIO(expected), keys.RECIPIENT_SK) == data
+
+
+def test_encryptor_from_invalid_state():
+    with pytest.raises(EncryptionError):
+        Encryptor.from_state({"session_key": "00"})
+
+
+def test_decrypt_stream(keys):
+    # Given (a file encrypted by stock crypt4gh)
+    data = b"x" * (2 * crypt4gh.SEGMENT_SIZE + 10)
+    encrypted_data = BytesIO()
+    encrypt(keys.CLIENT_SK, keys.RECIPIENT_PK, BytesIO(data), encrypted_data)
+    encrypted_data.seek(0)
+
+    # When
+    chunks = list(decrypt_stream(keys.RECIPIENT_SK, encrypted_data))
+
+    # Then
+    assert len(chunks) == 3
+    assert b"".join(chunks) == data
+
+
+def test_decrypt_segments_out_of_order(keys):
+    # Given
+    data = b"x" * crypt4gh.SEGMENT_SIZE + b"y" * 10
+    encrypted_data = BytesIO(b"".join(
+        encrypt_stream(keys.CLIENT_SK, keys.RECIPIENT_PK, BytesIO(data))))
+    decryptor = Decryptor(keys.RECIPIENT_SK)
+    decryptor.read_header(encrypted_data)
+    payload = encrypted_data.read()
+
+    # When (decrypt the last segment first)
+    last = decryptor.decrypt_segments(payload[CIPHER_SEGMENT_SIZE:])
+    first = decryptor.decrypt_segments(payload[:CIPHER_SEGMENT_SIZE])
+
+    # Then
+    assert first + last == data
+
+
+def test_decrypt_with_wrong_key_fails(keys):
+    # Given
+    encrypted_data = BytesIO(b"".join(
+        encrypt_stream(keys.CLIENT_SK, keys.RECIPIENT_PK, BytesIO(b"data"))))
+
+    # When/Then
+    with pytest.raises(EncryptionError):
+        list(decrypt_stream(keys.SERVER_SK, encrypted_data))
+
+
+@pytest.mark.parametrize("size", [
+    0, 10, 16 * crypt4gh.SEGMENT_SIZE, 40 * crypt4gh.SEGMENT_SIZE + 10])
+@pytest.mark.parametrize("processes", [False, True])
+def test_iter_encrypted_parallel(keys, size, processes):
+    # Given (an encryptor, and a copy of it)
+    data = os.urandom(size)
+    encryptor = Encryptor(keys.CLIENT_SK, keys.RECIPIENT_PK)
+    serial = Encryptor.from_state(encryptor.state)
+
+    # When
+    chunks = encryptor.iter_encrypted(
+        BytesIO(data), workers=3, processes=processes)
+
+    # Then (same output as serial encryption)
+    assert b"".join(chunks) == b"".join(serial.iter_encrypted(BytesIO(data)))
+
+
+def test_encrypt_parallel(keys):
+    # Given
+    data = os.urandom(3 * crypt4gh.SEGMENT_SIZE + 10)
+    encrypted = BytesIO()
+
+    # When
+    encrypt_parallel(keys.CLIENT_SK, keys.RECIPIENT_PK, BytesIO(data),
+                     encrypted, workers=2)
+
+    # Then (readable by stock crypt4gh)
+    encrypted.seek(0)
+    assert _decrypt(encrypted, keys.RECIPIENT_SK) == data
+
+
+def test_header_length(keys):
+    # Given
+    encryptor = Encryptor(keys.CLIENT_SK, keys.RECIPIENT_PK)
+    data = b"".join(encryptor.iter_encrypted(BytesIO(b"data")))
+
+    # When/Then
+    assert header_length(data) == len(encryptor.header)
+    assert header_length(data[:len(encryptor.header) - 1]) is None
+    assert header_length(data[:10]) is None
+    with pytest.raises(EncryptionError):
+        header_length(b"x" * 20)
+
+
+@pytest.mark.parametrize("size", [0, 1, crypt4gh.SEGMENT_SIZE,
+                                  2 * crypt4gh.SEGMENT_SIZE + 10])
+def test_plaintext_size(keys, size):
+    # Given
+    encryptor = Encryptor(keys.CLIENT_SK, keys.RECIPIENT_PK)
+    data = b"".join(encryptor.iter_encrypted(BytesIO(b"x" * size)))
+
+    # When/Then
+    assert plaintext_size(len(data) - len(encryptor.header)) == size
+
+
+def test_plaintext_size_truncated():
+    # When/Then (too short to hold even an empty segment)
+    with pytest.raises(EncryptionError):
+        plaintext_size(CIPHER_SEGMENT_SIZE + 10)
+
+
+def _decrypt(buf, seckey):
+    buf_out = BytesIO()
+    crypt4gh.lib.decrypt([(0, seckey, None)], buf, buf_out)
+    return buf_out.getvalue()
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_encrypt_stream_from_file(keys, tmp_path, workers):
+    # Given (a regular file, which is memory-mapped)
+    data = os.urandom(20 * crypt4gh.SEGMENT_SIZE + 10)
+    fname = tmp_path / "data"
+    fname.write_bytes(data)
+
+    # When
+    with open(fname, "rb") as fp:
+        chunks = list(Encryptor(keys.CLIENT_SK, keys.RECIPIENT_PK)
+                      .iter_encrypted(fp, workers=workers))
+
+    # Then
+    assert _decrypt(BytesIO(b"".join(chunks)), keys.RECIPIENT_SK) == data
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_iter_encrypted_progress(keys, workers):
+    # Given
+    data = b"x" * (40 * crypt4gh.SEGMENT_SIZE + 10)
+    reported = []
+
+    # When
+    chunks = Encryptor(keys.CLIENT_SK, keys.RECIPIENT_PK).iter_encrypted(
+        BytesIO(data), workers=workers, progress=reported.append)
+    for _ in chunks:
+        pass
+
+    # Then (all plaintext was reported, in steps)
+    assert sum(reported) == len(data)
+    assert len(reported) > 1
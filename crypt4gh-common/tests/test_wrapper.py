@@ -3,7 +3,8 @@ from io import BytesIO
 import crypt4gh
 import pytest
 
-from crypt4gh_common import encrypt, reencrypt, EncryptionError
+from crypt4gh_common import (
+    encrypt, header_length, reencrypt, reencrypt_header, EncryptionError)
 
 
 def test_encrypt(keys):
@@ -54,6 +55,31 @@ def test_reencrypt_fails_gracefully(keys):
         reencrypt(keys.SERVER_SK, keys.RECIPIENT_PK, file_data, BytesIO())
 
 
+def test_reencrypt_header(keys):
+    # Given (encrypted data by client for server)
+    encrypted_data = BytesIO()
+    encrypt(keys.CLIENT_SK, keys.SERVER_PK, BytesIO(b"test data"),
+            encrypted_data)
+    encrypted = encrypted_data.getvalue()
+
+    # When (reencrypt the header only, without the payload)
+    new_header, offset = reencrypt_header(
+        keys.SERVER_SK, keys.RECIPIENT_PK, BytesIO(encrypted))
+
+    # Then (the new header, followed by the original payload, is
+    # decryptable by the third party)
+    assert offset == header_length(encrypted)
+    spliced = BytesIO(new_header + encrypted[offset:])
+    assert _decrypt(spliced, keys.RECIPIENT_SK) == b"test data"
+
+
+def test_reencrypt_header_fails_gracefully(keys):
+    # When (attempting to reencrypt unencrypted data)
+    with pytest.raises(EncryptionError):
+        reencrypt_header(
+            keys.SERVER_SK, keys.RECIPIENT_PK, BytesIO(b"test data"))
+
+
 def _decrypt(buf, seckey):
     buf_out = BytesIO()
     crypt4gh.lib.decrypt([(0, seckey, None)], buf, buf_out)
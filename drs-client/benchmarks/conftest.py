@@ -0,0 +1,217 @@
+"""Offline stand-ins and payloads for the benchmarks.
+
+S3 is served by moto, in this process, unless --bench-s3 points at another
+endpoint (e.g. a local MinIO, for payloads that do not fit in memory). The
+DRS-filer is a small HTTP server that accepts any object.
+"""
+from base64 import b64encode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import resource
+import sys
+import threading
+
+import boto3
+from crypt4gh.keys import c4gh
+import pytest
+
+from crypt4gh_common import get_pubkey, get_seckey
+
+BUCKET = "benchmarks"
+
+_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+# Payloads repeat a block of random data, as fast to write as zeros but not
+# compressible by accident.
+_BLOCK_SIZE = 1 << 20
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmarks")
+    group.addoption(
+        "--bench-sizes", default="64K,16M,256M",
+        help="Comma-separated payload sizes, e.g. 1K,1G,20G")
+    group.addoption(
+        "--bench-objects", default="100,1000",
+        help="Comma-separated numbers of objects per batch, e.g. 10000")
+    group.addoption(
+        "--bench-s3", default=None, metavar="URL",
+        help="S3 endpoint to upload to, instead of an in-process moto "
+             "server; ACCESS_KEY and SECRET_KEY must be set for it")
+
+
+def pytest_generate_tests(metafunc):
+    config = metafunc.config
+    if "size" in metafunc.fixturenames:
+        sizes = config.getoption("--bench-sizes").split(",")
+        metafunc.parametrize("size", [parse_size(s) for s in sizes],
+                             ids=sizes)
+    if "count" in metafunc.fixturenames:
+        counts = [int(c) for c in config.getoption("--bench-objects")
+                  .split(",")]
+        metafunc.parametrize("count", counts, ids=str)
+
+
+def parse_size(text):
+    """Parse a size such as 64K or 20G, in bytes."""
+    text = text.strip().upper().rstrip("B")
+    if text[-1:] in _UNITS:
+        return int(float(text[:-1]) * _UNITS[text[-1]])
+    return int(text)
+
+
+def rounds(nbytes):
+    """Number of rounds for a benchmark processing some bytes per round."""
+    return max(1, min(10, (1 << 30) // max(nbytes, 1)))
+
+
+def report(benchmark, nbytes=None, objects=None):
+    """Add throughput and peak memory use to a benchmark's results.
+
+    Call after the benchmark ran. Results are in the `extra_info` of each
+    benchmark, shown with --benchmark-json or --benchmark-save. Nothing is
+    added with --benchmark-disable, which runs benchmarks once, untimed.
+
+    """
+    if benchmark.stats is None:
+        return
+    mean = benchmark.stats.stats.mean
+    if nbytes is not None:
+        benchmark.extra_info["MB/s"] = round(nbytes / mean / 1e6, 1)
+    if objects is not None:
+        benchmark.extra_info["objects/s"] = round(objects / mean, 1)
+    benchmark.extra_info["peak RSS (MB)"] = round(_peak_rss() / 1e6, 1)
+
+
+def _peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in kilobytes elsewhere.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@pytest.fixture(scope="session")
+def payloads(tmp_path_factory):
+    """Return a function creating (once) a payload file of a given size."""
+    directory = tmp_path_factory.mktemp("payloads")
+    block = os.urandom(_BLOCK_SIZE)
+    created = {}
+
+    def payload(size):
+        if size not in created:
+            path = directory / f"payload-{size}"
+            with open(path, "wb") as fp:
+                for offset in range(0, size, _BLOCK_SIZE):
+                    fp.write(block[:size - offset])
+            created[size] = path
+        return created[size]
+
+    return payload
+
+
+@pytest.fixture(scope="session")
+def keys(tmp_path_factory):
+    """Crypt4gh keys of a client and of the DRS server.
+
+    The client secret key is also written to `client_sk_file`, as the
+    uploader loads it from there.
+
+    """
+    directory = tmp_path_factory.mktemp("keys")
+    attributes = {}
+    for owner in ("client", "server"):
+        seckey = directory / f"{owner}.sk"
+        pubkey = directory / f"{owner}.pk"
+        c4gh.generate(str(seckey), str(pubkey), None, None)
+        attributes[f"{owner}_sk"] = get_seckey(str(seckey))
+        attributes[f"{owner}_pk"] = get_pubkey(str(pubkey))
+    attributes["client_sk_file"] = str(directory / "client.sk")
+    return type("Keys", (), attributes)
+
+
+@pytest.fixture(scope="session")
+def s3_endpoint(request):
+    """Return the URL of an S3 endpoint holding the benchmark bucket."""
+    endpoint = request.config.getoption("--bench-s3")
+    server = None
+    if endpoint is None:
+        from moto.server import ThreadedMotoServer
+
+        server = ThreadedMotoServer("127.0.0.1", port=0, verbose=False)
+        server.start()
+        endpoint = "http://%s:%d" % server.get_host_and_port()
+        os.environ.setdefault("ACCESS_KEY", "benchmark")
+        os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    s3 = boto3.client(
+        "s3", endpoint_url=endpoint,
+        aws_access_key_id=os.environ["ACCESS_KEY"],
+        aws_secret_access_key=os.environ["SECRET_KEY"])
+    try:
+        s3.create_bucket(Bucket=BUCKET)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    yield endpoint
+    if server is not None:
+        server.stop()
+
+
+@pytest.fixture(scope="session")
+def drs_filer(keys):
+    """Return the URL of a stand-in DRS-filer, advertising a server key.
+
+    Objects are registered without being recorded. Looking up an object
+    returns one stored in the benchmark bucket, under the object's ID.
+
+    """
+    service_info = json.dumps({
+        "id": "benchmarks",
+        "crypt4gh": {"pubkey": b64encode(keys.server_pk).decode("ascii")},
+    }).encode()
+    counter = iter(range(1 << 62))
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Do not let responses wait for delayed acknowledgements.
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            # Any object is taken to be stored in the benchmark bucket,
+            # under its ID.
+            prefix = "/ga4gh/drs/v1/objects/"
+            if not self.path.startswith(prefix):
+                self._respond(service_info)
+                return
+            name = self.path[len(prefix):]
+            self._respond(json.dumps({
+                "id": name,
+                "name": name,
+                "access_methods": [{
+                    "type": "s3",
+                    "access_url": {"url": f"s3://{BUCKET}/{name}"},
+                }],
+            }).encode())
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            with lock:
+                drs_id = next(counter)
+            self._respond(b'"object-%d"' % drs_id)
+
+        def _respond(self, body):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://%s:%d" % server.server_address
+    server.shutdown()
@@ -0,0 +1,66 @@
+from io import BytesIO
+import os
+
+import pytest
+
+from crypt4gh_common import (
+    encrypt, encrypt_parallel, encrypt_stream, reencrypt, reencrypt_many)
+
+from conftest import report, rounds
+
+
+@pytest.fixture
+def encrypted(tmp_path, payloads, keys, size):
+    """Path of a payload encrypted for the server."""
+    path = tmp_path / "payload.crypt4gh"
+    with open(payloads(size), "rb") as fp, open(path, "wb") as out:
+        encrypt(keys.client_sk, keys.server_pk, fp, out)
+    return path
+
+
+def test_encrypt(benchmark, payloads, keys, size):
+    path = payloads(size)
+
+    def run():
+        with open(path, "rb") as fp, open(os.devnull, "wb") as out:
+            encrypt(keys.client_sk, keys.server_pk, fp, out)
+
+    benchmark.pedantic(run, rounds=rounds(size))
+    report(benchmark, nbytes=size)
+
+
+@pytest.mark.parametrize("workers", [4])
+def test_encrypt_parallel(benchmark, payloads, keys, size, workers):
+    path = payloads(size)
+
+    def run():
+        with open(path, "rb") as fp, open(os.devnull, "wb") as out:
+            encrypt_parallel(keys.client_sk, keys.server_pk, fp, out,
+                             workers=workers)
+
+    benchmark.pedantic(run, rounds=rounds(size))
+    report(benchmark, nbytes=size)
+
+
+def test_reencrypt(benchmark, encrypted, keys, size):
+
+    def run():
+        with open(encrypted, "rb") as fp, open(os.devnull, "wb") as out:
+            reencrypt(keys.server_sk, keys.client_pk, fp, out)
+
+    benchmark.pedantic(run, rounds=rounds(size))
+    report(benchmark, nbytes=size)
+
+
+def test_reencrypt_many_headers(benchmark, keys, count):
+    header = b"".join(encrypt_stream(
+        keys.client_sk, keys.server_pk, BytesIO(b"x")))
+    sources = [(str(i), lambda: BytesIO(header)) for i in range(count)]
+
+    def run():
+        for result in reencrypt_many(
+                keys.server_sk, [keys.client_pk], sources):
+            assert result.error is None
+
+    benchmark.pedantic(run, rounds=3)
+    report(benchmark, objects=count)
@@ -0,0 +1,16 @@
+from drs_client.files import compute_digests, compute_sha256
+
+from conftest import report, rounds
+
+
+def test_compute_sha256(benchmark, payloads, size):
+    path = payloads(size)
+    benchmark.pedantic(compute_sha256, args=(path,), rounds=rounds(size))
+    report(benchmark, nbytes=size)
+
+
+def test_compute_digests_single_pass(benchmark, payloads, size):
+    path = payloads(size)
+    benchmark.pedantic(compute_digests, args=(path, ("sha-256", "md5")),
+                       rounds=rounds(size))
+    report(benchmark, nbytes=size)
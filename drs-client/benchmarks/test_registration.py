@@ -0,0 +1,34 @@
+from drs_client.drs import DRSClient, DRSMetadata
+
+from conftest import report
+
+
+def _metadata(count):
+    return [
+        DRSMetadata(name=f"object-{i}", checksum="0" * 64, size=i,
+                    url=f"s3://benchmarks/object-{i}")
+        for i in range(count)]
+
+
+def test_post_metadata(benchmark, drs_filer, count):
+    client = DRSClient(drs_filer)
+    metadata = _metadata(count)
+
+    def run():
+        for item in metadata:
+            client.post_metadata(item)
+
+    benchmark.pedantic(run, rounds=3)
+    report(benchmark, objects=count)
+
+
+def test_post_metadata_many(benchmark, drs_filer, count):
+    client = DRSClient(drs_filer)
+    metadata = _metadata(count)
+
+    def run():
+        for result in client.post_metadata_many(metadata):
+            assert result.error is None
+
+    benchmark.pedantic(run, rounds=3)
+    report(benchmark, objects=count)
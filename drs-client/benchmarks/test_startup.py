@@ -0,0 +1,48 @@
+"""Startup time of the command-line interface.
+
+Scripts often run drs-client once per file, which makes the time it takes
+to start add up. Every round runs the CLI in a new interpreter.
+"""
+import os
+import subprocess
+import sys
+
+import boto3
+import pytest
+
+from conftest import BUCKET
+
+# Runs drs-client as its console script does.
+_CLI = [sys.executable, "-c", "from drs_client.client import cli; cli()"]
+
+_ROUNDS = 10
+
+
+def _run(*args):
+    subprocess.run(_CLI + list(args), check=True, stdout=subprocess.DEVNULL)
+
+
+@pytest.mark.parametrize("args", [["--help"], ["download", "--help"]],
+                         ids=["help", "download-help"])
+def test_help(benchmark, args):
+    benchmark.pedantic(_run, args=args, rounds=_ROUNDS)
+
+
+def test_download(benchmark, tmp_path, s3_endpoint, drs_filer, monkeypatch):
+    # Fetch a small object: the time is mostly that of starting up.
+    s3 = boto3.client(
+        "s3", endpoint_url=s3_endpoint,
+        aws_access_key_id=os.environ["ACCESS_KEY"],
+        aws_secret_access_key=os.environ["SECRET_KEY"])
+    s3.put_object(Bucket=BUCKET, Key="startup.dat", Body=b"x" * 1024)
+    config = tmp_path / "drs-client.yaml"
+    config.write_text(
+        f"drs_url: {drs_filer}/\n"
+        f"storage_url: {s3_endpoint}\n"
+        f"bucket: {BUCKET}\n"
+        f"access_key: {os.environ['ACCESS_KEY']}\n"
+        f"secret_key: {os.environ['SECRET_KEY']}\n")
+    monkeypatch.chdir(tmp_path)
+    benchmark.pedantic(
+        _run, args=("-c", str(config), "download", "startup.dat"),
+        rounds=_ROUNDS)
@@ -0,0 +1,24 @@
+from drs_client.store import BucketStore, TransferSettings
+from drs_client.upload import Uploader
+
+from conftest import BUCKET, report, rounds
+
+
+def test_upload_file(benchmark, s3_endpoint, payloads, size):
+    path = payloads(size)
+    store = BucketStore(BUCKET, endpoint=s3_endpoint,
+                        transfer=TransferSettings())
+    benchmark.pedantic(store.upload_file, args=(str(path),),
+                       rounds=rounds(size))
+    report(benchmark, nbytes=size)
+
+
+def test_upload_and_register(
+        benchmark, s3_endpoint, drs_filer, keys, payloads, size):
+    # Encrypt, upload and register, as the `upload` command does.
+    uploader = Uploader(drs_filer, s3_endpoint, BUCKET,
+                        client_sk=keys.client_sk_file)
+    path = payloads(size)
+    benchmark.pedantic(uploader.upload, args=(str(path),),
+                       rounds=rounds(size))
+    report(benchmark, nbytes=size)
@@ -0,0 +1,640 @@
+"""Asyncio counterparts of the DRS client, bucket store and uploader.
+
+Many metadata calls and object transfers can be in flight at once on a
+single event loop. Reading, encrypting and digesting file data is CPU and
+disk bound, and runs in the loop's default executor, one part at a time.
+
+Requires the optional `async` dependencies (aiohttp and aiobotocore).
+"""
+
+import asyncio
+from base64 import b64decode
+import json
+import logging
+import os
+from urllib.parse import quote, urljoin
+
+import botocore
+import click
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+try:
+    import aiohttp
+    from aiobotocore.session import get_session
+except ImportError:  # pragma: no cover - optional dependency
+    aiohttp = get_session = None
+
+from .drs import (
+    _create_request_data, _POST_RETRY_STATUSES, _RETRY_STATUSES,
+    DEFAULT_BACKOFF, DEFAULT_RETRIES, DEFAULT_TIMEOUT, DRSMetadata,
+    RegistrationResult)
+from .files import DigestEngine
+from .store import _error_code, fitting_part_size, _grown_part_size, \
+    _iter_parts, _PositionalWriter, _preallocate, _slots_needed, \
+    TransferSettings
+from . import upload as _upload
+from .throttle import default_limiter
+
+from crypt4gh_common import Encryptor, key_registry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 100  # Connections per client
+
+
+class AsyncDRSClient:
+    """Asyncio counterpart of `DRSClient`.
+
+    Use as an async context manager, or call `close` when done.
+
+    """
+
+    def __init__(self, drs_url, limit=DEFAULT_LIMIT, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        """Create a new client.
+
+        Args:
+            drs_url (str): The URL of the DRS server.
+            limit (int): Maximum number of open connections.
+            timeout ((float, float)): Connect and read timeouts, in seconds.
+            retries (int): Number of retries of requests that failed to
+                connect or were answered with 429 or 5xx, and of requests
+                other than POSTs that failed or timed out while reading the
+                response, as for `DRSClient`.
+            backoff (float): Initial delay between attempts, in seconds.
+
+        """
+        _check_installed()
+        self._drs_url = drs_url
+        self._limit = limit
+        self._timeout = aiohttp.ClientTimeout(
+            sock_connect=timeout[0], sock_read=timeout[1])
+        self._retries = retries
+        self._backoff = backoff
+        self._session = None
+        self._service_info = None  # (ETag, service info) of last response
+
+    @property
+    def url(self):
+        return self._drs_url
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def post_metadata(self, drs_metadata):
+        """Upload a single metadata object; return its DRS ID."""
+        request_data = _create_request_data(drs_metadata)
+        objects_endpoint = urljoin(self._drs_url, "ga4gh/drs/v1/objects")
+
+        logger.info("Uploading metadata %s to %s",
+                    drs_metadata, objects_endpoint)
+        _, _, body = await self._request(
+            "POST", objects_endpoint,
+            headers={"Content-Type": "application/json"},
+            data=json.dumps(request_data))
+        object_id = body.decode("ascii").strip()[1:-1]
+
+        logger.info("Upload complete for object ID %s", object_id)
+        return object_id
+
+    async def post_metadata_many(self, drs_metadata,
+                                 concurrency=DEFAULT_LIMIT):
+        """Upload many metadata objects, several at a time.
+
+        Returns:
+            results (list of RegistrationResult): One per metadata object,
+                in input order.
+
+        """
+        slots = asyncio.Semaphore(concurrency)
+
+        async def post(metadata):
+            async with slots:
+                try:
+                    return RegistrationResult(
+                        drs_id=await self.post_metadata(metadata))
+                except Exception as e:
+                    logger.error("Registration of %s failed: %s",
+                                 metadata.name, e)
+                    return RegistrationResult(error=e)
+
+        return list(await asyncio.gather(
+            *(post(metadata) for metadata in drs_metadata)))
+
+    async def get_object(self, object_id):
+        """Retrieve the metadata of a single object."""
+        object_endpoint = urljoin(
+            self._drs_url, f"ga4gh/drs/v1/objects/{quote(object_id)}")
+        _, _, body = await self._request("GET", object_endpoint)
+        return json.loads(body)
+
+    async def get_service_info(self):
+        """Return service info object, revalidating it by ETag."""
+        service_info = urljoin(self._drs_url, "ga4gh/drs/v1/service-info")
+
+        headers = {}
+        cached = self._service_info
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
+        status, response_headers, body = await self._request(
+            "GET", service_info, headers=headers)
+        if cached is not None and status == 304:
+            return cached[1]
+
+        data = json.loads(body)
+        etag = response_headers.get("ETag")
+        self._service_info = (etag, data) if etag else None
+        return data
+
+    async def _request(self, method, url, **kwds):
+        """Send a request, retrying as `DRSClient` does.
+
+        Returns:
+            (status, headers, body): Of the final response.
+
+        Raises:
+            aiohttp.ClientResponseError: if the final response is an error.
+
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._limit),
+                timeout=self._timeout)
+        statuses = _POST_RETRY_STATUSES if method == "POST" \
+            else _RETRY_STATUSES
+
+        delay = self._backoff
+        for attempt in range(self._retries + 1):
+            last = attempt == self._retries
+            await _throttle(default_limiter.requests, 1)
+            try:
+                async with self._session.request(
+                        method, url, **kwds) as response:
+                    body = await response.read()
+                    if response.status not in statuses or last:
+                        if response.status >= 400:
+                            response.raise_for_status()
+                        return response.status, response.headers, body
+                    wait = _retry_after(response.headers, delay)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # Registrations that may have reached the server are not
+                # sent again, as they are not idempotent.
+                if last or (method == "POST" and not isinstance(
+                        e, aiohttp.ClientConnectorError)):
+                    raise
+                wait = delay
+            logger.warning("%s %s failed, retrying in %.1fs",
+                           method, url, wait)
+            await asyncio.sleep(wait)
+            delay *= 2
+
+
+class AsyncBucketStore:
+    """Asyncio counterpart of `BucketStore`.
+
+    Use as an async context manager, which opens and closes the
+    connections to storage.
+
+    """
+
+    def __init__(self, bucket, endpoint=None, transfer=None,
+                 max_connections=None):
+        """Create new AsyncBucketStore instance.
+
+        Args:
+            bucket: The name of the bucket to use.
+            endpoint (optional): The hostname and port of the storage server.
+            transfer (TransferSettings, optional): Multipart transfer
+                settings. If not set, defaults are used.
+            max_connections (int, optional): Size of the connection pool.
+                Defaults to enough connections for a single transfer.
+
+        """
+        _check_installed()
+        self._transfer = transfer or TransferSettings()
+        self._endpoint = endpoint
+        self._max_connections = max_connections or max(
+            10, self._transfer.max_concurrency)
+        self._bucket = bucket
+        self._client_context = None
+        self._client = None
+
+    async def __aenter__(self):
+        self._client_context = _configure_client(
+            self._endpoint, self._max_connections)
+        self._client = await self._client_context.__aenter__()
+        # Allow for easy creation of URLs to bucket objects.
+        self._client._client_config.signature_version = botocore.UNSIGNED
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._client_context.__aexit__(*exc_info)
+        self._client = self._client_context = None
+
+    async def upload_file(self, file_path, name=None):
+        """Upload a file to the store; return a URL to retrieve it."""
+        name = name or os.path.basename(file_path)
+        with open(file_path, "rb") as fp:
+            part_size = self._transfer.part_size
+            return await self.upload_stream(
+                iter(lambda: fp.read(part_size), b""), name,
+                size=os.fstat(fp.fileno()).st_size)
+
+    async def upload_stream(self, chunks, name, part_size=None, size=None):
+        """Upload a stream of unknown length to the store.
+
+        As `BucketStore.upload_stream`, without journals. Chunks may be
+        an async iterable, or a plain iterable, which is then consumed in
+        the default executor, so that reading or encrypting the data does
+        not block the event loop.
+
+        Returns:
+            url (str): A URL that can be used to retrieve the file from storage
+
+        """
+        part_size = part_size or self._transfer.part_size
+        if size is not None:
+            part_size = fitting_part_size(size, part_size)
+        logger.debug("Uploading stream to %s", name)
+        grow = size is None
+        if hasattr(chunks, "__aiter__"):
+            parts = _aiter_async_parts(chunks, part_size, grow)
+        else:
+            parts = _aiter_in_executor(_iter_parts(chunks, part_size, grow))
+
+        first = await _anext(parts, b"")
+        second = await _anext(parts, None)
+        if second is None:
+            await _throttle(default_limiter.bandwidth, len(first))
+            await self._client.put_object(
+                Bucket=self._bucket, Key=name, Body=first)
+        else:
+            await self._upload_multipart(
+                _achain([first, second], parts), name)
+        logger.debug("Upload finished for stream %s", name)
+        return await self.generate_presigned_url(name)
+
+    async def abort_upload(self, name, upload_id):
+        """Abort an unfinished multipart upload, discarding its parts."""
+        logger.info("Aborting multipart upload of %s", name)
+        try:
+            await self._client.abort_multipart_upload(
+                Bucket=self._bucket, Key=name, UploadId=upload_id)
+        except ClientError as e:
+            if _error_code(e) != "NoSuchUpload":
+                raise
+
+    async def _upload_multipart(self, parts, name):
+        upload_id = (await self._client.create_multipart_upload(
+            Bucket=self._bucket, Key=name))["UploadId"]
+        concurrency = self._transfer.max_concurrency \
+            if self._transfer.parallel else 1
+        transfers = asyncio.Semaphore(concurrency)
+        # Producing parts stalls while too many wait to be uploaded.
+        capacity = max(concurrency, self._transfer.max_inflight_parts)
+        slots = asyncio.Semaphore(capacity)
+
+        async def upload(number, body, held):
+            try:
+                async def send():
+                    await _throttle(default_limiter.bandwidth, len(body))
+                    return await self._client.upload_part(
+                        Bucket=self._bucket, Key=name, UploadId=upload_id,
+                        PartNumber=number, Body=body)
+
+                async with transfers:
+                    response = await self._retry(
+                        send, f"part {number} of {name}")
+                return {"PartNumber": number, "ETag": response["ETag"]}
+            finally:
+                for _ in range(held):
+                    slots.release()
+
+        tasks = []
+        try:
+            number = 0
+            async for body in parts:
+                number += 1
+                held = _slots_needed(
+                    len(body), self._transfer.part_size, capacity)
+                for _ in range(held):
+                    await slots.acquire()
+                if any(task.done() and task.exception() for task in tasks):
+                    break
+                tasks.append(
+                    asyncio.ensure_future(upload(number, body, held)))
+            completed = await asyncio.gather(*tasks)
+            await self._client.complete_multipart_upload(
+                Bucket=self._bucket, Key=name, UploadId=upload_id,
+                MultipartUpload={"Parts": list(completed)})
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.abort_upload(name, upload_id)
+            raise
+
+    async def download_file(self, file_id, file_path):
+        """Download file from the store, fetching parts concurrently."""
+        size = await self.object_size(file_id)
+        part_size = self._transfer.part_size
+        concurrency = self._transfer.max_concurrency \
+            if self._transfer.parallel else 1
+        transfers = asyncio.Semaphore(concurrency)
+        loop = asyncio.get_running_loop()
+
+        try:
+            with open(file_path, "wb") as fp:
+                _preallocate(fp.fileno(), size)
+                writer = _PositionalWriter(fp.fileno())
+
+                async def download(start):
+                    # Parts are held until written, which bounds the data
+                    # buffered when the disk is slower than the network.
+                    async with transfers:
+                        data = await self.read_range(
+                            file_id, start, min(start + part_size, size))
+                        write = loop.run_in_executor(
+                            None, writer.write, start, data)
+                        try:
+                            await asyncio.shield(write)
+                        except asyncio.CancelledError:
+                            # The write goes on in its thread: the file
+                            # must not be closed before it is done.
+                            await asyncio.wait([write])
+                            raise
+
+                tasks = [asyncio.ensure_future(download(start))
+                         for start in range(0, size, part_size)]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+        except BaseException:
+            os.remove(file_path)
+            raise
+
+    async def object_size(self, name):
+        """Return the size of a stored object, in bytes."""
+        response = await self._client.head_object(
+            Bucket=self._bucket, Key=name)
+        return response["ContentLength"]
+
+    async def read_range(self, name, start, end):
+        """Read bytes [start, end) of a stored object."""
+        if end <= start:
+            return b""
+
+        async def read():
+            await _throttle(default_limiter.bandwidth, end - start)
+            response = await self._client.get_object(
+                Bucket=self._bucket, Key=name,
+                Range=f"bytes={start}-{end - 1}")
+            data = await response["Body"].read()
+            if len(data) != end - start:
+                raise IOError(f"Short read: got {len(data)} bytes "
+                              f"of {end - start}")
+            return data
+
+        return await self._retry(read, f"bytes {start}-{end - 1} of {name}")
+
+    async def generate_presigned_url(self, name):
+        """Generate presigned URL for bucket object."""
+        return await self._client.generate_presigned_url(
+            "get_object",
+            ExpiresIn=3600,
+            Params={'Bucket': self._bucket, 'Key': name},
+        )
+
+    async def _retry(self, func, what):
+        """Await func(), retrying with exponential backoff, as `_retry`."""
+        delay = self._transfer.retry_backoff
+        for attempt in range(self._transfer.part_retries + 1):
+            try:
+                return await func()
+            except (BotoCoreError, ClientError, OSError) as e:
+                if attempt >= self._transfer.part_retries:
+                    raise
+                logger.warning(
+                    "Transfer of %s failed (%s), retrying in %.1fs",
+                    what, e, delay)
+                await asyncio.sleep(delay)
+                delay *= 2
+
+
+class AsyncUploader:
+    """Asyncio counterpart of `Uploader`, without resumable uploads.
+
+    Many uploads may run concurrently on one event loop, sharing the DRS
+    and storage connections of the uploader. Use as an async context
+    manager.
+
+    """
+
+    def __init__(self, drs_url, storage_url, bucket,
+                 encrypt=True, client_sk=None, transfer=None,
+                 max_connections=None):
+        """Create a new uploader; see `upload_and_register`."""
+        self._drs_client = AsyncDRSClient(
+            drs_url, limit=max(DEFAULT_LIMIT, max_connections or 0))
+        self._encrypt = encrypt
+        self._client_sk = client_sk
+        self._transfer = transfer or TransferSettings()
+        self._bucket = bucket
+        self._store_client = AsyncBucketStore(
+            bucket, endpoint=storage_url, transfer=self._transfer,
+            max_connections=max_connections)
+        self._server_pubkey = self._client_seckey = None
+
+    async def __aenter__(self):
+        if self._encrypt:
+            try:
+                self._server_pubkey, self._client_seckey = \
+                    await _load_crypt4gh_keys(
+                        self._drs_client, self._client_sk)
+            except BaseException:
+                await self._drs_client.close()
+                raise
+        await self._store_client.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._drs_client.close()
+        await self._store_client.__aexit__(*exc_info)
+
+    async def upload(self, filename, desc=""):
+        """Upload a file to storage and register its DRS metadata.
+
+        Returns:
+            drs_id (str) : the DRS ID of the uploaded object.
+
+        """
+        name = os.path.basename(filename)
+        digests = DigestEngine()
+        with open(filename, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if self._encrypt:
+                name += ".crypt4gh"
+                encryptor = Encryptor(
+                    self._client_seckey, self._server_pubkey)
+                chunks = encryptor.iter_encrypted(
+                    fp, workers=self._transfer.encryption_workers)
+                size = _upload._encrypted_size(size)
+            else:
+                chunks = iter(lambda: fp.read(self._transfer.part_size), b"")
+            await self._store_client.upload_stream(
+                _digested(chunks, digests), name, size=size)
+
+        digest_result = digests.result()
+        metadata = DRSMetadata(
+            name=name,
+            checksum=digest_result.digests["sha-256"],
+            size=digest_result.size,
+            url=_upload._create_s3_resource_url(self._bucket, name),
+            description=desc,
+        )
+        return await self._drs_client.post_metadata(metadata)
+
+
+async def upload_and_register(
+        filename, drs_url, storage_url, bucket,
+        encrypt=True, client_sk=None, desc="", transfer=None):
+    """Asyncio counterpart of `drs_client.upload.upload_and_register`.
+
+    Returns:
+        drs_id (str) : the DRS ID of the uploaded object.
+
+    """
+    uploader = AsyncUploader(
+        drs_url, storage_url, bucket, encrypt=encrypt, client_sk=client_sk,
+        transfer=transfer)
+    async with uploader:
+        return await uploader.upload(filename, desc=desc)
+
+
+async def _load_crypt4gh_keys(client, client_sk):
+    """Load crypt4gh key data, or bail out as `Uploader` does."""
+    try:
+        server_pubkey = await _get_server_pubkey(client)
+    except Exception:
+        raise click.ClickException(
+            "Encryption requested but server does not "
+            "advertise a Crypt4gh public key.")
+
+    try:
+        # Reading the key file (and asking for its passphrase) blocks.
+        client_seckey = await asyncio.get_running_loop().run_in_executor(
+            None, key_registry.seckey, client_sk)
+    except Exception:
+        raise click.ClickException(
+            f"Could not load client secret key from location: {client_sk}."
+            " Specify a valid key with the --client-sk flag.")
+
+    return server_pubkey, client_seckey
+
+
+async def _get_server_pubkey(client):
+    """Retrieve server public key, advertised in /service-info."""
+    name = ("server-pubkey", client.url)
+    pubkey = key_registry.peek(name)
+    if pubkey is not None:
+        return pubkey
+    try:
+        service_info = await client.get_service_info()
+        pubkey_b64 = service_info["crypt4gh"]["pubkey"]
+        logger.info("Loaded server public key: %s", pubkey_b64)
+        return key_registry.fetch(name, lambda: b64decode(pubkey_b64))
+    except Exception as e:
+        raise _upload.KeyError() from e
+
+
+def _digested(chunks, digests):
+    for chunk in chunks:
+        digests.update(chunk)
+        yield chunk
+
+
+def _configure_client(endpoint, max_connections):
+    """Return a context manager creating an aiobotocore S3 client."""
+    return get_session().create_client(
+        "s3",
+        endpoint_url=endpoint,
+        aws_access_key_id=os.environ["ACCESS_KEY"],
+        aws_secret_access_key=os.environ["SECRET_KEY"],
+        config=Config(max_pool_connections=max_connections),
+    )
+
+
+def _retry_after(headers, default):
+    """Seconds to wait according to a Retry-After header, if any."""
+    try:
+        return max(0.0, float(headers.get("Retry-After", default)))
+    except ValueError:  # An HTTP date; not worth parsing
+        return default
+
+
+async def _throttle(bucket, amount):
+    """Wait for tokens of a rate limit without blocking the event loop."""
+    delay = bucket.reserve(amount)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def _aiter_in_executor(iterator):
+    """Consume a blocking iterator in the default executor."""
+    loop = asyncio.get_running_loop()
+    sentinel = object()
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, sentinel)
+        if item is sentinel:
+            return
+        yield item
+
+
+async def _aiter_async_parts(chunks, part_size, grow=False):
+    """Regroup an async stream of chunks into parts, as `_iter_parts`."""
+    buf = bytearray()
+    number = 1
+    size = part_size
+    async for chunk in chunks:
+        buf += chunk
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+            number += 1
+            if grow:
+                size = _grown_part_size(part_size, number)
+    if buf:
+        yield bytes(buf)
+
+
+async def _achain(items, aiterator):
+    for item in items:
+        yield item
+    async for item in aiterator:
+        yield item
+
+
+async def _anext(aiterator, default):
+    try:
+        return await aiterator.__anext__()
+    except StopAsyncIteration:
+        return default
+
+
+def _check_installed():
+    if aiohttp is None:
+        raise ImportError(
+            "Async clients require the optional 'async' dependencies")
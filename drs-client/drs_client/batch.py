@@ -0,0 +1,147 @@
+"""Upload and register many files concurrently."""
+
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+import glob
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+
+_GLOB_CHARS = re.compile(r"[*?[]")
+
+
+@dataclass
+class BatchItem:
+    """A file to upload, with an optional description."""
+    filename: str
+    description: str = ""
+    name: str = None  # Object name; defaults to the base name of the file
+
+    @property
+    def object_name(self):
+        """Name of the object the file is uploaded to."""
+        return self.name or os.path.basename(self.filename)
+
+
+@dataclass
+class BatchResult:
+    """Outcome of uploading a single file of a batch."""
+    filename: str
+    drs_id: str = None  # Set if the upload succeeded
+    error: str = None  # Set if the upload failed
+
+
+def collect_inputs(paths=(), manifest=None):
+    """Expand paths, glob patterns and a manifest into a list of files.
+
+    Directories are searched recursively; their files are named after
+    their path in the directory, e.g. 'lane2/b.fastq', and other files
+    after their base name. The manifest lists one file per line,
+    optionally followed by a tab and a description; blank lines and lines
+    starting with '#' are ignored. Files are listed once, in the order in
+    which they are first found.
+
+    Args:
+        paths (iterable of str): Files, directories or glob patterns.
+        manifest (str, optional): Path of a manifest file.
+
+    Returns:
+        items (list of BatchItem)
+
+    Raises:
+        ValueError: if several files would be uploaded to the same object.
+
+    """
+    items = {}
+
+    def add(filename, description="", name=None):
+        filename = os.path.normpath(filename)
+        items.setdefault(filename, BatchItem(filename, description, name))
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for fname in sorted(files):
+                    filename = os.path.join(root, fname)
+                    name = os.path.relpath(filename, path)
+                    add(filename, name=name.replace(os.sep, "/"))
+        elif _GLOB_CHARS.search(path):
+            for fname in sorted(glob.glob(path, recursive=True)):
+                if os.path.isfile(fname):
+                    add(fname)
+        else:
+            add(path)
+
+    if manifest is not None:
+        with open(manifest, "rt", encoding="utf-8") as fp:
+            for line in fp:
+                line = line.rstrip("\n")
+                if not line.strip() or line.startswith("#"):
+                    continue
+                filename, _, description = line.partition("\t")
+                add(filename, description)
+
+    files_by_name = {}
+    for item in items.values():
+        files_by_name.setdefault(item.object_name, []).append(item.filename)
+    duplicates = [files for files in files_by_name.values() if len(files) > 1]
+    if duplicates:
+        raise ValueError("Files would be uploaded to the same object: " +
+                         "; ".join(", ".join(files) for files in duplicates))
+    return list(items.values())
+
+
+def upload_many(uploader, items, workers=DEFAULT_WORKERS, progress=None):
+    """Upload files concurrently through a shared uploader.
+
+    Failures are reported per file and do not stop the batch.
+
+    Args:
+        uploader (Uploader): Uploader shared by all workers.
+        items (iterable of BatchItem): The files to upload.
+        workers (int): Number of files uploaded at the same time.
+        progress (callable, optional): Called with the number of bytes read
+            for upload, by all workers; see `upload_and_register`.
+
+    Yields:
+        result (BatchResult): One per file, as uploads complete.
+
+    """
+    def upload(item):
+        try:
+            drs_id = uploader.upload(item.filename, desc=item.description,
+                                     name=item.object_name,
+                                     progress=progress)
+        except Exception as e:
+            logger.error("Upload of %s failed: %s", item.filename, e)
+            return BatchResult(item.filename, error=str(e) or repr(e))
+        return BatchResult(item.filename, drs_id=drs_id)
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(upload, item) for item in items]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def write_result(result, fp, fmt="tsv"):
+    """Write one line describing a batch result.
+
+    Args:
+        result (BatchResult): The result to write.
+        fp: Text file handle to write to.
+        fmt (str): Either "tsv" (file, DRS ID, error) or "jsonl".
+
+    """
+    if fmt == "jsonl":
+        fp.write(json.dumps(asdict(result)) + "\n")
+    else:
+        error = " ".join((result.error or "").split())
+        fp.write("\t".join(
+            [result.filename, result.drs_id or "", error]) + "\n")
+    fp.flush()
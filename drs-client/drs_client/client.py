@@ -1,14 +1,26 @@
 """Easy (unified) access to the upload/download client.
 """
+from base64 import b64encode
+import contextlib
 import os
+import sys
+import time
 
 import click
-import yaml
 
-from .download import download_file
-from .upload import upload_and_register
+from .batch import collect_inputs, DEFAULT_WORKERS, upload_many, write_result
+from .index import DEFAULT_INDEX_PATH, ObjectIndex
+from .journal import DEFAULT_JOURNAL_DIR, iter_journals
+from .progress import JSONLinesDisplay, ProgressTracker, TerminalDisplay
+from .store import BucketStore, TransferSettings
+from .telemetry import default_recorder
+from .throttle import default_limiter, RateLimits
 from .utils import configure_logging
 
+# The DRS and storage clients (requests, boto3), crypt4gh and yaml take long
+# to import: commands import them when run, so that the others and --help
+# start quickly. benchmarks/test_startup.py measures this.
+
 DEFAULT_CONFIG_FILE = "drs-client.yaml"
 
 
@@ -20,6 +32,8 @@ class ConfigManager:
 
     @classmethod
     def from_file(cls, fname):
+        import yaml
+
         try:
             with open(fname, "rt", encoding="utf-8") as fp:
                 data = yaml.safe_load(fp) or {}
@@ -28,9 +42,14 @@ class ConfigManager:
         return cls(data, fname)
 
     def write_to_file(self):
+        import yaml
+
         with open(self.fname, "wt", encoding="utf-8") as fp:
             yaml.dump(self.data, fp)
 
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
     def __getitem__(self, key):
         return self.data[key]
 
@@ -59,18 +78,101 @@ def _promptable_default_option(option, name, **kwds):
     return click.option(option, cls=_OptionDefaultFromConfig, **kwds)
 
 
+def _transfer_settings(cfg):
+    try:
+        return TransferSettings.from_dict(cfg.get("transfer") or {})
+    except (TypeError, ValueError) as e:
+        raise click.ClickException(f"Invalid configuration: {e}")
+
+
+def _rate_limits(cfg):
+    try:
+        return RateLimits.from_dict(cfg.get("limits") or {})
+    except (TypeError, ValueError) as e:
+        raise click.ClickException(f"Invalid configuration: {e}")
+
+
+def _journal_dir(cfg):
+    return cfg.get("journal_dir") or DEFAULT_JOURNAL_DIR
+
+
+def _object_index(cfg, dedup, use_index):
+    """Open the local object index if enabled, or needed for dedup."""
+    if dedup is None:
+        dedup = cfg.get("dedup", False)
+    if use_index is None:
+        use_index = cfg.get("index", False)
+    if not (dedup or use_index):
+        return False, None
+    return dedup, ObjectIndex(cfg.get("index_path") or DEFAULT_INDEX_PATH)
+
+
+_progress_option = click.option(
+    "--progress", "progress_mode",
+    type=click.Choice(["auto", "bar", "json", "none"]), default="auto",
+    show_default=True,
+    help="How to report progress on standard error: as a line updated in "
+         "place (bar), as JSON objects, one per line (json), or not at all; "
+         "auto shows a line on terminals only")
+
+
+@contextlib.contextmanager
+def _progress(mode, total=None):
+    """Track the progress of a command, reported according to mode."""
+    if mode == "auto":
+        mode = "bar" if sys.stderr.isatty() else "none"
+    if mode == "none":
+        yield None
+        return
+    tracker = ProgressTracker(total)
+    tracker.subscribe(
+        TerminalDisplay() if mode == "bar" else JSONLinesDisplay())
+    try:
+        yield tracker
+    finally:
+        tracker.close()
+
+
+def _file_size(fname):
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return 0  # Reported as a failed upload
+
+
 def _parse_pk_file(fname):
-    with open(fname, "rt", encoding="utf-8") as fp:
-        return fp.readlines()[1].strip()
+    """Return a public key file's key, base64-encoded."""
+    from crypt4gh_common import key_registry
+
+    try:
+        return b64encode(key_registry.pubkey(fname)).decode("ascii")
+    except Exception:
+        raise click.ClickException(f"Could not load public key from {fname}")
 
 
 @click.option("-c", "--config", default=DEFAULT_CONFIG_FILE,
               help="Location of the configuration file")
+@click.option("--stats", is_flag=True, default=False,
+              help="Print the time spent in each transfer stage when done")
+@click.option("--metrics-file", type=click.Path(dir_okay=False),
+              help="Write transfer metrics to this file when done, in the "
+                   "OpenMetrics (Prometheus) text format")
 @click.group()
 @click.pass_context
-def cli(ctx, config):
+def cli(ctx, config, stats, metrics_file):
     configure_logging()
     ctx.obj = ConfigManager.from_file(config)
+    default_limiter.configure(_rate_limits(ctx.obj))
+    if stats or metrics_file:
+        ctx.call_on_close(lambda: _report_telemetry(stats, metrics_file))
+
+
+def _report_telemetry(stats, metrics_file):
+    if stats:
+        click.echo(default_recorder.format_table(), err=True)
+    if metrics_file:
+        with open(metrics_file, "wt", encoding="utf-8") as fp:
+            fp.write(default_recorder.openmetrics())
 
 
 # Decorators must appear in *reverse* order of how we want the prompts to
@@ -100,53 +202,250 @@ def configure(ctx, drs_url, storage_url, bucket, access_key, secret_key):
     click.echo(f"Configuration options written to {cfg.fname}")
 
 
-@click.argument("filename", type=click.Path(exists=True))
+@click.argument("filename",
+                type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option("--name",
+              help="Name of the object (default: that of the file); "
+                   "required when uploading standard input, given as '-'")
 @click.option("--client-sk",
               help="Secret key of the client")
 @click.option("--encrypt/--no-encrypt", help="Whether to encrypt payload",
               default=True, is_flag=True, show_default=True)
+@click.option("--resume/--no-resume",
+              help="Whether to resume an interrupted upload of the file",
+              default=True, is_flag=True, show_default=True)
+@click.option("--dedup/--no-dedup", default=None,
+              help="Whether to skip files whose content was uploaded "
+                   "before (default: dedup from the configuration, or off)")
+@click.option("--index/--no-index", "use_index", default=None,
+              help="Whether to skip files that did not change since they "
+                   "were uploaded (default: index from the configuration, "
+                   "or off)")
+@_progress_option
 @click.command()
 @click.pass_context
-def upload(ctx, filename, client_sk, encrypt):
-    """Upload a file to the server."""
+def upload(ctx, filename, name, client_sk, encrypt, resume, dedup,
+           use_index, progress_mode):
+    """Upload a file, or standard input, to the server."""
+    from .upload import upload_and_register
 
     if encrypt and client_sk is None:
         raise click.ClickException(
             "When uploading in encrypted mode, provide a client secret key"
         )
+    total = None
+    if filename == "-":
+        if not name:
+            raise click.UsageError("Uploading standard input requires --name")
+        filename = click.get_binary_stream("stdin")
+    else:
+        total = os.path.getsize(filename)
 
     cfg = ctx.obj
     os.environ.update({
         "ACCESS_KEY": cfg["access_key"],
         "SECRET_KEY": cfg["secret_key"],
     })
-    drs_id = upload_and_register(
-        filename,
+    dedup, index = _object_index(cfg, dedup, use_index)
+    with _progress(progress_mode, total) as progress:
+        drs_id = upload_and_register(
+            filename,
+            cfg["drs_url"],
+            cfg["storage_url"],
+            cfg["bucket"],
+            encrypt=encrypt,
+            client_sk=client_sk,
+            transfer=_transfer_settings(cfg),
+            journal_dir=_journal_dir(cfg) if resume else None,
+            dedup=dedup,
+            index=index,
+            name=name,
+            progress=progress,
+        )
+    click.echo(drs_id)
+
+
+@click.argument("paths", nargs=-1)
+@click.option("--manifest", type=click.Path(exists=True, dir_okay=False),
+              help="File listing files to upload, one per line, each "
+                   "optionally followed by a tab and a description")
+@click.option("--client-sk",
+              help="Secret key of the client")
+@click.option("--encrypt/--no-encrypt", help="Whether to encrypt payload",
+              default=True, is_flag=True, show_default=True)
+@click.option("--resume/--no-resume",
+              help="Whether to resume interrupted uploads of the files",
+              default=True, is_flag=True, show_default=True)
+@click.option("--dedup/--no-dedup", default=None,
+              help="Whether to skip files whose content was uploaded "
+                   "before (default: dedup from the configuration, or off)")
+@click.option("--index/--no-index", "use_index", default=None,
+              help="Whether to skip files that did not change since they "
+                   "were uploaded (default: index from the configuration, "
+                   "or off)")
+@click.option("--workers", type=click.IntRange(min=1),
+              help="Number of files to upload at the same time (default: "
+                   f"batch_workers from the configuration, or "
+                   f"{DEFAULT_WORKERS})")
+@click.option("-o", "--output", type=click.File("wt"), default="-",
+              help="Where to write the file to DRS ID mapping")
+@click.option("--format", "fmt", type=click.Choice(["tsv", "jsonl"]),
+              default="tsv", show_default=True,
+              help="Format of the file to DRS ID mapping")
+@_progress_option
+@click.command("upload-batch")
+@click.pass_context
+def upload_batch(ctx, paths, manifest, client_sk, encrypt, resume, dedup,
+                 use_index, workers, output, fmt, progress_mode):
+    """Upload many files, given as paths, directories or glob patterns."""
+    from .upload import Uploader
+
+    if encrypt and client_sk is None:
+        raise click.ClickException(
+            "When uploading in encrypted mode, provide a client secret key"
+        )
+
+    try:
+        items = collect_inputs(paths, manifest)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if not items:
+        raise click.ClickException("No files to upload")
+
+    cfg = ctx.obj
+    os.environ.update({
+        "ACCESS_KEY": cfg["access_key"],
+        "SECRET_KEY": cfg["secret_key"],
+    })
+    workers = workers or cfg.get("batch_workers") or DEFAULT_WORKERS
+    transfer = _transfer_settings(cfg)
+    dedup, index = _object_index(cfg, dedup, use_index)
+    uploader = Uploader(
         cfg["drs_url"],
         cfg["storage_url"],
         cfg["bucket"],
         encrypt=encrypt,
         client_sk=client_sk,
+        transfer=transfer,
+        journal_dir=_journal_dir(cfg) if resume else None,
+        max_connections=workers * transfer.max_concurrency,
+        dedup=dedup,
+        index=index,
     )
-    click.echo(drs_id)
+
+    failed = 0
+    total = sum(_file_size(item.filename) for item in items)
+    with _progress(progress_mode, total) as progress:
+        results = upload_many(
+            uploader, items, workers=workers, progress=progress)
+        for result in results:
+            write_result(result, output, fmt)
+            failed += result.error is not None
+    if failed:
+        raise click.ClickException(
+            f"{failed} of {len(items)} uploads failed")
+
+
+@click.option("--older-than", type=float, default=0, show_default=True,
+              help="Only abort uploads started at least this many hours ago")
+@click.command("abort-uploads")
+@click.pass_context
+def abort_uploads(ctx, older_than):
+    """Abort interrupted uploads, discarding their stored parts."""
+    cfg = ctx.obj
+    os.environ.update({
+        "ACCESS_KEY": cfg["access_key"],
+        "SECRET_KEY": cfg["secret_key"],
+    })
+    cutoff = time.time() - older_than * 3600
+    for journal in iter_journals(_journal_dir(cfg)):
+        if journal.started > cutoff:
+            continue
+        if journal.upload_id:
+            store = BucketStore(journal.bucket, endpoint=cfg["storage_url"])
+            store.abort_upload(journal.name, journal.upload_id)
+        journal.delete()
+        click.echo(f"Aborted upload of {journal.name}")
 
 
 @click.argument("drs-id")
 @click.option("--recipient-pk",
-              help="Public key of the third-party recipient",
-              required=True)
+              help="Public key of a third-party recipient. If set, the "
+                   "server re-encrypts the object for the recipient, and "
+                   "the download goes through the external 'drs' tool.")
+@click.option("--sk",
+              help="Secret key to decrypt the object with while it is "
+                   "downloaded. Only the decrypted data is written.")
+@click.option("-o", "--output-dir",
+              help="Where to place the file (default: a directory named "
+                   "after the DRS ID)")
+@click.option("--stdout", "to_stdout", is_flag=True, default=False,
+              help="Write the decrypted data to standard output "
+                   "(requires --sk)")
+@click.option("--verify/--no-verify", default=False, show_default=True,
+              help="Whether to check the checksum of the downloaded file")
+@_progress_option
 @click.command()
 @click.pass_context
-def download(ctx, drs_id, recipient_pk):
+def download(ctx, drs_id, recipient_pk, sk, output_dir, to_stdout, verify,
+             progress_mode):
     """Get a file from the server."""
+    from crypt4gh_common import EncryptionError, key_registry
 
-    pkdata = _parse_pk_file(recipient_pk)
-    os.environ["CRYPT4GH_PUBKEY"] = pkdata
+    from .download import (
+        download_decrypted, download_file, download_object, DownloadError)
 
     cfg = ctx.obj
-    download_file(cfg["drs_url"], drs_id)
+    if recipient_pk is not None:
+        pkdata = _parse_pk_file(recipient_pk)
+        os.environ["CRYPT4GH_PUBKEY"] = pkdata
+        download_file(cfg["drs_url"], drs_id)
+        return
+    if to_stdout and sk is None:
+        raise click.UsageError("--stdout requires --sk")
+
+    os.environ.update({
+        "ACCESS_KEY": cfg["access_key"],
+        "SECRET_KEY": cfg["secret_key"],
+    })
+    seckey = None
+    if sk is not None:
+        try:
+            seckey = key_registry.seckey(sk)
+        except Exception:
+            raise click.ClickException(f"Could not load secret key from {sk}")
+
+    try:
+        with _progress(progress_mode) as progress:
+            if to_stdout:
+                download_decrypted(
+                    drs_id,
+                    cfg["drs_url"],
+                    cfg["storage_url"],
+                    seckey,
+                    sys.stdout.buffer,
+                    transfer=_transfer_settings(cfg),
+                    verify=verify,
+                    progress=progress,
+                )
+                return
+            path = download_object(
+                drs_id,
+                cfg["drs_url"],
+                cfg["storage_url"],
+                dest_dir=output_dir,
+                transfer=_transfer_settings(cfg),
+                verify=verify,
+                seckey=seckey,
+                progress=progress,
+            )
+    except (DownloadError, EncryptionError) as e:
+        raise click.ClickException(str(e) or "Could not decrypt object")
+    click.echo(path)
 
 
 cli.add_command(configure)
 cli.add_command(upload)
+cli.add_command(upload_batch)
+cli.add_command(abort_uploads)
 cli.add_command(download)
@@ -0,0 +1,162 @@
+"""Adaptive limits on the number of requests in flight.
+
+A fixed number of parallel requests is either too timid on fast links, or
+overloads busy servers. An `AdaptiveConcurrency` finds out how many requests
+a server takes, AIMD-style as TCP does: its limit grows by one request per
+round of requests completing at a stable latency, and is cut by a constant
+factor when the server throttles requests or latency rises.
+"""
+import logging
+import threading
+import time
+
+from .telemetry import default_recorder
+
+logger = logging.getLogger(__name__)
+
+# Smoothed latency, relative to the lowest seen, taken as congestion.
+DEFAULT_TOLERANCE = 2.0
+# Factor applied to the limit on congestion.
+DEFAULT_BACKOFF = 0.5
+
+# Weight of the latest latency in the smoothed latency.
+_SMOOTHING = 0.2
+# Growth of the baseline latency per request, so that it follows lasting
+# changes, e.g. of the network path.
+_DRIFT = 1.01
+
+
+class AdaptiveConcurrency:
+    """Limit the requests in flight, adapting the limit to the server.
+
+    Every request holds a slot while it runs; threads wait for a free slot
+    while the limit is reached. The controller may be shared by any number
+    of threads and transfers.
+
+    """
+
+    def __init__(self, max_limit, initial=None, min_limit=1, stage=None,
+                 is_throttling=None, tolerance=DEFAULT_TOLERANCE,
+                 backoff=DEFAULT_BACKOFF, recorder=None,
+                 clock=time.monotonic):
+        """Create a new controller.
+
+        Args:
+            max_limit (int): Upper bound of the limit.
+            initial (int, optional): Limit to start from. Defaults to a
+                quarter of `max_limit`.
+            min_limit (int): Lower bound of the limit.
+            stage (str, optional): Telemetry stage to report the limit of.
+            is_throttling (callable, optional): Returns whether an exception
+                raised by a request means that the server throttled it.
+            tolerance (float): Smoothed latency, relative to the lowest
+                seen, above which the server is taken to be congested.
+            backoff (float): Factor applied to the limit on congestion.
+            recorder (Recorder, optional): Where to report the limit.
+                Defaults to the default recorder.
+            clock (callable): Returns the current time, in seconds.
+
+        """
+        self.max_limit = max(max_limit, min_limit)
+        self.min_limit = min_limit
+        self._limit = float(min(self.max_limit,
+                                initial or max(min_limit, max_limit // 4)))
+        self._stage = stage
+        self._is_throttling = is_throttling or (lambda exc: False)
+        self._tolerance = tolerance
+        self._backoff = backoff
+        self._recorder = recorder or default_recorder
+        self._clock = clock
+        self._inflight = 0
+        self._smoothed = None  # Moving average of latencies
+        self._baseline = None  # Lowest smoothed latency, drifting upwards
+        self._last_backoff = float("-inf")
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        """Current number of requests allowed in flight."""
+        return int(self._limit)
+
+    def slot(self):
+        """Hold a slot for a request, as a context manager.
+
+        Requests that raise an exception for which `is_throttling` is true
+        count as throttled. Requests may also be flagged as throttled by
+        setting the `throttled` attribute of the object returned on entering
+        the context, e.g. when they succeeded after retries.
+
+        """
+        return _Slot(self)
+
+    def acquire(self):
+        """Wait for a free slot, and return the time it was taken."""
+        with self._cond:
+            while self._inflight >= int(self._limit):
+                self._cond.wait()
+            self._inflight += 1
+            return self._clock()
+
+    def release(self, started, throttled=False, failed=False):
+        """Free a slot taken at `started`, adapting the limit.
+
+        Args:
+            started (float): As returned by `acquire`.
+            throttled (bool): Whether the server throttled the request.
+            failed (bool): Whether the request failed otherwise; it then
+                does not change the limit.
+
+        """
+        now = self._clock()
+        backoff = False
+        with self._cond:
+            self._inflight -= 1
+            if not failed:
+                if throttled or self._congested(now - started):
+                    # Requests that started before the last backoff saw
+                    # the same congestion: back off once per round.
+                    if started > self._last_backoff:
+                        self._limit = max(self.min_limit,
+                                          self._limit * self._backoff)
+                        self._last_backoff = now
+                        backoff = True
+                else:
+                    self._limit = min(self.max_limit,
+                                      self._limit + 1 / self._limit)
+            limit = int(self._limit)
+            self._cond.notify_all()
+        if backoff:
+            logger.debug("Backing off to %d requests in flight (%s)",
+                         limit, "throttled" if throttled else "latency")
+        if self._stage is not None:
+            self._recorder.concurrency(self._stage, limit, backoff)
+
+    def _congested(self, latency):
+        if self._smoothed is None:
+            self._smoothed = self._baseline = latency
+            return False
+        self._smoothed += _SMOOTHING * (latency - self._smoothed)
+        self._baseline = min(self._smoothed, self._baseline * _DRIFT)
+        return self._smoothed > self._baseline * self._tolerance
+
+
+class _Slot:
+    """Context manager holding a slot of a controller."""
+
+    __slots__ = ("_controller", "_started", "throttled")
+
+    def __init__(self, controller):
+        self._controller = controller
+        self.throttled = False
+
+    def __enter__(self):
+        self._started = self._controller.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        throttled = self.throttled or (
+            exc_value is not None
+            and self._controller._is_throttling(exc_value))
+        self._controller.release(
+            self._started, throttled=throttled,
+            failed=exc_type is not None and not throttled)
@@ -1,13 +1,296 @@
+"""Download of file data from storage, resolved through DRS."""
+
+from io import BytesIO
+import logging
+import os
 import subprocess
+from urllib.parse import urlparse
+
+from .drs import DRSClient
+from .files import compute_sha256, DigestEngine
+from .store import BucketStore, TransferSettings
+
+from crypt4gh_common import (
+    CIPHER_SEGMENT_SIZE, Decryptor, header_length, plaintext_size,
+    SEGMENT_SIZE)
+
+logger = logging.getLogger(__name__)
+
+# Amount of data fetched to find the crypt4gh header; grown if too short.
+_HEADER_READ_SIZE = 64 * 1024
+
+
+class DownloadError(Exception):
+    """Raised if a DRS object cannot be downloaded."""
 
 
 def download_file(drs_url, drs_id):
     """Download file data and metadata from DRS server.
 
     Currently, just calls through to our modified version of the GA4GH
-    client.
+    client. This is used when the object is to be re-encrypted by the
+    server for a third-party recipient; see `download_object` otherwise.
     """
     command = [
         "drs", "get", "-d", drs_url, drs_id
     ]
     subprocess.run(command, check=True)
+
+
+def download_object(drs_id, drs_url, storage_url, dest_dir=None,
+                    transfer=None, verify=False, seckey=None, progress=None):
+    """Download the data of a DRS object, in process.
+
+    The object is resolved through the DRS server, and its data fetched
+    from its S3 access method with parallel ranged GETs.
+
+    Args:
+        drs_id (str) : the DRS ID of the object to download.
+        drs_url (str) : the URL of the DRS server.
+        storage_url (str) : the URL of the file storage.
+        dest_dir (str) : where to place the file. Defaults to a directory
+            named after the DRS ID.
+        transfer (TransferSettings) : optional multipart transfer settings.
+        verify (bool) : whether to check the SHA-256 checksum of the file
+            against the DRS metadata, which takes another pass over it.
+        seckey (bytes) : optional crypt4gh secret key. If set, the object
+            is decrypted on the fly and only the plaintext is saved, under
+            the object name without its ".crypt4gh" extension.
+        progress (callable) : optionally called with the number of bytes
+            written, as the download proceeds; these are plaintext bytes
+            when decrypting.
+
+    Returns:
+        path (str) : the path of the downloaded file.
+
+    """
+    drs_object = DRSClient(drs_url).get_object(drs_id)
+    bucket, key = _resolve_s3_location(drs_object)
+    store = BucketStore(bucket, endpoint=storage_url, transfer=transfer)
+
+    dest_dir = dest_dir or drs_id
+    os.makedirs(dest_dir, exist_ok=True)
+    name = os.path.basename(drs_object.get("name") or key)
+    if seckey is not None:
+        path = os.path.join(dest_dir, decrypted_name(name))
+        logger.info("Decrypting %s from bucket %s to %s", key, bucket, path)
+        try:
+            with open(path, "wb") as fp:
+                _download_decrypted(store, key, drs_object, seckey, fp,
+                                    transfer, verify, progress)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path
+
+    path = os.path.join(dest_dir, name)
+    logger.info("Downloading %s from bucket %s to %s", key, bucket, path)
+    store.download_file(key, path, progress=progress)
+
+    expected_size = drs_object.get("size")
+    actual_size = os.path.getsize(path)
+    if expected_size is not None and actual_size != expected_size:
+        raise DownloadError(
+            f"Downloaded {actual_size} bytes of {drs_id}, "
+            f"expected {expected_size}")
+
+    if verify:
+        _verify_checksum(drs_object, path)
+    return path
+
+
+def download_decrypted(drs_id, drs_url, storage_url, seckey, output_fp,
+                       transfer=None, verify=False, progress=None):
+    """Download a crypt4gh-encrypted DRS object, decrypting it on the fly.
+
+    Only plaintext is written. Parts of the object are fetched and decrypted
+    in parallel, but written in order, so the output may be a pipe.
+
+    Args:
+        drs_id (str) : the DRS ID of the object to download.
+        drs_url (str) : the URL of the DRS server.
+        storage_url (str) : the URL of the file storage.
+        seckey (bytes) : the crypt4gh secret key to decrypt with.
+        output_fp : binary file handle to write the plaintext to.
+        transfer (TransferSettings) : optional multipart transfer settings.
+        verify (bool) : whether to check the SHA-256 checksum of the
+            encrypted object against the DRS metadata, as it streams by.
+            A mismatch is only reported once all data has been written.
+        progress (callable) : optionally called with the number of plaintext
+            bytes written, as the download proceeds.
+
+    Returns:
+        size (int) : the number of plaintext bytes written.
+
+    """
+    drs_object = DRSClient(drs_url).get_object(drs_id)
+    bucket, key = _resolve_s3_location(drs_object)
+    store = BucketStore(bucket, endpoint=storage_url, transfer=transfer)
+    return _download_decrypted(
+        store, key, drs_object, seckey, output_fp, transfer, verify, progress)
+
+
+def read_range(drs_id, drs_url, storage_url, seckey, offset, length,
+               transfer=None):
+    """Read part of the plaintext of a crypt4gh-encrypted DRS object.
+
+    Only the segments holding the requested bytes are fetched. To read
+    several ranges of the same object, use an `EncryptedObjectReader`,
+    which resolves the object and decrypts its header once.
+
+    Args:
+        drs_id (str) : the DRS ID of the object to read.
+        drs_url (str) : the URL of the DRS server.
+        storage_url (str) : the URL of the file storage.
+        seckey (bytes) : the crypt4gh secret key to decrypt with.
+        offset (int) : position of the first byte to read, in the plaintext.
+        length (int) : number of bytes to read.
+        transfer (TransferSettings) : optional multipart transfer settings.
+
+    Returns:
+        data (bytes) : the plaintext; shorter than `length` if the range
+            extends past the end of the object.
+
+    """
+    reader = EncryptedObjectReader.open(
+        drs_id, drs_url, storage_url, seckey, transfer=transfer)
+    return reader.read(offset, length)
+
+
+class EncryptedObjectReader:
+    """Random access to the plaintext of a crypt4gh object in storage.
+
+    Crypt4gh segments are encrypted independently, so a plaintext range
+    maps to a range of whole encrypted segments following the header. Only
+    those are fetched, and large ranges are fetched in parallel parts.
+    Reads may be issued concurrently from several threads.
+
+    """
+
+    def __init__(self, store, key, seckey, transfer=None):
+        """Fetch and decrypt the header of a stored object.
+
+        Args:
+            store (BucketStore) : the store holding the object.
+            key (str) : the name of the object in the store.
+            seckey (bytes) : the crypt4gh secret key to decrypt with.
+            transfer (TransferSettings) : settings the store was created
+                with; its part size sets the size of parallel reads.
+
+        """
+        self._store = store
+        self._key = key
+        self._encrypted_size = store.object_size(key)
+        self.header = _fetch_header(store, key, self._encrypted_size)
+        self._decryptor = Decryptor(seckey)
+        self._decryptor.read_header(BytesIO(self.header))
+        self.size = plaintext_size(self._encrypted_size - len(self.header))
+
+        # Parts hold whole segments, so that each decrypts on its own.
+        self._part_size = CIPHER_SEGMENT_SIZE * max(
+            1, (transfer or TransferSettings()).part_size
+            // CIPHER_SEGMENT_SIZE)
+
+    @classmethod
+    def open(cls, drs_id, drs_url, storage_url, seckey, transfer=None):
+        """Create a reader for a DRS object, resolved through DRS."""
+        drs_object = DRSClient(drs_url).get_object(drs_id)
+        bucket, key = _resolve_s3_location(drs_object)
+        store = BucketStore(bucket, endpoint=storage_url, transfer=transfer)
+        return cls(store, key, seckey, transfer=transfer)
+
+    def read(self, offset, length):
+        """Read `length` bytes of plaintext, starting at `offset`."""
+        if offset < 0 or length < 0:
+            raise ValueError("Offset and length must not be negative")
+        end = min(offset + length, self.size)
+        if end <= offset:
+            return b""
+
+        first = offset // SEGMENT_SIZE
+        last = (end - 1) // SEGMENT_SIZE
+        plaintext = b"".join(
+            plaintext for _, plaintext in self._iter_segments(first, last + 1))
+        start = offset - first * SEGMENT_SIZE
+        return plaintext[start:start + end - offset]
+
+    def iter_parts(self):
+        """Yield (encrypted data, plaintext) of all parts, in order."""
+        return self._iter_segments(0, None)
+
+    def _iter_segments(self, first, last):
+        """Fetch and decrypt segments [first, last), or up to the end."""
+        start = len(self.header) + first * CIPHER_SEGMENT_SIZE
+        end = self._encrypted_size if last is None else min(
+            len(self.header) + last * CIPHER_SEGMENT_SIZE,
+            self._encrypted_size)
+        ranges = [(part, min(part + self._part_size, end))
+                  for part in range(start, end, self._part_size)]
+        return self._store.iter_ranges(
+            self._key, ranges,
+            lambda data: (data, self._decryptor.decrypt_segments(data)))
+
+
+def decrypted_name(name):
+    """Name of the decrypted version of an encrypted object."""
+    root, ext = os.path.splitext(name)
+    return root if ext == ".crypt4gh" else name + ".decrypted"
+
+
+def _download_decrypted(store, key, drs_object, seckey, output_fp,
+                        transfer, verify, progress=None):
+    reader = EncryptedObjectReader(store, key, seckey, transfer=transfer)
+    digests = DigestEngine()
+    digests.update(reader.header)
+    written = 0
+    for data, plaintext in reader.iter_parts():
+        if verify:
+            digests.update(data)
+        output_fp.write(plaintext)
+        written += len(plaintext)
+        if progress is not None:
+            progress(len(plaintext))
+    output_fp.flush()
+
+    if verify:
+        _check_checksum(drs_object, digests.result().digests["sha-256"])
+    return written
+
+
+def _fetch_header(store, key, size):
+    """Fetch the crypt4gh header at the start of a stored object."""
+    read_size = _HEADER_READ_SIZE
+    while True:
+        data = store.read_range(key, 0, min(read_size, size))
+        length = header_length(data)
+        if length is not None:
+            return data[:length]
+        if read_size >= size:
+            raise DownloadError(f"Object {key} has a truncated header")
+        read_size *= 4
+
+
+def _verify_checksum(drs_object, path):
+    _check_checksum(drs_object, compute_sha256(path))
+
+
+def _check_checksum(drs_object, actual):
+    expected = {c.get("type"): c.get("checksum")
+                for c in drs_object.get("checksums", [])}.get("sha-256")
+    if expected is None:
+        raise DownloadError(
+            f"Object {drs_object.get('id')} has no SHA-256 checksum")
+    if actual != expected:
+        raise DownloadError(
+            f"Checksum mismatch for object {drs_object.get('id')}")
+
+
+def _resolve_s3_location(drs_object):
+    """Return the bucket and key of the first S3 access method."""
+    for access_method in drs_object.get("access_methods", []):
+        url = (access_method.get("access_url") or {}).get("url", "")
+        parsed_url = urlparse(url)
+        if access_method.get("type") == "s3" and parsed_url.scheme == "s3":
+            return parsed_url.netloc, parsed_url.path.lstrip("/")
+    raise DownloadError(
+        f"Object {drs_object.get('id')} has no S3 access method")
@@ -1,18 +1,36 @@
 """ DRS metadata request handling.
 """
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from dataclasses import dataclass, field
 import datetime
 import json
 import logging
 import os
-from urllib.parse import urljoin
+from urllib.parse import quote, urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from .files import compute_sha256, compute_size
+from .concurrency import AdaptiveConcurrency
+from .files import compute_digests
+from .telemetry import default_recorder, DRS_GET, DRS_REGISTER
+from .throttle import default_limiter
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (10.0, 60.0)  # Connect and read timeouts, in seconds
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5  # Initial delay between attempts, in seconds
+
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Statuses of requests the server turned down, being busy.
+_THROTTLING_STATUSES = (429, 503)
+# Registration is not idempotent: only retry when the server turned it down.
+_POST_RETRY_STATUSES = _THROTTLING_STATUSES
+
 
 @dataclass
 class DRSMetadata:
@@ -27,11 +45,15 @@ class DRSMetadata:
     size: int  # Size, in bytes
     url: str = ""  # URL to retrieve bytes
     description: str = ""  # Optional description
+    checksums: dict = field(default_factory=dict)  # Extra checksums, by type
 
     @classmethod
-    def from_file(cls, fpath, url="", description=""):
+    def from_file(cls, fpath, url="", description="",
+                  checksum_types=("sha-256",)):
         """ Initialize a DRSMetadata object from a file.
 
+        All requested checksums are computed in a single pass over the file.
+
         Parameters
         ----------
         fpath : str
@@ -40,17 +62,34 @@ class DRSMetadata:
             URL with file byte data.
         description : str, optional
             An optional free-form description.
+        checksum_types : sequence of str, optional
+            Checksum types to compute, in addition to SHA-256.
 
         """
+        checksum_types = ("sha-256",) + tuple(
+            t for t in checksum_types if t != "sha-256")
+        result = compute_digests(fpath, checksum_types)
+        logger.debug("Computed checksums for %s at %.1f MB/s",
+                     fpath, result.throughput / 1e6)
+
+        checksums = dict(result.digests)
         return cls(
             name=os.path.basename(fpath),
-            checksum=compute_sha256(fpath),
-            size=compute_size(fpath),
+            checksum=checksums.pop("sha-256"),
+            size=result.size,
             url=url,
             description=description,
+            checksums=checksums,
         )
 
 
+@dataclass
+class RegistrationResult:
+    """ Outcome of registering a single object. """
+    drs_id: str = None  # Set if the registration succeeded
+    error: Exception = None  # Set if it failed
+
+
 class DRSClient:
     """ Thin client for DRS-filer object uploading.
 
@@ -60,8 +99,40 @@ class DRSClient:
 
     """
 
-    def __init__(self, drs_url):
+    def __init__(self, drs_url, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, adaptive=False):
+        """ Create a new client, with its own pool of connections.
+
+        Parameters
+        ----------
+        drs_url : str
+            The URL of the DRS server.
+        pool_size : int
+            Number of connections kept alive; should be at least the
+            number of threads using the client.
+        timeout : float or (float, float)
+            Connect and read timeouts of every request, in seconds.
+        retries : int
+            Number of retries of requests that failed to connect, or were
+            answered with 429 or 5xx. Delays grow exponentially from
+            `backoff` seconds, unless the server sends Retry-After.
+        adaptive : bool
+            Whether to adapt the number of registrations in flight (up to
+            `pool_size`) to the server, backing off when it turns them
+            down or slows down.
+
+        """
         self._drs_url = drs_url
+        self._service_info = None  # (ETag, service info) of last response
+        self._timeout = timeout
+        self._session = _create_session(pool_size, retries, backoff)
+        self._concurrency = AdaptiveConcurrency(
+            pool_size, stage=DRS_REGISTER) if adaptive else None
+
+    @property
+    def url(self):
+        return self._drs_url
 
     def post_metadata(self, drs_metadata):
         """ Upload a single metadata object.
@@ -78,31 +149,158 @@ class DRSClient:
         logger.info("Uploading metadata %s to %s",
                     drs_metadata, objects_endpoint)
 
-        response = requests.post(
-            objects_endpoint,
-            headers={"Content-Type": "application/json"},
-            data=json.dumps(request_data))
-
-        response.raise_for_status()
+        default_limiter.throttle_request()
+        with default_recorder.stage(DRS_REGISTER), self._slot() as slot:
+            response = self._session.post(
+                objects_endpoint,
+                headers={"Content-Type": "application/json"},
+                data=json.dumps(request_data),
+                timeout=self._timeout)
+            _count_retries(response, DRS_REGISTER)
+            if slot is not None:
+                slot.throttled = _was_throttled(response)
+            response.raise_for_status()
         object_id = response.content.decode("ascii").strip()[1:-1]
 
         logger.info("Upload complete for object ID %s", object_id)
 
         return object_id
 
+    def _slot(self):
+        """Hold a slot of the adaptive concurrency limit, if enabled."""
+        if self._concurrency is None:
+            return contextlib.nullcontext()
+        return self._concurrency.slot()
+
+    def post_metadata_many(self, drs_metadata, workers=DEFAULT_POOL_SIZE):
+        """ Upload many metadata objects, several at a time.
+
+        DRS-filer registers one object per request, so requests are sent
+        concurrently over the pooled connections of the client. Failures
+        are reported per object and do not stop the others.
+
+        Parameters
+        ----------
+        drs_metadata : iterable of DRSMetadata
+            DRS metadata objects to be uploaded.
+        workers : int
+            Number of requests in flight at the same time; should not
+            exceed the pool size of the client.
+
+        Returns
+        -------
+        list of RegistrationResult
+            One result per metadata object, in input order.
+
+        """
+        def post(metadata):
+            try:
+                return RegistrationResult(drs_id=self.post_metadata(metadata))
+            except Exception as e:
+                logger.error("Registration of %s failed: %s",
+                             metadata.name, e)
+                return RegistrationResult(error=e)
+
+        with ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(post, drs_metadata))
+
+    def get_object(self, object_id):
+        """ Retrieve the metadata of a single object.
+
+        Parameters
+        ----------
+        object_id : str
+            The DRS ID of the object.
+
+        Returns
+        -------
+        dict
+            The DRS object, as returned by the server.
+
+        """
+        object_endpoint = urljoin(
+            self._drs_url, f"ga4gh/drs/v1/objects/{quote(object_id)}")
+
+        default_limiter.throttle_request()
+        with default_recorder.stage(DRS_GET):
+            response = self._session.get(
+                object_endpoint, timeout=self._timeout)
+            _count_retries(response, DRS_GET)
+            response.raise_for_status()
+
+        return response.json()
+
     def get_service_info(self):
         """Return service info object.
 
+        If the server tagged the previous response with an ETag, it is
+        revalidated rather than fetched again.
+
         Returns:
             service_info (dict)
 
         """
         service_info = urljoin(self._drs_url, "ga4gh/drs/v1/service-info")
 
-        response = requests.get(service_info)
+        headers = {}
+        cached = self._service_info
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
+        default_limiter.throttle_request()
+        with default_recorder.stage(DRS_GET):
+            response = self._session.get(
+                service_info, headers=headers, timeout=self._timeout)
+            _count_retries(response, DRS_GET)
+        if cached is not None and response.status_code == 304:
+            return cached[1]
         response.raise_for_status()
 
-        return response.json()
+        data = response.json()
+        etag = response.headers.get("ETag")
+        self._service_info = (etag, data) if etag else None
+        return data
+
+
+class _Retry(Retry):
+    """Retry policy that also retries POSTs the server turned down."""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST" and status_code in _POST_RETRY_STATUSES:
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def _count_retries(response, stage):
+    """Count the retries that led to a response towards a stage."""
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and retries.history:
+        default_recorder.retry(stage, len(retries.history))
+
+
+def _was_throttled(response):
+    """Return whether the server turned down a request, or its retries."""
+    retries = getattr(response.raw, "retries", None)
+    statuses = [response.status_code]
+    if retries is not None:
+        statuses += [attempt.status for attempt in retries.history]
+    return any(status in _THROTTLING_STATUSES for status in statuses)
+
+
+def _create_session(pool_size, retries, backoff):
+    retry = _Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=_RETRY_STATUSES,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size,
+        max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 def _create_request_data(drs_metadata):
@@ -121,7 +319,11 @@ def _create_request_data(drs_metadata):
         "checksums": [{
             "checksum": drs_metadata.checksum,
             "type": "sha-256"
-        }],
+        }] + [
+            {"checksum": checksum, "type": checksum_type}
+            for checksum_type, checksum in drs_metadata.checksums.items()
+            if checksum_type != "sha-256"
+        ],
         "description": drs_metadata.description,
         "mime_type": "application/json",
         "name": drs_metadata.name,
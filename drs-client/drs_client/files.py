@@ -1,14 +1,162 @@
+""" Streaming file digests.
+
+Digests are computed in a single pass over the file. Regular files are
+memory-mapped and digested without copying; other streams are read in
+fixed-size chunks into a reusable buffer, so memory use does not depend on
+file size.
+"""
+from dataclasses import dataclass
 import hashlib
 import os
+import time
 
+from crypt4gh_common import iter_views
 
-def compute_sha256(fname):
-    """ Compute SHA-256 checksum of file contents.
+try:
+    import crc32c as _crc32c
+except ImportError:  # pragma: no cover - optional dependency
+    _crc32c = None
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class _CRC32C:
+    """hashlib-style wrapper around the optional crc32c package."""
+
+    def __init__(self):
+        if _crc32c is None:
+            raise ValueError(
+                "crc32c checksums require the optional 'crc32c' package")
+        self._value = 0
+
+    def update(self, data):
+        self._value = _crc32c.crc32c(data, self._value)
+
+    def digest(self):
+        return self._value.to_bytes(4, "big")
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+# Digest factories, keyed by DRS checksum type.
+_ALGORITHMS = {
+    "sha-256": hashlib.sha256,
+    "md5": hashlib.md5,
+    "crc32c": _CRC32C,
+}
+
+
+def register_algorithm(name, factory):
+    """ Make a new digest algorithm available to the digest engine.
+
+    Parameters
+    ----------
+    name : str
+        The checksum type, as reported in DRS metadata.
+    factory : callable
+        Returns a new object with hashlib-style `update` and `hexdigest`
+        methods.
+
+    """
+    _ALGORITHMS[name] = factory
+
+
+@dataclass
+class DigestResult:
+    """ Outcome of a digest computation.
+    """
+    digests: dict  # Hex digests, keyed by checksum type
+    size: int  # Number of bytes digested
+    elapsed: float  # Wall-clock time spent digesting, in seconds
+
+    @property
+    def throughput(self):
+        """ Digest throughput, in bytes per second.
+        """
+        return self.size / self.elapsed if self.elapsed else 0.0
+
+
+class DigestEngine:
+    """ Compute several digests of a byte stream in a single pass.
+
+    Data may be fed incrementally with `update`, or read from a file
+    object with `update_from_file`.
+
+    """
+
+    def __init__(self, algorithms=("sha-256",)):
+        try:
+            self._digests = {
+                name: _ALGORITHMS[name]() for name in algorithms}
+        except KeyError as e:
+            raise ValueError(f"Unsupported checksum type: {e}") from None
+        self._size = 0
+        self._elapsed = 0.0
+
+    def update(self, data):
+        """ Feed a chunk of data to all digests.
+        """
+        start = time.perf_counter()
+        self._update(data)
+        self._elapsed += time.perf_counter() - start
+
+    def update_from_file(self, fp, chunk_size=DEFAULT_CHUNK_SIZE,
+                         progress=None):
+        """ Feed the remaining contents of a binary file object.
+
+        Time spent reading from the file counts towards the throughput.
+        If given, `progress` is called with the size of each chunk once
+        it has been digested.
+
+        """
+        start = time.perf_counter()
+        for chunk in iter_views(fp, chunk_size):
+            self._update(chunk)
+            if progress is not None:
+                progress(len(chunk))
+        self._elapsed += time.perf_counter() - start
+
+    def _update(self, data):
+        for digest in self._digests.values():
+            digest.update(data)
+        self._size += len(data)
+
+    def result(self):
+        """ Return the digests computed so far.
+        """
+        return DigestResult(
+            digests={
+                name: digest.hexdigest()
+                for name, digest in self._digests.items()},
+            size=self._size,
+            elapsed=self._elapsed,
+        )
+
+
+def compute_digests(fname, algorithms=("sha-256",),
+                    chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """ Compute one or more digests of file contents in a single pass.
+
+    Parameters
+    ----------
+    progress : callable, optional
+        Called with the number of bytes digested, as digesting proceeds.
+
+    Returns
+    -------
+    DigestResult
     """
-    m = hashlib.sha256()
+    engine = DigestEngine(algorithms)
     with open(fname, 'rb') as fp:
-        m.update(fp.read())
-    return m.hexdigest()
+        engine.update_from_file(fp, chunk_size, progress)
+    return engine.result()
+
+
+def compute_sha256(fname, progress=None):
+    """ Compute SHA-256 checksum of file contents.
+    """
+    return compute_digests(fname, progress=progress).digests["sha-256"]
 
 
 def compute_size(fname):
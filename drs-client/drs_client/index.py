@@ -0,0 +1,107 @@
+"""Local index of uploaded files and registered objects."""
+
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_PATH = os.path.join("~", ".cache", "drs-client", "index.sqlite")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    digest TEXT NOT NULL,      -- SHA-256 of the plaintext
+    encrypted INTEGER NOT NULL,
+    drs_url TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    name TEXT NOT NULL,        -- Name of the object in the bucket
+    drs_id TEXT NOT NULL,
+    PRIMARY KEY (digest, encrypted, drs_url, bucket)
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,     -- Absolute path of the file
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    digest TEXT NOT NULL       -- SHA-256 of the file
+);
+"""
+
+
+class ObjectIndex:
+    """Map content digests to the DRS IDs of objects holding them.
+
+    Objects are registered per DRS server and bucket, and separately for
+    encrypted and plain uploads of the same content. The digests of local
+    files are remembered too, for as long as their size, modification time
+    and inode do not change, so that unchanged files are not hashed again.
+    The index lives in a SQLite database, and may be shared by several
+    threads.
+
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        """Open the index, creating it if needed.
+
+        Args:
+            path (str): Location of the database, or ":memory:".
+
+        """
+        if path != ":memory:":
+            path = os.path.expanduser(path)
+            os.makedirs(os.path.dirname(path) or ".", mode=0o700,
+                        exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def lookup(self, digest, encrypted, drs_url, bucket):
+        """Return the DRS ID of an object with the given content, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT drs_id FROM objects WHERE digest = ? AND "
+                "encrypted = ? AND drs_url = ? AND bucket = ?",
+                (digest, int(encrypted), drs_url, bucket)).fetchone()
+        return row[0] if row else None
+
+    def record(self, digest, encrypted, drs_url, bucket, name, drs_id):
+        """Remember the DRS ID of an object with the given content."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, int(encrypted), drs_url, bucket, name, drs_id))
+
+    def file_digest(self, path):
+        """Return the digest of a file, or None if unknown or changed."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest FROM files WHERE path = ? AND size = ? AND "
+                "mtime_ns = ? AND inode = ?",
+                (path, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            ).fetchone()
+        return row[0] if row else None
+
+    def record_file(self, path, digest, stat=None):
+        """Remember the digest of a file.
+
+        Args:
+            path (str): Path of the file.
+            digest (str): Its SHA-256 digest.
+            stat (os.stat_result, optional): Status of the file when it was
+                read. Defaults to its current status.
+
+        """
+        path = os.path.abspath(path)
+        stat = stat or os.stat(path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,175 @@
+"""On-disk journal of resumable multipart uploads."""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOURNAL_DIR = os.path.join("~", ".cache", "drs-client", "uploads")
+
+
+class UploadJournal:
+    """Progress of a single multipart upload, saved after every part.
+
+    Besides the multipart upload ID and the ETags of completed parts, the
+    journal holds the crypt4gh encryption state of the upload, which
+    includes its session key. Journals are therefore only readable by their
+    owner, and deleted as soon as the object has been registered.
+
+    """
+
+    def __init__(self, path, data):
+        self.path = path
+        self._data = data
+        self._lock = threading.Lock()
+        self.stale = False
+
+    @classmethod
+    def open(cls, journal_dir, source, bucket, name):
+        """Load the journal for an upload, or start a new one.
+
+        Args:
+            journal_dir (str): Directory holding the journals.
+            source (str): Path of the file being uploaded.
+            bucket (str): Storage bucket the file is uploaded to.
+            name (str): Name of the object in the bucket.
+
+        Returns:
+            journal (UploadJournal): If the source file changed since the
+                journal was written, `stale` is set on the journal.
+
+        """
+        source = os.path.abspath(source)
+        journal_id = hashlib.sha256(
+            "\0".join([source, bucket, name]).encode()).hexdigest()[:32]
+        path = os.path.join(
+            os.path.expanduser(journal_dir), journal_id + ".json")
+        stat = os.stat(source)
+        fingerprint = {
+            "path": source,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+        journal = cls.load(path) or cls(path, {})
+        journal.stale = bool(journal._data) and \
+            journal._data.get("source") != fingerprint
+        if not journal._data:
+            journal._data = _new_data(fingerprint, bucket, name)
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        """Load a journal from file, or return None if it is unusable."""
+        try:
+            with open(path, "rt", encoding="utf-8") as fp:
+                return cls(path, json.load(fp))
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning("Ignoring corrupt upload journal %s", path)
+            return None
+
+    @property
+    def bucket(self):
+        return self._data["bucket"]
+
+    @property
+    def name(self):
+        return self._data["name"]
+
+    @property
+    def started(self):
+        return self._data["started"]
+
+    @property
+    def upload_id(self):
+        return self._data.get("upload_id")
+
+    @property
+    def part_size(self):
+        return self._data.get("part_size")
+
+    @property
+    def parts(self):
+        """ETags of completed parts, keyed by part number."""
+        return {int(number): etag
+                for number, etag in self._data.get("parts", {}).items()}
+
+    @property
+    def encryption(self):
+        return self._data.get("encryption")
+
+    @encryption.setter
+    def encryption(self, state):
+        self._data["encryption"] = state
+
+    @property
+    def result(self):
+        return self._data.get("result")
+
+    def reset(self):
+        """Forget about the previous upload, e.g. when it became stale."""
+        self._data = _new_data(
+            self._data["source"], self.bucket, self.name)
+        self.stale = False
+
+    def start(self, upload_id, part_size):
+        """Record the start of a new multipart upload."""
+        with self._lock:
+            self._data.update({
+                "upload_id": upload_id,
+                "part_size": part_size,
+                "parts": {},
+                "started": time.time(),
+            })
+            self._save()
+
+    def record_part(self, number, etag):
+        """Record a completed part."""
+        with self._lock:
+            self._data["parts"][str(number)] = etag
+            self._save()
+
+    def record_result(self, checksum, size):
+        """Record the checksum and size of a completely uploaded object."""
+        with self._lock:
+            self._data["result"] = {"checksum": checksum, "size": size}
+            self._save()
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "wt", encoding="utf-8") as fp:
+            json.dump(self._data, fp)
+        os.replace(tmp_path, self.path)
+
+
+def iter_journals(journal_dir):
+    """Yield all readable journals in a directory."""
+    pattern = os.path.join(os.path.expanduser(journal_dir), "*.json")
+    for path in sorted(glob.glob(pattern)):
+        journal = UploadJournal.load(path)
+        if journal is not None:
+            yield journal
+
+
+def _new_data(fingerprint, bucket, name):
+    return {
+        "source": fingerprint,
+        "bucket": bucket,
+        "name": name,
+        "started": time.time(),
+    }
@@ -0,0 +1,185 @@
+"""Progress of long transfers, aggregated across threads.
+
+Transfer functions report progress by calling a callback with a number of
+bytes. A `ProgressTracker` is such a callback: it adds up the bytes reported
+by all parts and workers of one or more transfers, and passes the running
+totals to its listeners at regular intervals. `TerminalDisplay` and
+`JSONLinesDisplay` are listeners showing progress to people and programs.
+"""
+import collections
+from dataclasses import asdict, dataclass
+import json
+import sys
+import threading
+import time
+
+# Seconds between two notifications of the listeners.
+DEFAULT_INTERVAL = 0.5
+
+# Period over which the current rate is measured, in seconds.
+_RATE_WINDOW = 10.0
+
+
+@dataclass
+class ProgressState:
+    """Running totals of a tracker."""
+    done: int  # Bytes reported so far
+    total: int = None  # Bytes expected, if known
+    elapsed: float = 0.0  # Seconds since the tracker was created
+    rate: float = 0.0  # Bytes per second, over the last few seconds
+    finished: bool = False  # Whether this is the last notification
+
+    @property
+    def fraction(self):
+        """Fraction of the expected bytes done, or None if unknown."""
+        if not self.total:
+            return None
+        return min(self.done / self.total, 1.0)
+
+    @property
+    def eta(self):
+        """Seconds left at the current rate, or None if unknown."""
+        if not self.total or not self.rate:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+
+class ProgressTracker:
+    """Add up bytes reported from any number of threads.
+
+    Call the tracker with a number of bytes to report progress. Listeners
+    are called with a `ProgressState` at most every `interval` seconds, by
+    whichever thread reports progress at the time, and a last time on
+    `close`. Reporting never waits for listeners.
+
+    """
+
+    def __init__(self, total=None, interval=DEFAULT_INTERVAL):
+        """Create a new tracker.
+
+        Args:
+            total (int, optional): Number of bytes expected, if known. May
+                also be added to later, with `add_total`.
+            interval (float): Minimum number of seconds between two
+                notifications of the listeners.
+
+        """
+        self._total = total
+        self._done = 0
+        self._interval = interval
+        self._start = time.monotonic()
+        self._next = self._start
+        self._samples = collections.deque([(self._start, 0)])
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._notifying = threading.Lock()
+
+    def __call__(self, nbytes):
+        with self._lock:
+            self._done += nbytes
+            now = time.monotonic()
+            if now < self._next:
+                return
+            self._next = now + self._interval
+            state = self._state(now)
+        self._notify(state, blocking=False)
+
+    def add_total(self, nbytes):
+        """Expect more bytes, e.g. for another file of a batch."""
+        with self._lock:
+            self._total = (self._total or 0) + nbytes
+
+    def subscribe(self, listener):
+        """Call listener with a `ProgressState` at each notification."""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def state(self):
+        """Return the current totals."""
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def close(self):
+        """Notify the listeners of the final totals."""
+        with self._lock:
+            state = self._state(time.monotonic())
+        state.finished = True
+        self._notify(state, blocking=True)
+
+    def _state(self, now):
+        samples = self._samples
+        samples.append((now, self._done))
+        while len(samples) > 2 and samples[1][0] < now - _RATE_WINDOW:
+            samples.popleft()
+        since, done_since = samples[0]
+        rate = (self._done - done_since) / (now - since) \
+            if now > since else 0.0
+        return ProgressState(done=self._done, total=self._total,
+                             elapsed=now - self._start, rate=rate)
+
+    def _notify(self, state, blocking):
+        # Skip intermediate notifications while another thread notifies,
+        # rather than stall a transfer.
+        if not self._notifying.acquire(blocking=blocking):
+            return
+        try:
+            for listener in list(self._listeners):
+                listener(state)
+        finally:
+            self._notifying.release()
+
+
+class TerminalDisplay:
+    """Show progress on a single, updated line of a terminal."""
+
+    def __init__(self, stream=None, label=""):
+        self._stream = stream or sys.stderr
+        self._label = label
+        self._width = 0
+
+    def __call__(self, state):
+        text = self._label + format_size(state.done)
+        if state.total is not None:
+            text += f" / {format_size(state.total)}"
+            text += f" ({state.fraction * 100:.0f}%)"
+        text += f"  {format_size(state.rate)}/s"
+        if state.eta is not None and not state.finished:
+            text += f"  ETA {format_duration(state.eta)}"
+        elif state.finished:
+            text += f"  in {format_duration(state.elapsed)}"
+        padding = " " * max(self._width - len(text), 0)
+        self._width = len(text)
+        self._stream.write("\r" + text + padding
+                           + ("\n" if state.finished else ""))
+        self._stream.flush()
+
+
+class JSONLinesDisplay:
+    """Write progress as JSON objects, one per line, for other programs."""
+
+    def __init__(self, stream=None):
+        self._stream = stream or sys.stderr
+
+    def __call__(self, state):
+        record = asdict(state)
+        record["eta"] = state.eta
+        self._stream.write(json.dumps(record) + "\n")
+        self._stream.flush()
+
+
+def format_size(nbytes):
+    """Format a number of bytes with a decimal unit, e.g. 1.5 GB."""
+    for unit in ("B", "kB", "MB", "GB", "TB"):
+        if abs(nbytes) < 1000 or unit == "TB":
+            break
+        nbytes /= 1000
+    return f"{nbytes:.0f} {unit}" if unit == "B" else f"{nbytes:.1f} {unit}"
+
+
+def format_duration(seconds):
+    """Format a number of seconds as [H:]MM:SS."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
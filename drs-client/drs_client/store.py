@@ -1,61 +1,507 @@
 """S3-backed file storage."""
 
+import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
+import itertools
 import logging
 import os
+import threading
+import time
 from urllib.parse import urlparse, urlunparse
 
-import botocore
-import boto3
+from .concurrency import AdaptiveConcurrency
+from .telemetry import default_recorder, S3_GET, S3_PUT
+from .throttle import default_limiter
 
 
 logger = logging.getLogger(__name__)
 
+# S3 limits on multipart uploads: all parts but the last must be at least
+# MIN_PART_SIZE, and an upload may have at most MAX_PARTS parts.
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+# Parts of streams of unknown size double in size every so many parts, which
+# fits 8 TB in MAX_PARTS parts with the default part size.
+_PARTS_PER_SIZE = 1000
+
+_MIB = 1024 * 1024
+
+# Size of reads from response bodies.
+_READ_SIZE = _MIB
+
+# Error codes of requests turned down by a busy server.
+_THROTTLING_CODES = ("SlowDown", "503", "ServiceUnavailable", "Throttling",
+                     "ThrottlingException", "RequestLimitExceeded",
+                     "TooManyRequests", "429")
+
+
+@dataclass
+class TransferSettings:
+    """Tuning knobs for multipart transfers.
+
+    May be set from the `transfer` section of the configuration file.
+
+    """
+    part_size: int = DEFAULT_PART_SIZE  # Size of each part, in bytes
+    max_concurrency: int = 8  # Number of parts transferred in parallel
+    use_threads: bool = True  # If False, transfer one part at a time
+    max_inflight_bytes: int = 256 * 1024 * 1024  # Parts held in memory
+    part_retries: int = 3  # Attempts per part beyond the first
+    retry_backoff: float = 1.0  # Initial delay between attempts, in seconds
+    encryption_workers: int = 1  # Threads encrypting each uploaded file
+    adaptive_concurrency: bool = False  # Adapt parts in flight to the server
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create settings from a (configuration file) dictionary.
+
+        Raises:
+            ValueError: if the dictionary contains unknown settings, or a
+                part size that S3 does not accept.
+
+        """
+        known = {f.name for f in fields(cls)}
+        unknown = set(data) - known
+        if unknown:
+            raise ValueError(
+                f"Unknown transfer settings: {', '.join(sorted(unknown))}")
+        settings = cls(**data)
+        if not MIN_PART_SIZE <= settings.part_size <= MAX_PART_SIZE:
+            raise ValueError(
+                f"part_size must be between {MIN_PART_SIZE} and "
+                f"{MAX_PART_SIZE} bytes")
+        return settings
+
+    @property
+    def max_inflight_parts(self):
+        return max(1, self.max_inflight_bytes // self.part_size)
+
+    @property
+    def parallel(self):
+        return self.use_threads and self.max_concurrency > 1
+
 
 class BucketStore:
     """File store using an S3 or Minio bucket."""
 
-    def __init__(self, bucket, endpoint=None):
+    def __init__(self, bucket, endpoint=None, transfer=None,
+                 max_connections=None):
         """Create new BucketStore instance.
 
         Args:
             bucket: The name of the bucket to use.
             endpoint (optional): The hostname and port of the storage server.
+            transfer (TransferSettings, optional): Multipart transfer
+                settings. If not set, defaults are used.
+            max_connections (int, optional): Size of the connection pool.
+                Defaults to enough connections for a single transfer. With
+                adaptive concurrency, also the most parts uploaded at once
+                by all transfers of the store.
 
         """
-        self._client = _configure_client(endpoint)
+        self._transfer = transfer or TransferSettings()
+        self._client = _configure_client(
+            endpoint,
+            max_connections or max(10, self._transfer.max_concurrency))
         self._bucket = bucket
+        self._concurrency = None
+        if self._transfer.adaptive_concurrency:
+            self._concurrency = AdaptiveConcurrency(
+                max_connections or self._transfer.max_concurrency,
+                stage=S3_PUT, is_throttling=_is_throttling)
 
-    def upload_file(self, file_path, name=None):
+    def upload_file(self, file_path, name=None, progress=None):
         """Upload a file to the store.
 
         Args:
             file_path (str): File path to upload.
             name (str, optional): Optionally, a name under which to register
                 the file. If not set, defaults to the file name.
+            progress (callable, optional): Called with the number of bytes
+                stored, as parts complete; see `upload_stream`.
 
         Returns:
             url (str): A URL that can be used to retrieve the file from storage
 
         """
         name = name or os.path.basename(file_path)
+        part_size = self._transfer.part_size
 
         logger.debug("Uploading file %s", file_path)
-        self._client.upload_file(file_path, self._bucket, name)
+        with open(file_path, "rb") as fp:
+            url = self.upload_stream(
+                iter(lambda: fp.read(part_size), b""), name,
+                progress=progress, size=os.fstat(fp.fileno()).st_size)
         logger.debug("Upload finished for file %s", file_path)
+        return url
+
+    def upload_stream(self, chunks, name, part_size=None, journal=None,
+                      progress=None, size=None):
+        """Upload a stream of unknown length to the store.
+
+        Chunks are gathered into parts of exactly `part_size` bytes and
+        sent as a multipart upload as soon as each part is complete. Parts
+        are uploaded in parallel, bounded by the transfer settings, and each
+        part is retried on its own if it fails. Streams shorter than one
+        part are sent with a single request.
+
+        S3 takes at most `MAX_PARTS` parts per upload. If the size of the
+        stream is given, parts are made large enough to fit it. Otherwise,
+        parts double in size every thousand parts.
+
+        With a journal, the upload can be resumed: completed parts are
+        recorded in the journal, and when the journal refers to an earlier,
+        unfinished upload, parts that were already stored are skipped
+        (their chunks are still consumed). This requires the stream to be
+        identical to that of the interrupted upload. An interrupted upload
+        is left in place for a later rerun to resume; see `abort_upload`.
+
+        Args:
+            chunks (iterable of bytes): The object data, in order.
+            name (str): The name under which to register the object.
+            part_size (int, optional): Minimum size of each part, in bytes.
+                Defaults to the part size of the transfer settings.
+            journal (UploadJournal, optional): Journal to resume from and
+                record progress in.
+            progress (callable, optional): Called with the size of each part
+                once it is stored (or found stored, when resuming). Parts
+                complete in any order, and it may be called from several
+                threads at once.
+            size (int, optional): Size of the stream, in bytes, if known.
+                An estimate is fine, as long as it is not too low.
+
+        Returns:
+            url (str): A URL that can be used to retrieve the file from storage
+
+        """
+        part_size = part_size or self._transfer.part_size
+        if size is not None:
+            part_size = fitting_part_size(size, part_size)
+        logger.debug("Uploading stream to %s", name)
+        parts = _iter_parts(chunks, part_size, grow=size is None)
+        if journal is None:
+            first = next(parts, b"")
+            second = next(parts, None)
+            if second is None:
+                default_limiter.throttle_bytes(len(first))
+                with default_recorder.stage(S3_PUT, len(first)):
+                    self._client.put_object(
+                        Bucket=self._bucket, Key=name, Body=first)
+                if progress is not None:
+                    progress(len(first))
+            else:
+                self._upload_multipart(
+                    itertools.chain([first, second], parts), name,
+                    progress=progress)
+        else:
+            self._upload_multipart(parts, name, part_size, journal, progress)
+        logger.debug("Upload finished for stream %s", name)
 
         url = self.generate_presigned_url(name)
-        logger.debug("Finished file upload. URL: %s", url)
+        logger.debug("Finished stream upload. URL: %s", url)
         return url
 
-    def download_file(self, file_id, file_path):
+    def abort_upload(self, name, upload_id):
+        """Abort an unfinished multipart upload, discarding its parts."""
+        logger.info("Aborting multipart upload of %s", name)
+        try:
+            self._client.abort_multipart_upload(
+                Bucket=self._bucket, Key=name, UploadId=upload_id)
+        except _botocore_exceptions().ClientError as e:
+            if _error_code(e) != "NoSuchUpload":
+                raise
+
+    def _upload_multipart(self, parts, name, part_size=None, journal=None,
+                          progress=None):
+        upload_id, done = self._resume_or_create_upload(
+            name, part_size, journal)
+
+        def pending():
+            for number, body in enumerate(parts, start=1):
+                if number not in done:
+                    yield number, body
+                elif progress is not None:
+                    progress(len(body))
+
+        try:
+            completed = self._upload_parts(
+                pending(), name, upload_id, journal, progress)
+            completed += [{"PartNumber": number, "ETag": etag}
+                          for number, etag in done.items()]
+            completed.sort(key=lambda part: part["PartNumber"])
+            self._client.complete_multipart_upload(
+                Bucket=self._bucket, Key=name, UploadId=upload_id,
+                MultipartUpload={"Parts": completed})
+        except BaseException:
+            if journal is None:
+                self.abort_upload(name, upload_id)
+            else:
+                logger.info("Upload of %s interrupted; rerun to resume", name)
+            raise
+
+    def _resume_or_create_upload(self, name, part_size, journal):
+        """Return the ID of the upload to use, and its completed parts."""
+        if journal is not None and journal.upload_id:
+            stored = None
+            if journal.part_size == part_size:
+                stored = self._list_parts(name, journal.upload_id)
+            if stored is None:
+                self.abort_upload(name, journal.upload_id)
+            else:
+                done = {number: etag
+                        for number, etag in journal.parts.items()
+                        if stored.get(number) == etag}
+                logger.info("Resuming upload of %s: %d parts already stored",
+                            name, len(done))
+                return journal.upload_id, done
+
+        upload_id = self._client.create_multipart_upload(
+            Bucket=self._bucket, Key=name)["UploadId"]
+        if journal is not None:
+            journal.start(upload_id, part_size)
+        return upload_id, {}
+
+    def _list_parts(self, name, upload_id):
+        """Return ETags of stored parts, or None if the upload is gone."""
+        stored = {}
+        kwds = {}
+        while True:
+            try:
+                response = self._client.list_parts(
+                    Bucket=self._bucket, Key=name, UploadId=upload_id, **kwds)
+            except _botocore_exceptions().ClientError as e:
+                if _error_code(e) == "NoSuchUpload":
+                    return None
+                raise
+            for part in response.get("Parts", []):
+                stored[part["PartNumber"]] = part["ETag"]
+            if not response.get("IsTruncated"):
+                return stored
+            kwds = {"PartNumberMarker": response["NextPartNumberMarker"]}
+
+    def _upload_parts(self, numbered_parts, name, upload_id, journal=None,
+                      progress=None):
+        """Upload parts, in parallel if configured, and return their ETags.
+
+        Producing parts stalls while `max_inflight_bytes` are waiting to be
+        uploaded (counted in parts of the configured size, and at least one
+        part), which bounds memory use, and stops as soon as a part has
+        failed for good.
+
+        """
+        if not self._transfer.parallel:
+            return [self._upload_part(
+                        name, upload_id, number, body, journal, progress)
+                    for number, body in numbered_parts]
+
+        capacity = self._transfer.max_inflight_parts
+        slots = threading.BoundedSemaphore(capacity)
+        failed = threading.Event()
+
+        def upload(number, body, held):
+            try:
+                return self._upload_part(
+                    name, upload_id, number, body, journal, progress)
+            except BaseException:
+                failed.set()
+                raise
+            finally:
+                for _ in range(held):
+                    slots.release()
+
+        futures = []
+        with ThreadPoolExecutor(self._transfer.max_concurrency) as executor:
+            try:
+                for number, body in numbered_parts:
+                    # Only this thread acquires slots: it may take several.
+                    held = _slots_needed(
+                        len(body), self._transfer.part_size, capacity)
+                    for _ in range(held):
+                        slots.acquire()
+                    if failed.is_set():
+                        break
+                    futures.append(
+                        executor.submit(upload, number, body, held))
+            except BaseException:
+                failed.set()
+                raise
+            finally:
+                if failed.is_set():
+                    for future in futures:
+                        future.cancel()
+        return [future.result() for future in futures]
+
+    def _upload_part(self, name, upload_id, number, body, journal=None,
+                     progress=None):
+        def upload():
+            default_limiter.throttle_bytes(len(body))
+            with self._slot():
+                return self._client.upload_part(
+                    Bucket=self._bucket, Key=name, UploadId=upload_id,
+                    PartNumber=number, Body=body)
+
+        with default_recorder.stage(S3_PUT, len(body)):
+            response = _retry(upload, self._transfer,
+                              f"part {number} of {name}", S3_PUT)
+        if journal is not None:
+            journal.record_part(number, response["ETag"])
+        if progress is not None:
+            progress(len(body))
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def _slot(self):
+        """Hold a slot of the adaptive concurrency limit, if enabled."""
+        if self._concurrency is None:
+            return contextlib.nullcontext()
+        return self._concurrency.slot()
+
+    def download_file(self, file_id, file_path, progress=None):
         """Download file from the store.
 
+        The file is preallocated at its final size, and its parts are
+        fetched with ranged GETs, in parallel if configured, each written in
+        place as it arrives. A part that fails is retried on its own.
+
         Args:
             file_id (str): Object ID (in the store) of the file to download.
             file_path (str): Where to store the downloaded file.
+            progress (callable, optional): Called with the size of each part
+                once it is written. Parts complete in any order, and it may
+                be called from several threads at once.
+
+        """
+        size = self.object_size(file_id)
+        part_size = self._transfer.part_size
+        ranges = [(start, min(start + part_size, size))
+                  for start in range(0, size, part_size)]
+
+        logger.debug("Downloading %s (%d bytes) to %s",
+                     file_id, size, file_path)
+        try:
+            with open(file_path, "wb") as fp:
+                _preallocate(fp.fileno(), size)
+                writer = _PositionalWriter(fp.fileno())
+                self._map_parallel(
+                    lambda r: self._download_range(
+                        file_id, r, writer, progress),
+                    ranges)
+        except BaseException:
+            os.remove(file_path)
+            raise
+        logger.debug("Download finished for %s", file_id)
+
+    def object_size(self, name):
+        """Return the size of a stored object, in bytes."""
+        response = self._client.head_object(Bucket=self._bucket, Key=name)
+        return response["ContentLength"]
+
+    def object_metadata(self, name):
+        """Return the user metadata of a stored object, or None if absent."""
+        try:
+            response = self._client.head_object(Bucket=self._bucket, Key=name)
+        except _botocore_exceptions().ClientError as e:
+            if _error_code(e) in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return response.get("Metadata", {})
+
+    def put_marker(self, name, metadata):
+        """Store an empty object carrying only user metadata."""
+        self._client.put_object(
+            Bucket=self._bucket, Key=name, Body=b"", Metadata=metadata)
+
+    def read_range(self, name, start, end):
+        """Read bytes [start, end) of a stored object."""
+        if end <= start:
+            return b""
+
+        def get():
+            default_limiter.throttle_bytes(end - start)
+            body = self._client.get_object(
+                Bucket=self._bucket, Key=name,
+                Range=f"bytes={start}-{end - 1}")["Body"]
+            data = body.read()
+            if len(data) != end - start:
+                raise IOError(f"Short read: got {len(data)} bytes "
+                              f"of {end - start}")
+            return data
+
+        with default_recorder.stage(S3_GET, end - start):
+            return _retry(get, self._transfer,
+                          f"bytes {start}-{end - 1} of {name}", S3_GET)
+
+    def iter_ranges(self, name, ranges, transform=None):
+        """Fetch byte ranges of an object, yielding them in order.
+
+        Ranges are fetched in parallel if configured, with a bounded number
+        of them held in memory ahead of the consumer.
+
+        Args:
+            name (str): The name of the object.
+            ranges (iterable of (int, int)): [start, end) byte ranges.
+            transform (callable, optional): Applied to the data of each
+                range by the thread that fetched it; its result is yielded
+                instead of the data.
 
         """
-        self._client.download_file(self._bucket, file_id, file_path)
+        def fetch(byte_range):
+            data = self.read_range(name, *byte_range)
+            return transform(data) if transform is not None else data
+
+        if not self._transfer.parallel:
+            for byte_range in ranges:
+                yield fetch(byte_range)
+            return
+
+        window = max(self._transfer.max_inflight_parts,
+                     self._transfer.max_concurrency)
+        pending = collections.deque()
+        with ThreadPoolExecutor(self._transfer.max_concurrency) as executor:
+            try:
+                for byte_range in ranges:
+                    if len(pending) >= window:
+                        yield pending.popleft().result()
+                    pending.append(executor.submit(fetch, byte_range))
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _download_range(self, name, byte_range, writer, progress=None):
+        def fetch():
+            start, end = byte_range
+            body = self._client.get_object(
+                Bucket=self._bucket, Key=name,
+                Range=f"bytes={start}-{end - 1}")["Body"]
+            offset = start
+            for chunk in iter(lambda: body.read(_READ_SIZE), b""):
+                default_limiter.throttle_bytes(len(chunk))
+                writer.write(offset, chunk)
+                offset += len(chunk)
+            if offset != end:
+                raise IOError(f"Short read: got {offset - start} bytes "
+                              f"of {end - start}")
+
+        start, end = byte_range
+        with default_recorder.stage(S3_GET, end - start):
+            _retry(fetch, self._transfer, f"bytes {byte_range} of {name}",
+                   S3_GET)
+        if progress is not None:
+            progress(end - start)
+
+    def _map_parallel(self, func, items):
+        """Apply func to all items, in parallel if configured."""
+        if not self._transfer.parallel:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(self._transfer.max_concurrency) as executor:
+            return list(executor.map(func, items))
 
     def generate_presigned_url(self, name):
         """Generate presigned URL for bucket object.
@@ -68,7 +514,12 @@ class BucketStore:
         return url
 
 
-def _configure_client(endpoint):
+def _configure_client(endpoint, max_connections):
+    # boto3 takes a while to import: only pay for it once storage is used.
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+
     session = boto3.Session(
         aws_access_key_id=os.environ["ACCESS_KEY"],
         aws_secret_access_key=os.environ["SECRET_KEY"],
@@ -77,15 +528,140 @@ def _configure_client(endpoint):
     client = session.client(
         "s3",
         endpoint_url=endpoint,
+        config=Config(max_pool_connections=max_connections),
     )
 
     # Allow for easy creation of URLs to bucket objects.
     config = client._client_config
-    config.signature_version = botocore.UNSIGNED
+    config.signature_version = UNSIGNED
 
     return client
 
 
+class _PositionalWriter:
+    """Write to arbitrary offsets of a file from several threads."""
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._lock = threading.Lock()
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        while view:
+            written = self._write_at(offset, view)
+            view = view[written:]
+            offset += written
+
+    def _write_at(self, offset, data):
+        if hasattr(os, "pwrite"):
+            return os.pwrite(self._fd, data, offset)
+        with self._lock:  # pragma: no cover - platforms without pwrite
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.write(self._fd, data)
+
+
+def _preallocate(fd, size):
+    """Reserve disk space for a file of the given size."""
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:  # e.g. not supported by the file system
+            pass
+    os.ftruncate(fd, size)
+
+
+def _botocore_exceptions():
+    """Return botocore.exceptions, imported on first use as boto3 is."""
+    from botocore import exceptions
+    return exceptions
+
+
+def _transfer_errors():
+    """Return the exception types of failed transfers, which are retried."""
+    exceptions = _botocore_exceptions()
+    return exceptions.BotoCoreError, exceptions.ClientError, OSError
+
+
+def _error_code(error):
+    return error.response.get("Error", {}).get("Code")
+
+
+def _is_throttling(error):
+    """Return whether an exception means that the server is busy."""
+    return isinstance(error, _botocore_exceptions().ClientError) \
+        and _error_code(error) in _THROTTLING_CODES
+
+
+def _retry(func, transfer, what, stage=None):
+    """Call func, retrying with exponential backoff on transfer errors.
+
+    Retries are counted towards the telemetry of `stage`, if given.
+
+    """
+    delay = transfer.retry_backoff
+    for attempt in itertools.count():
+        try:
+            return func()
+        except _transfer_errors() as e:
+            if attempt >= transfer.part_retries:
+                raise
+            if stage is not None:
+                default_recorder.retry(stage)
+            logger.warning("Transfer of %s failed (%s), retrying in %.1fs",
+                           what, e, delay)
+            time.sleep(delay)
+            delay *= 2
+
+
+def fitting_part_size(size, part_size=DEFAULT_PART_SIZE):
+    """Return a part size, of at least part_size, fitting size in MAX_PARTS.
+
+    Part sizes larger than part_size are rounded up to whole MiB.
+
+    """
+    needed = -(-size // MAX_PARTS)
+    if needed <= part_size:
+        return part_size
+    return -(-needed // _MIB) * _MIB
+
+
+def _grown_part_size(part_size, number):
+    """Return the size of part `number` of a stream of unknown size."""
+    return min(part_size << ((number - 1) // _PARTS_PER_SIZE),
+               max(part_size, MAX_PART_SIZE))
+
+
+def _slots_needed(nbytes, part_size, capacity):
+    """Number of in-flight slots, each worth a part, taken by nbytes."""
+    return min(capacity, max(1, -(-nbytes // part_size)))
+
+
+def _iter_parts(chunks, part_size, grow=False):
+    """Regroup a stream of chunks into parts of part_size bytes.
+
+    Only the last part may be shorter. Parts end at the same offsets
+    whatever the size of the chunks, so that a resumed upload, which may
+    produce chunks of other sizes (e.g. with more encryption workers), cuts
+    its parts where the interrupted one did. With `grow`, parts grow as
+    `_grown_part_size`, which only depends on their number.
+
+    """
+    buf = bytearray()
+    number = 1
+    size = part_size
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+            number += 1
+            if grow:
+                size = _grown_part_size(part_size, number)
+    if buf:
+        yield bytes(buf)
+
+
 def _remove_query_string(url):
     parsed_url = urlparse(url)
     return urlunparse((
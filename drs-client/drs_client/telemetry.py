@@ -0,0 +1,233 @@
+"""Per-stage timing of transfers, with OpenMetrics export.
+
+Uploads and downloads go through several stages (hashing, encryption,
+S3 requests, DRS-filer requests), each of which may bound throughput. Every
+stage reports to a recorder how long it took, in wall-clock and CPU time,
+and how many bytes it handled. The recorder aggregates these per stage, and
+passes each to its listeners as a `StageEvent`.
+"""
+from dataclasses import dataclass, replace
+import threading
+import time
+
+# Names of the stages reported by this package.
+HASH = "hash"  # Digesting data, for checksums or deduplication
+ENCRYPT = "encrypt"  # Reading and encrypting plaintext
+READ = "read"  # Reading plaintext that is not encrypted
+S3_PUT = "s3.put"  # Storing objects and parts
+S3_GET = "s3.get"  # Fetching byte ranges
+DRS_REGISTER = "drs.register"  # Registering objects
+DRS_GET = "drs.get"  # Fetching objects and service info
+THROTTLE_BYTES = "throttle.bytes"  # Waiting for the bandwidth limit
+THROTTLE_REQUESTS = "throttle.requests"  # Waiting for the request rate limit
+
+
+@dataclass
+class StageEvent:
+    """A single operation of a stage."""
+    stage: str
+    wall: float  # Wall-clock time, in seconds
+    cpu: float  # CPU time of the thread running the operation, in seconds
+    nbytes: int = 0  # Number of bytes handled
+    error: bool = False  # Whether the operation failed
+
+
+@dataclass
+class StageStats:
+    """Totals of all operations of a stage."""
+    count: int = 0  # Number of operations
+    nbytes: int = 0
+    wall: float = 0.0
+    cpu: float = 0.0
+    max_wall: float = 0.0  # Latency of the slowest operation
+    retries: int = 0
+    errors: int = 0
+    concurrency: int = None  # Adaptive limit on operations in flight, if any
+    backoffs: int = 0  # Decreases of the adaptive limit
+
+    @property
+    def throughput(self):
+        """Bytes per second of wall-clock time spent in the stage."""
+        return self.nbytes / self.wall if self.wall else 0.0
+
+
+class Recorder:
+    """Aggregate the operations of transfer stages.
+
+    A recorder may be shared by several threads. Stages of concurrent
+    operations overlap, so the wall-clock times of a stage add up to more
+    than the elapsed time when it runs in parallel.
+
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def stage(self, name, nbytes=0):
+        """Time an operation of a stage, as a context manager.
+
+        The number of bytes may also be set once known, through the
+        `nbytes` attribute of the object returned on entering the context.
+
+        """
+        return _Span(self, name, nbytes)
+
+    def record(self, event):
+        """Add an operation to the totals, and pass it to the listeners."""
+        with self._lock:
+            stats = self._stats.setdefault(event.stage, StageStats())
+            stats.count += 1
+            stats.nbytes += event.nbytes
+            stats.wall += event.wall
+            stats.cpu += event.cpu
+            stats.max_wall = max(stats.max_wall, event.wall)
+            stats.errors += event.error
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(event)
+
+    def retry(self, name, count=1):
+        """Count retried attempts of an operation of a stage."""
+        with self._lock:
+            self._stats.setdefault(name, StageStats()).retries += count
+
+    def concurrency(self, name, limit, backoff=False):
+        """Set the adaptive concurrency limit of a stage."""
+        with self._lock:
+            stats = self._stats.setdefault(name, StageStats())
+            stats.concurrency = limit
+            stats.backoffs += backoff
+
+    def subscribe(self, listener):
+        """Call listener with every `StageEvent` from now on."""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def snapshot(self):
+        """Return a copy of the totals, as a dict of StageStats by stage."""
+        with self._lock:
+            return {name: replace(stats)
+                    for name, stats in self._stats.items()}
+
+    def reset(self):
+        """Forget all totals."""
+        with self._lock:
+            self._stats.clear()
+
+    def format_table(self):
+        """Return the totals as a human-readable table, one stage per row."""
+        rows = [("stage", "ops", "MB", "wall s", "cpu s", "MB/s", "max s",
+                 "retries", "errors", "limit")]
+        for name, stats in sorted(self.snapshot().items()):
+            rows.append((
+                name, str(stats.count), f"{stats.nbytes / 1e6:.1f}",
+                f"{stats.wall:.3f}", f"{stats.cpu:.3f}",
+                f"{stats.throughput / 1e6:.1f}", f"{stats.max_wall:.3f}",
+                str(stats.retries), str(stats.errors),
+                "-" if stats.concurrency is None else str(stats.concurrency)))
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(rows[0]))]
+        return "\n".join(
+            "  ".join([row[0].ljust(widths[0])]
+                      + [cell.rjust(width)
+                         for cell, width in zip(row[1:], widths[1:])])
+            for row in rows)
+
+    def openmetrics(self, prefix="drs_client"):
+        """Return the totals in the OpenMetrics (Prometheus) text format."""
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+        for metric, kind, unit, help_text, value in _METRICS:
+            name = f"{prefix}_stage_{metric}"
+            lines.append(f"# TYPE {name} {kind}")
+            if unit:
+                lines.append(f"# UNIT {name} {unit}")
+            lines.append(f"# HELP {name} {help_text}")
+            suffix = "_total" if kind == "counter" else ""
+            for stage, stats in snapshot:
+                if value(stats) is not None:
+                    lines.append(
+                        f'{name}{suffix}{{stage="{stage}"}} {value(stats)}')
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+# Exported metrics: name, type, unit, help, and value from StageStats (or
+# None, for stages without the metric).
+_METRICS = [
+    ("operations", "counter", "", "Operations of the stage.",
+     lambda s: s.count),
+    ("bytes", "counter", "bytes", "Bytes handled by the stage.",
+     lambda s: s.nbytes),
+    ("wall_seconds", "counter", "seconds",
+     "Wall-clock time spent in the stage.", lambda s: s.wall),
+    ("cpu_seconds", "counter", "seconds", "CPU time spent in the stage.",
+     lambda s: s.cpu),
+    ("retries", "counter", "", "Retried attempts of operations.",
+     lambda s: s.retries),
+    ("errors", "counter", "", "Operations that failed.",
+     lambda s: s.errors),
+    ("max_latency_seconds", "gauge", "seconds",
+     "Wall-clock time of the slowest operation.", lambda s: s.max_wall),
+    ("concurrency_limit", "gauge", "",
+     "Adaptive limit on operations in flight.", lambda s: s.concurrency),
+    ("concurrency_backoffs", "counter", "",
+     "Decreases of the adaptive limit on operations in flight.",
+     lambda s: s.backoffs if s.concurrency is not None else None),
+]
+
+
+class _Span:
+    """Context manager timing one operation of a stage."""
+
+    __slots__ = ("_recorder", "_name", "nbytes", "_wall", "_cpu")
+
+    def __init__(self, recorder, name, nbytes):
+        self._recorder = recorder
+        self._name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._recorder.record(StageEvent(
+            stage=self._name,
+            wall=time.perf_counter() - self._wall,
+            cpu=time.thread_time() - self._cpu,
+            nbytes=self.nbytes,
+            error=exc_type is not None,
+        ))
+
+
+def timed(chunks, name, recorder=None):
+    """Pass chunks through, timing the production of each as a stage."""
+    recorder = recorder or default_recorder
+    chunks = iter(chunks)
+    while True:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        except BaseException:
+            recorder.record(StageEvent(
+                name, time.perf_counter() - wall, time.thread_time() - cpu,
+                error=True))
+            raise
+        recorder.record(StageEvent(
+            name, time.perf_counter() - wall, time.thread_time() - cpu,
+            len(chunk)))
+        yield chunk
+
+
+# Recorder shared by all transfers in a process.
+default_recorder = Recorder()
@@ -0,0 +1,147 @@
+"""Process-wide limits on bandwidth and request rates.
+
+All transfers of a process share one `Limiter`, whatever the number of
+threads or stores: storage transfers take tokens for the bytes they send and
+receive, and DRS requests take a token each. Limits are token buckets, which
+let short bursts through and hold the average rate to the configured one.
+"""
+from dataclasses import dataclass, fields
+import threading
+import time
+
+from .telemetry import default_recorder, THROTTLE_BYTES, THROTTLE_REQUESTS
+
+
+@dataclass
+class RateLimits:
+    """Limits shared by all transfers of a process.
+
+    May be set from the `limits` section of the configuration file. Limits
+    that are not set (or set to 0) do not apply.
+
+    """
+    bytes_per_second: float = None  # Storage data, sent and received
+    requests_per_second: float = None  # Requests to the DRS server
+    burst: float = 1.0  # Seconds of traffic that may be sent at once
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create limits from a (configuration file) dictionary.
+
+        Raises:
+            ValueError: if the dictionary contains unknown or negative
+                limits.
+
+        """
+        known = {f.name for f in fields(cls)}
+        unknown = set(data) - known
+        if unknown:
+            raise ValueError(
+                f"Unknown limits: {', '.join(sorted(unknown))}")
+        limits = cls(**data)
+        for name in known:
+            value = getattr(limits, name)
+            if value is not None and value < 0:
+                raise ValueError(f"Limit {name} must not be negative")
+        return limits
+
+
+class TokenBucket:
+    """Thread-safe token bucket.
+
+    Tokens accrue at `rate` per second, up to `capacity`. Taking more tokens
+    than the bucket holds puts it in debt, which later callers wait out in
+    turn: callers are served in the order they came, and a request larger
+    than the capacity is let through on its own.
+
+    """
+
+    def __init__(self, rate=None, capacity=None, clock=time.monotonic):
+        """Create a new bucket, full.
+
+        Args:
+            rate (float, optional): Tokens per second; unlimited if None
+                or 0.
+            capacity (float, optional): Maximum number of tokens held.
+                Defaults to one second's worth.
+            clock (callable): Returns the current time, in seconds.
+
+        """
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.configure(rate, capacity)
+
+    def configure(self, rate=None, capacity=None):
+        """Change the rate and capacity, and fill the bucket."""
+        with self._lock:
+            self.rate = rate or None
+            self.capacity = capacity or rate or 0
+            self._tokens = self.capacity
+            self._updated = self._clock()
+
+    def reserve(self, amount=1):
+        """Take tokens, and return how long to wait before using them.
+
+        Returns:
+            delay (float): Seconds to wait; 0 if the tokens are available.
+
+        """
+        if self.rate is None:
+            return 0.0
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, amount=1):
+        """Take tokens, waiting until they are available.
+
+        Returns:
+            delay (float): Seconds waited.
+
+        """
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class Limiter:
+    """Bandwidth and request rate limits of a process."""
+
+    def __init__(self):
+        self.bandwidth = TokenBucket()
+        self.requests = TokenBucket()
+
+    def configure(self, limits):
+        """Apply limits (a `RateLimits`), replacing the previous ones."""
+        bandwidth = limits.bytes_per_second
+        requests = limits.requests_per_second
+        self.bandwidth.configure(
+            bandwidth, bandwidth * limits.burst if bandwidth else None)
+        self.requests.configure(
+            requests, max(1, requests * limits.burst) if requests else None)
+
+    def throttle_bytes(self, nbytes):
+        """Wait until nbytes of storage data may be transferred."""
+        delay = self.bandwidth.reserve(nbytes)
+        if delay > 0:
+            with default_recorder.stage(THROTTLE_BYTES, nbytes):
+                time.sleep(delay)
+
+    def throttle_request(self):
+        """Wait until a request to the DRS server may be sent."""
+        delay = self.requests.reserve()
+        if delay > 0:
+            with default_recorder.stage(THROTTLE_REQUESTS):
+                time.sleep(delay)
+
+
+# Limiter shared by all transfers in a process; unlimited until configured.
+default_limiter = Limiter()
@@ -1,19 +1,29 @@
 """Crypt4gh-related utilities for the uploader client."""
 
 from base64 import b64decode
+import hashlib
 import logging
 import os
-from pathlib import Path
 
 import click
 
-from .drs import DRSClient, DRSMetadata
-from .store import BucketStore
+from .drs import DEFAULT_POOL_SIZE, DRSClient, DRSMetadata
+from .files import compute_sha256, DEFAULT_CHUNK_SIZE, DigestEngine
+from .journal import UploadJournal
+from .store import BucketStore, TransferSettings
+from .telemetry import default_recorder, ENCRYPT, HASH, READ, timed
 
-from crypt4gh_common import encrypt as _encrypt, get_seckey
+from crypt4gh_common import (
+    CIPHER_SEGMENT_SIZE, Encryptor, key_registry, SEGMENT_SIZE)
 
 logger = logging.getLogger(__name__)
 
+# Prefix of content-addressed markers of uploaded objects.
+_DEDUP_PREFIX = ".dedup/sha-256/"
+
+# Generous bound on the size of crypt4gh headers, when sizing parts.
+_MAX_HEADER_SIZE = 64 * 1024
+
 
 class KeyError(Exception):
     """Generic error if server pubkey could not be loaded."""
@@ -21,42 +31,332 @@ class KeyError(Exception):
 
 def upload_and_register(
         filename, drs_url, storage_url, bucket,
-        encrypt=True, client_sk=None, desc=""):
+        encrypt=True, client_sk=None, desc="", transfer=None,
+        journal_dir=None, dedup=False, index=None, name=None, progress=None):
     """Upload file to storage and register DRS metadata.
 
+    The file is read once: (encrypted) data is streamed to storage while
+    its checksum and size are accumulated for the DRS metadata, so no
+    encrypted copy of the file is written to disk. The file may also be
+    a stream of unknown size, such as standard input.
+
+    With a journal directory, uploads of files larger than one part are
+    resumable: rerunning an interrupted upload of an unchanged file skips
+    the parts that were already stored.
+
     Args:
-        filename (str) : the path to the file to upload.
+        filename (str or file object) : the path to the file to upload, or
+            a binary stream to upload until its end.
         drs_url (str) : the URL of the DRS server.
         storage_url (str) : the URL of the file storage.
         bucket (str) : the storage bucket to use.
         encrypt (bool) : whether to encrypt the file prior to upload.
         client_sk (str) : the path to the private key of the client.
         desc (str) : an optional description of the object.
+        transfer (TransferSettings) : optional multipart transfer settings.
+        journal_dir (str) : optional directory for upload journals.
+        dedup (bool) : whether to skip files whose content was uploaded
+            before, returning the DRS ID of the existing object.
+        index (ObjectIndex) : optional local index of uploaded files and
+            content. Files that did not change since they were uploaded to
+            the same server and bucket are skipped without being read.
+        name (str) : the name of the object, by default that of the file;
+            required for streams. Encrypted objects get a ".crypt4gh"
+            suffix.
+        progress (callable) : optionally called with the number of bytes of
+            the file read and sent on for upload, as the upload proceeds.
+            Reads run ahead of storage by at most the parts in flight.
+            Files that are skipped are reported whole at once.
 
     Returns:
         drs_id (str) : the DRS ID of the uploaded object.
 
     """
-    drs_client = DRSClient(drs_url)
-    # Encrypt byte data
-    if encrypt:
-        server_pubkey, client_seckey = _load_crypt4gh_keys(
-            drs_client, client_sk)
-        filename = _encrypt_crypt4gh_file(
-            filename, client_seckey, server_pubkey)
+    uploader = Uploader(
+        drs_url, storage_url, bucket, encrypt=encrypt, client_sk=client_sk,
+        transfer=transfer, journal_dir=journal_dir, dedup=dedup, index=index)
+    return uploader.upload(filename, desc=desc, name=name, progress=progress)
+
+
+class Uploader:
+    """Upload and register files, sharing clients and keys between uploads.
+
+    Uploading many files through one uploader fetches the server public key
+    and loads the client secret key once, and reuses the connections of a
+    single DRS client and storage client. Uploads may run concurrently from
+    several threads.
+
+    """
+
+    def __init__(self, drs_url, storage_url, bucket,
+                 encrypt=True, client_sk=None, transfer=None,
+                 journal_dir=None, max_connections=None, dedup=False,
+                 index=None):
+        """Create a new uploader.
+
+        See `upload_and_register` for the arguments. `max_connections`
+        sizes the storage and DRS connection pools; the former should hold
+        a connection per part in flight across all concurrent uploads.
+
+        With `dedup`, the plaintext of each file is hashed first, in a
+        separate pass. If an object with the same content was registered
+        before, by this or any other client, the file is neither encrypted
+        nor uploaded. Previous uploads are found in the local `index`, or
+        through a content-addressed marker in the bucket.
+
+        With an `index`, the digest of every uploaded file is remembered
+        along with its size, modification time and inode. While these do not
+        change, the file is known by its digest without being read again:
+        it is skipped if it was uploaded before, and not hashed again for
+        deduplication.
+
+        Streams are always uploaded, as they can only be read once, and
+        uploads of streams are never resumed. Their digest is computed on
+        the way, and recorded for the deduplication of later uploads.
+
+        """
+        self._transfer = transfer or TransferSettings()
+        self._drs_client = DRSClient(
+            drs_url, pool_size=max(DEFAULT_POOL_SIZE, max_connections or 0),
+            adaptive=self._transfer.adaptive_concurrency)
+        self._encrypt = encrypt
+        if encrypt:
+            self._server_pubkey, self._client_seckey = _load_crypt4gh_keys(
+                self._drs_client, client_sk)
+
+        self._bucket = bucket
+        self._store_client = BucketStore(
+            bucket, endpoint=storage_url, transfer=self._transfer,
+            max_connections=max_connections)
+        self._journal_dir = journal_dir
+        self._dedup = dedup
+        self._index = index
+
+    def upload(self, filename, desc="", name=None, progress=None):
+        """Upload a file to storage and register its DRS metadata.
+
+        See `upload_and_register` for the arguments.
+
+        Returns:
+            drs_id (str) : the DRS ID of the uploaded object.
+
+        """
+        if hasattr(filename, "read"):
+            return self._upload_stream(filename, desc, name, progress)
+
+        name = self._object_name(name or os.path.basename(filename))
+        stat = os.stat(filename)
+        digest = None
+        if self._index is not None:
+            digest = self._index.file_digest(filename)
+        if digest is None and self._dedup:
+            with default_recorder.stage(HASH, stat.st_size):
+                digest = compute_sha256(filename)
+            if self._index is not None:
+                self._index.record_file(filename, digest, stat)
+        if digest is not None:
+            drs_id = self._find_duplicate(digest)
+            if drs_id is not None:
+                logger.info("%s was registered before as %s; skipping it",
+                            filename, drs_id)
+                if progress is not None:
+                    progress(stat.st_size)
+                return drs_id
+
+        journal = None
+        if self._journal_dir is not None and \
+                os.path.getsize(filename) >= self._transfer.part_size:
+            journal = _open_journal(self._journal_dir, filename,
+                                    self._bucket, name, self._store_client)
+
+        result = journal.result if journal is not None else None
+        if result is None:
+            with open(filename, "rb") as fp:
+                result = self._upload(fp, name, journal,
+                                      hash_plaintext=digest is None,
+                                      progress=progress, size=stat.st_size)
+            if "digest" in result:
+                digest = result.pop("digest")
+                if self._index is not None:
+                    self._index.record_file(filename, digest, stat)
+            if journal is not None:
+                journal.record_result(**result)
+        else:
+            logger.info("%s was uploaded before; registering it", filename)
+            if progress is not None:
+                progress(stat.st_size)
+
+        meta_id = self._register(name, result, desc)
+        if journal is not None:
+            journal.delete()
+        if digest is not None and (self._dedup or self._index is not None):
+            self._record_duplicate(digest, name, meta_id)
+        return meta_id
+
+    def _upload_stream(self, fp, desc, name, progress):
+        """Upload and register a stream; see `upload`."""
+        if not name:
+            raise ValueError("A name is required to upload a stream")
+        name = self._object_name(name)
+        track = self._dedup or self._index is not None
+        result = self._upload(fp, name, None, hash_plaintext=track,
+                              progress=progress)
+        digest = result.pop("digest", None)
+        meta_id = self._register(name, result, desc)
+        if digest is not None:
+            self._record_duplicate(digest, name, meta_id)
+        return meta_id
+
+    def _object_name(self, name):
+        return name + ".crypt4gh" if self._encrypt else name
+
+    def _register(self, name, result, desc):
+        """Register DRS metadata for an uploaded object; return its ID."""
+        metadata = DRSMetadata(
+            name=name,
+            checksum=result["checksum"],
+            size=result["size"],
+            url=_create_s3_resource_url(self._bucket, name),
+            description=desc,
+        )
+        return self._drs_client.post_metadata(metadata)
+
+    def _find_duplicate(self, digest):
+        """Return the DRS ID of an object with the given plaintext digest."""
+        index_key = (digest, self._encrypt, self._drs_client.url, self._bucket)
+        if self._index is not None:
+            drs_id = self._index.lookup(*index_key)
+            if drs_id is not None:
+                return drs_id
+        if not self._dedup:
+            return None
+
+        marker = self._store_client.object_metadata(
+            _dedup_key(digest, self._encrypt))
+        # Markers are shared by all servers registering objects of the
+        # bucket, but IDs are only known to the server that issued them.
+        if not marker or "drs-id" not in marker \
+                or marker.get("drs-url") != self._drs_client.url:
+            return None
+        if self._index is not None:
+            self._index.record(
+                *index_key, marker.get("name", ""), marker["drs-id"])
+        return marker["drs-id"]
+
+    def _record_duplicate(self, digest, name, drs_id):
+        """Make an uploaded object findable by its plaintext digest."""
+        if self._dedup:
+            self._store_client.put_marker(
+                _dedup_key(digest, self._encrypt),
+                {"drs-id": drs_id, "name": name,
+                 "drs-url": self._drs_client.url})
+        if self._index is not None:
+            self._index.record(digest, self._encrypt, self._drs_client.url,
+                               self._bucket, name, drs_id)
 
-    # Upload byte data to storage server
-    store_client = BucketStore(bucket, endpoint=storage_url)
-    store_client.upload_file(filename)
-    resource_url = _create_s3_resource_url(
-        bucket, os.path.basename(filename))
+    def _upload(self, fp, name, journal, hash_plaintext=False,
+                progress=None, size=None):
+        """Stream file data to storage; return its checksum and size.
 
-    # Upload metadata to DRS-filer
-    metadata = DRSMetadata.from_file(
-        filename, url=resource_url, description=desc)
+        With `hash_plaintext`, the SHA-256 digest of the file is returned
+        too, computed as it is read for the upload. The size of the file,
+        if known, sets the size of the parts it is uploaded in.
 
-    meta_id = drs_client.post_metadata(metadata)
-    return meta_id
+        """
+        digests = DigestEngine()
+        if hash_plaintext:
+            fp = _HashingReader(fp)
+        # Encrypt byte data
+        if self._encrypt:
+            encryptor = _create_encryptor(
+                self._client_seckey, self._server_pubkey, journal)
+            chunks = timed(encryptor.iter_encrypted(
+                fp, workers=self._transfer.encryption_workers,
+                progress=progress), ENCRYPT)
+        else:
+            chunks = timed(_read_chunks(fp, progress), READ)
+
+        if size is not None and self._encrypt:
+            size = _encrypted_size(size)
+
+        # Upload byte data to storage server, digesting it on the way
+        self._store_client.upload_stream(
+            _digested(chunks, digests), name, journal=journal, size=size)
+        digest_result = digests.result()
+        result = {
+            "checksum": digest_result.digests["sha-256"],
+            "size": digest_result.size,
+        }
+        if hash_plaintext:
+            result["digest"] = fp.hexdigest()
+        return result
+
+
+def _encrypted_size(size):
+    """Return an upper bound of the size of a file once encrypted."""
+    segments = -(-size // SEGMENT_SIZE)
+    return size + segments * (CIPHER_SEGMENT_SIZE - SEGMENT_SIZE) \
+        + _MAX_HEADER_SIZE
+
+
+def _open_journal(journal_dir, filename, bucket, name, store_client):
+    """Open the upload journal, discarding it if the file changed."""
+    journal = UploadJournal.open(journal_dir, filename, bucket, name)
+    if journal.stale:
+        logger.info("%s changed since its last upload attempt; "
+                    "starting over", filename)
+        if journal.upload_id:
+            store_client.abort_upload(name, journal.upload_id)
+        journal.reset()
+    return journal
+
+
+def _create_encryptor(client_seckey, server_pubkey, journal):
+    """Create an encryptor, reusing the state of an interrupted upload."""
+    if journal is not None and journal.encryption:
+        return Encryptor.from_state(journal.encryption)
+    encryptor = Encryptor(client_seckey, server_pubkey)
+    if journal is not None:
+        journal.encryption = encryptor.state
+    return encryptor
+
+
+def _read_chunks(fp, progress):
+    """Yield the data of a file in chunks, reporting their size."""
+    for chunk in iter(lambda: fp.read(DEFAULT_CHUNK_SIZE), b""):
+        if progress is not None:
+            progress(len(chunk))
+        yield chunk
+
+
+def _digested(chunks, digests):
+    """Pass chunks through, feeding them to a digest engine."""
+    for chunk in chunks:
+        with default_recorder.stage(HASH, len(chunk)):
+            digests.update(chunk)
+        yield chunk
+
+
+class _HashingReader:
+    """Binary file wrapper hashing the data read through it."""
+
+    def __init__(self, fp):
+        self._fp = fp
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self._hash.update(data)
+        return data
+
+    def readinto(self, buf):
+        nbytes = self._fp.readinto(buf)
+        if nbytes:
+            self._hash.update(memoryview(buf)[:nbytes])
+        return nbytes
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
 
 
 def _load_crypt4gh_keys(client, client_sk):
@@ -69,7 +369,7 @@ def _load_crypt4gh_keys(client, client_sk):
             "advertise a Crypt4gh public key.")
 
     try:
-        client_seckey = get_seckey(client_sk)
+        client_seckey = key_registry.seckey(client_sk)
     except Exception:
         raise click.ClickException(
             f"Could not load client secret key from location: {client_sk}."
@@ -81,30 +381,35 @@ def _load_crypt4gh_keys(client, client_sk):
 def _get_server_pubkey(client):
     """Retrieve server public key, advertised in /service-info.
 
+    The key is kept in the key registry for a while, so that it is not
+    fetched for every upload.
+
     Args:
         client (DRSClient) : DRS server client
 
     Returns:
         The public key of the server.
     """
-    try:
+    def fetch():
         crypt4gh_info = client.get_service_info()["crypt4gh"]
         pubkey_b64 = crypt4gh_info["pubkey"]
-        pubkey_decoded = b64decode(pubkey_b64)
         logger.info("Loaded server public key: %s", pubkey_b64)
+        return b64decode(pubkey_b64)
+
+    try:
+        return key_registry.fetch(("server-pubkey", client.url), fetch)
     except Exception as e:
         raise KeyError() from e
-    return pubkey_decoded
 
 
-def _create_s3_resource_url(bucket, filename):
-    return f"s3://{bucket}/{filename}"
+def _dedup_key(digest, encrypt):
+    """Content-addressed key of the marker of an uploaded object.
 
+    Encrypted and plain uploads of the same content are different objects.
+
+    """
+    return _DEDUP_PREFIX + digest + (".crypt4gh" if encrypt else "")
 
-def _encrypt_crypt4gh_file(filename, client_seckey, server_pubkey):
-    """Encrypt file with given server/client keys."""
-    filename = Path(filename)
-    filename_enc = filename.with_suffix(filename.suffix + ".crypt4gh")
-    with open(filename, "rb") as orig, open(filename_enc, "wb") as enc:
-        _encrypt(client_seckey, server_pubkey, orig, enc)
-    return str(filename_enc)
+
+def _create_s3_resource_url(bucket, filename):
+    return f"s3://{bucket}/{filename}"
@@ -1,7 +1,17 @@
+import hashlib
+import io
 import pathlib
 
+from botocore.exceptions import ClientError
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, PublicFormat)
 import pytest
 
+from crypt4gh_common import encrypt_stream, get_seckey, key_registry
+
+from drs_client import store
+
 
 SERVICE_INFO_PLAIN = {
     "contactUrl": "contact/abc",
@@ -31,6 +41,14 @@ SERVICE_INFO_CRYPT4GH = {
 }
 
 
+@pytest.fixture(autouse=True)
+def clear_key_registry():
+    """Do not let keys fetched by one test leak into the next."""
+    key_registry.clear()
+    yield
+    key_registry.clear()
+
+
 def _configure_drs_filer(requests_mock, json):
     requests_mock.post("https://DRS/ga4gh/drs/v1/objects", text="\"dummy_id\"")
     requests_mock.get("https://DRS/ga4gh/drs/v1/service-info", json=json)
@@ -62,6 +80,20 @@ def client_sk():
     return _datapath("client-sk.key")
 
 
+@pytest.fixture
+def encrypt_for_client(client_sk):
+    """Encrypt data for the client itself, returning the client seckey."""
+    seckey = get_seckey(client_sk)
+    pubkey = X25519PrivateKey.from_private_bytes(seckey).public_key() \
+        .public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+    def encrypt(plaintext):
+        return b"".join(encrypt_stream(seckey, pubkey, io.BytesIO(plaintext)))
+
+    encrypt.seckey = seckey
+    return encrypt
+
+
 @pytest.fixture
 def server_pk():
     return _datapath("server-pk.key")
@@ -75,3 +107,84 @@ def recipient_pk():
 @pytest.fixture
 def service_info_crypt4gh():
     return SERVICE_INFO_CRYPT4GH
+
+
+class MockBotoClient:
+    """In-memory stand-in for the parts of the S3 API that we use."""
+
+    def __init__(self):
+        self.objects = {}
+        self.parts = {}
+        self.aborted = []
+        self.attempts = {}
+        self.ranges = []
+        self.metadata = {}
+
+    def generate_presigned_url(self, *args, **kwds):
+        return "http://example.com/myfile.txt?Expiry=3600"
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError(
+                {"Error": {"Code": "404", "Message": "Not Found"}},
+                "HeadObject")
+        return {"ContentLength": len(self.objects[Key]),
+                "Metadata": self.metadata.get(Key, {})}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = map(int, Range[len("bytes="):].split("-"))
+        self.ranges.append((start, end))
+        return {"Body": io.BytesIO(self.objects[Key][start:end + 1])}
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):
+        self.objects[Key] = Body
+        self.metadata[Key] = Metadata or {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.parts[Key] = {}
+        return {"UploadId": "upload-" + Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        attempt = self.attempts[Body] = self.attempts.get(Body, 0) + 1
+        if Body == b"fail" or (Body == b"flaky" and attempt == 1):
+            raise IOError("connection reset")
+        if Body == b"busy" and attempt == 1:
+            raise ClientError(
+                {"Error": {"Code": "SlowDown"}}, "UploadPart")
+        self.parts[Key][PartNumber] = Body
+        return {"ETag": _etag(Body)}
+
+    def list_parts(self, Bucket, Key, UploadId, **kwds):
+        if Key not in self.parts:
+            raise ClientError(
+                {"Error": {"Code": "NoSuchUpload"}}, "ListParts")
+        return {"Parts": [
+            {"PartNumber": number, "ETag": _etag(body)}
+            for number, body in self.parts[Key].items()
+        ]}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        parts = self.parts.pop(Key)
+        self.objects[Key] = b"".join(
+            parts[p["PartNumber"]] for p in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.parts.pop(Key, None)
+        self.aborted.append(UploadId)
+
+
+def _etag(body):
+    return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+@pytest.fixture
+def mock_boto3(monkeypatch):
+
+    client = MockBotoClient()
+
+    def configure_client(*args, **kwargs):
+        return client
+
+    monkeypatch.setattr(store, "_configure_client", configure_client)
+    return client
@@ -0,0 +1,330 @@
+import asyncio
+import hashlib
+import io
+import time
+
+import click
+import pytest
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("aiobotocore")
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from drs_client import aio  # noqa: E402
+from drs_client.drs import DRSMetadata  # noqa: E402
+from drs_client.store import TransferSettings  # noqa: E402
+
+
+class MockAsyncBotoClient:
+    """Async view of a MockBotoClient, as an aiobotocore client."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        async def call(*args, **kwds):
+            response = method(*args, **kwds)
+            if isinstance(response, dict) and "Body" in response:
+                response["Body"] = _AsyncBody(response["Body"])
+            return response
+
+        return call
+
+
+class _AsyncBody:
+
+    def __init__(self, fp):
+        self._fp = fp
+
+    async def read(self):
+        return self._fp.read()
+
+
+class _ClientContext:
+
+    def __init__(self, client):
+        self._client = client
+
+    async def __aenter__(self):
+        return self._client
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+@pytest.fixture
+def mock_aiobotocore(monkeypatch, mock_boto3):
+    mock_boto3._client_config = type("Config", (), {})()
+    client = MockAsyncBotoClient(mock_boto3)
+    monkeypatch.setattr(
+        aio, "_configure_client", lambda *args: _ClientContext(client))
+    return mock_boto3
+
+
+def _drs_filer(service_info):
+    """Start a DRS-filer lookalike, recording registered objects."""
+    registered = []
+
+    async def post_object(request):
+        data = await request.json()
+        if data["name"] == "bad":
+            return web.Response(status=400)
+        registered.append(data)
+        return web.Response(text=f'"id-{len(registered)}"')
+
+    async def get_service_info(request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.json_response(service_info, headers={"ETag": '"v1"'})
+
+    app = web.Application()
+    app.router.add_post("/ga4gh/drs/v1/objects", post_object)
+    app.router.add_get("/ga4gh/drs/v1/service-info", get_service_info)
+    server = TestServer(app)
+    server.registered = registered
+    return server
+
+
+def test_post_metadata_many(service_info_crypt4gh):
+
+    async def run():
+        async with _drs_filer(service_info_crypt4gh) as server:
+            async with aio.AsyncDRSClient(str(server.make_url("/"))) as client:
+                metadata = [
+                    DRSMetadata(name=name, checksum="0", size=1,
+                                url="s3://b/o")
+                    for name in ("a", "bad", "c")]
+                return await client.post_metadata_many(metadata)
+
+    # WHEN
+    results = asyncio.run(run())
+
+    # THEN (results are in input order, with per-object errors)
+    assert results[0].drs_id and results[2].drs_id
+    assert results[1].drs_id is None and results[1].error is not None
+
+
+def test_get_service_info_revalidates(service_info_crypt4gh):
+
+    async def run():
+        async with _drs_filer(service_info_crypt4gh) as server:
+            async with aio.AsyncDRSClient(str(server.make_url("/"))) as client:
+                return [await client.get_service_info() for _ in range(2)]
+
+    # WHEN/THEN (the cached copy is returned on 304)
+    assert asyncio.run(run()) == [service_info_crypt4gh] * 2
+
+
+def _slow_server(delays):
+    """Start a server answering its n-th request after delays[n] seconds."""
+    requests = []
+
+    async def respond(request):
+        requests.append(request.method)
+        await asyncio.sleep(delays[len(requests) - 1])
+        return web.Response(text='"id-1"')
+
+    app = web.Application()
+    app.router.add_route("*", "/ga4gh/drs/v1/objects", respond)
+    app.router.add_route("*", "/ga4gh/drs/v1/objects/{id}", respond)
+    server = TestServer(app)
+    server.requests = requests
+    return server
+
+
+def test_get_retries_timeouts():
+
+    # GIVEN (a server answering the first request too late)
+    server = _slow_server([1, 0])
+
+    async def run():
+        async with server:
+            async with aio.AsyncDRSClient(
+                    str(server.make_url("/")), timeout=(1, 0.2),
+                    backoff=0) as client:
+                return await client.get_object("id-1")
+
+    # WHEN
+    result = asyncio.run(run())
+
+    # THEN
+    assert result == "id-1"
+    assert server.requests == ["GET", "GET"]
+
+
+def test_post_not_retried_after_timeouts():
+
+    # GIVEN (a server answering the first registration too late)
+    server = _slow_server([1, 0])
+    metadata = DRSMetadata(name="a", checksum="0", size=1, url="s3://b/o")
+
+    async def run():
+        async with server:
+            async with aio.AsyncDRSClient(
+                    str(server.make_url("/")), timeout=(1, 0.2),
+                    backoff=0) as client:
+                await client.post_metadata(metadata)
+
+    # WHEN/THEN (the registration may have gone through: not resent)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+    assert server.requests == ["POST"]
+
+
+@pytest.mark.parametrize("size", [10, 200000])
+def test_upload_stream_and_download(tmp_path, mock_aiobotocore, size):
+
+    # GIVEN
+    data = bytes(range(256)) * (size // 256 + 1)
+    transfer = TransferSettings(part_size=70000, max_concurrency=3)
+    chunks = [data[i:i + 1000] for i in range(0, len(data), 1000)]
+
+    async def run():
+        async with aio.AsyncBucketStore("bucket", transfer=transfer) as store:
+            await store.upload_stream(iter(chunks), "obj")
+            await store.download_file("obj", tmp_path / "obj")
+
+    # WHEN
+    asyncio.run(run())
+
+    # THEN
+    assert mock_aiobotocore.objects["obj"] == data
+    assert (tmp_path / "obj").read_bytes() == data
+
+
+def test_upload_stream_aborts_on_failure(mock_aiobotocore):
+
+    # GIVEN (a part that always fails)
+    transfer = TransferSettings(part_size=4, part_retries=1,
+                                retry_backoff=0)
+
+    async def chunks():
+        for chunk in (b"good", b"fail", b"more"):
+            yield chunk
+
+    async def run():
+        async with aio.AsyncBucketStore("bucket", transfer=transfer) as store:
+            await store.upload_stream(chunks(), "obj")
+
+    # WHEN/THEN
+    with pytest.raises(IOError):
+        asyncio.run(run())
+    assert mock_aiobotocore.aborted == ["upload-obj"]
+
+
+def test_read_range_retries_short_reads(mock_aiobotocore, monkeypatch):
+
+    # GIVEN (a body cut short on the first attempt)
+    mock_aiobotocore.objects["obj"] = b"abcdefg"
+    get_object = mock_aiobotocore.get_object
+    responses = []
+
+    def truncating_get_object(**kwds):
+        response = get_object(**kwds)
+        if not responses:
+            response["Body"] = io.BytesIO(response["Body"].read()[:-1])
+        responses.append(response)
+        return response
+
+    monkeypatch.setattr(mock_aiobotocore, "get_object", truncating_get_object)
+    transfer = TransferSettings(retry_backoff=0)
+
+    async def run():
+        async with aio.AsyncBucketStore("bucket", transfer=transfer) as store:
+            return await store.read_range("obj", 2, 5)
+
+    # WHEN
+    data = asyncio.run(run())
+
+    # THEN
+    assert data == b"cde"
+    assert len(responses) == 2
+
+
+def test_download_file_waits_for_writes_on_failure(
+        tmp_path, mock_aiobotocore, monkeypatch):
+
+    # GIVEN (a part that always fails, while others are slowly written)
+    mock_aiobotocore.objects["obj"] = bytes(40)
+    get_object = mock_aiobotocore.get_object
+
+    def failing_get_object(**kwds):
+        if kwds["Range"].startswith("bytes=30-"):
+            raise IOError("connection reset")
+        return get_object(**kwds)
+
+    errors = []
+
+    class SlowWriter(aio._PositionalWriter):
+
+        def write(self, offset, data):
+            time.sleep(0.05)
+            try:
+                super().write(offset, data)
+            except OSError as e:
+                errors.append(e)
+
+    monkeypatch.setattr(mock_aiobotocore, "get_object", failing_get_object)
+    monkeypatch.setattr(aio, "_PositionalWriter", SlowWriter)
+    transfer = TransferSettings(part_size=10, part_retries=0)
+
+    async def run():
+        async with aio.AsyncBucketStore("bucket", transfer=transfer) as store:
+            await store.download_file("obj", tmp_path / "obj")
+
+    # WHEN/THEN (no write outlived the file)
+    with pytest.raises(IOError, match="connection reset"):
+        asyncio.run(run())
+    assert errors == []
+    assert not (tmp_path / "obj").exists()
+
+
+def test_upload_and_register(
+        tmp_path, mock_aiobotocore, service_info_crypt4gh, client_sk):
+
+    # GIVEN
+    fname = tmp_path / "upload.dat"
+    fname.write_bytes(b"x" * 100000)
+
+    async def run():
+        async with _drs_filer(service_info_crypt4gh) as server:
+            drs_id = await aio.upload_and_register(
+                fname, str(server.make_url("/")), None, "bucket",
+                client_sk=client_sk)
+            return drs_id, server.registered
+
+    # WHEN
+    drs_id, registered = asyncio.run(run())
+
+    # THEN (the encrypted object was stored and registered)
+    data = mock_aiobotocore.objects["upload.dat.crypt4gh"]
+    assert data.startswith(b"crypt4gh")
+    assert drs_id == "id-1"
+    payload, = registered
+    assert payload["size"] == len(data)
+    assert payload["checksums"][0]["checksum"] == \
+        hashlib.sha256(data).hexdigest()
+
+
+def test_uploader_fails_without_client_key(
+        tmp_path, mock_aiobotocore, service_info_crypt4gh):
+
+    # GIVEN
+    fname = tmp_path / "upload.dat"
+    fname.write_bytes(b"x" * 100)
+
+    async def run():
+        async with _drs_filer(service_info_crypt4gh) as server:
+            await aio.upload_and_register(
+                fname, str(server.make_url("/")), None, "bucket",
+                client_sk=str(tmp_path / "does-not-exist.key"))
+
+    # WHEN/THEN
+    with pytest.raises(click.ClickException,
+                       match="Could not load client secret key"):
+        asyncio.run(run())
+    assert mock_aiobotocore.objects == {}
@@ -0,0 +1,114 @@
+import io
+import json
+
+import pytest
+
+from drs_client.batch import (
+    BatchItem, BatchResult, collect_inputs, upload_many, write_result)
+
+
+def test_collect_inputs(tmp_path):
+
+    # GIVEN
+    (tmp_path / "run" / "lane2").mkdir(parents=True)
+    for name in ["run/a.fastq", "run/lane2/b.fastq", "c.fastq", "d.txt"]:
+        (tmp_path / name).write_text("data")
+    manifest = tmp_path / "manifest.tsv"
+    manifest.write_text(
+        "# comment\n"
+        f"{tmp_path / 'd.txt'}\tsome description\n"
+        "\n"
+        f"{tmp_path / 'c.fastq'}\n")
+
+    # WHEN
+    items = collect_inputs(
+        [str(tmp_path / "run"), str(tmp_path / "*.fastq")], str(manifest))
+
+    # THEN (files are listed once, in order)
+    assert items == [
+        BatchItem(str(tmp_path / "run" / "a.fastq"), name="a.fastq"),
+        BatchItem(str(tmp_path / "run" / "lane2" / "b.fastq"),
+                  name="lane2/b.fastq"),
+        BatchItem(str(tmp_path / "c.fastq")),
+        BatchItem(str(tmp_path / "d.txt"), "some description"),
+    ]
+
+
+def test_collect_inputs_keeps_subdirectories_in_names(tmp_path):
+
+    # GIVEN (files of the same name, in different subdirectories)
+    for name in ["run/a/sample.bam", "run/b/sample.bam"]:
+        (tmp_path / name).parent.mkdir(parents=True)
+        (tmp_path / name).write_text("data")
+
+    # WHEN
+    items = collect_inputs([str(tmp_path / "run")])
+
+    # THEN
+    assert [item.object_name for item in items] == [
+        "a/sample.bam", "b/sample.bam"]
+
+
+def test_collect_inputs_rejects_duplicate_names(tmp_path):
+
+    # GIVEN (files of the same name, given one by one)
+    for name in ["a/sample.bam", "b/sample.bam"]:
+        (tmp_path / name).parent.mkdir(parents=True)
+        (tmp_path / name).write_text("data")
+
+    # WHEN/THEN
+    with pytest.raises(ValueError, match="same object"):
+        collect_inputs([str(tmp_path / "*" / "sample.bam")])
+
+
+class FakeUploader:
+
+    def __init__(self):
+        self.names = []
+
+    def upload(self, filename, desc="", name=None, progress=None):
+        if filename == "bad":
+            raise IOError("no such file")
+        self.names.append(name)
+        if progress is not None:
+            progress(len(filename))
+        return f"id-{filename}"
+
+
+def test_upload_many():
+
+    # GIVEN
+    items = [BatchItem(name) for name in ["a", "bad"]] + [
+        BatchItem("dir/c", name="sub/c")]
+    uploader = FakeUploader()
+
+    # WHEN
+    results = list(upload_many(uploader, items, workers=2))
+
+    # THEN
+    assert sorted(results, key=lambda r: r.filename) == [
+        BatchResult("a", drs_id="id-a"),
+        BatchResult("bad", error="no such file"),
+        BatchResult("dir/c", drs_id="id-dir/c"),
+    ]
+    assert sorted(uploader.names) == ["a", "sub/c"]
+
+
+def test_write_result():
+
+    # GIVEN
+    ok = BatchResult("a", drs_id="id-a")
+    failed = BatchResult("b", error="failed\twith\nwhitespace")
+
+    # WHEN
+    tsv, jsonl = io.StringIO(), io.StringIO()
+    for result in [ok, failed]:
+        write_result(result, tsv, "tsv")
+        write_result(result, jsonl, "jsonl")
+
+    # THEN
+    assert tsv.getvalue() == "a\tid-a\t\nb\t\tfailed with whitespace\n"
+    assert [json.loads(line) for line in jsonl.getvalue().splitlines()] == [
+        {"filename": "a", "drs_id": "id-a", "error": None},
+        {"filename": "b", "drs_id": None, "error": "failed\twith\nwhitespace"},
+    ]
@@ -1,7 +1,12 @@
+import hashlib
+import json
 import os
+import subprocess
+import sys
 
 import pytest
 
+
 from drs_client import upload
 from drs_client.client import cli, ConfigManager
 
@@ -13,8 +18,8 @@ class MockBucketStore:
     def __init__(self, *args, **kwds):
         pass
 
-    def upload_file(self, fname):
-        self.call_args.append(fname)
+    def upload_stream(self, chunks, name, journal=None, size=None):
+        self.call_args.append((name, b"".join(chunks)))
         return "http://example.com/myfile"
 
 
@@ -92,14 +97,22 @@ def test_upload_encrypt(
     # THEN (a) check that command exited normally
     assert result.exit_code == 0
 
-    # THEN (b) check that bytes were uploaded
+    # THEN (b) check that encrypted bytes were uploaded
     assert len(dummy_bucket_store.call_args) == 1
-    assert dummy_bucket_store.call_args[0].endswith("upload.txt.crypt4gh")
+    name, data = dummy_bucket_store.call_args[0]
+    assert name == "upload.txt.crypt4gh"
+    assert data.startswith(b"crypt4gh")
 
     # THEN (c) check that metatadata was registered
     assert dummy_drs_filer.call_count == 2
     payload = dummy_drs_filer.request_history[1].json()
     assert payload["name"] == "upload.txt.crypt4gh"
+    assert payload["size"] == len(data)
+    assert payload["checksums"][0]["checksum"] == \
+        hashlib.sha256(data).hexdigest()
+
+    # THEN (d) check that no encrypted copy was left on disk
+    assert not (tmp_path / "upload.txt.crypt4gh").exists()
 
 
 def test_upload_no_encrypt(
@@ -123,7 +136,7 @@ def test_upload_no_encrypt(
 
     # THEN (b) check that bytes were uploaded
     assert len(dummy_bucket_store.call_args) == 2
-    assert dummy_bucket_store.call_args[1].endswith("upload.txt")
+    assert dummy_bucket_store.call_args[1] == ("upload.txt", b"test")
 
     # THEN (c) check that metatadata was registered
     assert dummy_drs_filer.call_count == 1
@@ -131,6 +144,184 @@ def test_upload_no_encrypt(
     assert payload["name"] == "upload.txt"
 
 
+def test_upload_stats(
+        cli_runner, tmp_path, dummy_bucket_store, dummy_drs_filer, drs_config):
+
+    # GIVEN
+    upload_fname = tmp_path / "upload.txt"
+    _write(upload_fname, "test")
+    metrics_file = tmp_path / "metrics.txt"
+
+    # WHEN
+    result = cli_runner.invoke(
+        cli, [
+            "-c", drs_config,
+            "--stats",
+            "--metrics-file", str(metrics_file),
+            "upload",
+            str(upload_fname),
+            "--no-encrypt"
+        ])
+
+    # THEN (the stages of the upload were reported)
+    assert result.exit_code == 0
+    assert "drs.register" in result.output
+    assert 'stage="hash"' in metrics_file.read_text()
+
+
+def test_upload_progress_json(
+        cli_runner, tmp_path, dummy_bucket_store, dummy_drs_filer, drs_config):
+
+    # GIVEN
+    upload_fname = tmp_path / "upload.txt"
+    _write(upload_fname, "test")
+
+    # WHEN
+    result = cli_runner.invoke(
+        cli, [
+            "-c", drs_config,
+            "upload",
+            str(upload_fname),
+            "--no-encrypt",
+            "--progress", "json",
+        ])
+
+    # THEN (the last progress line reports the whole file)
+    assert result.exit_code == 0
+    records = [json.loads(line) for line in result.output.splitlines()
+               if line.startswith("{")]
+    assert records[-1]["done"] == records[-1]["total"] == 4
+    assert records[-1]["finished"]
+
+
+def test_upload_stdin(
+        cli_runner, dummy_bucket_store, dummy_drs_filer, drs_config):
+
+    # WHEN
+    result = cli_runner.invoke(
+        cli, [
+            "-c", drs_config,
+            "upload",
+            "-",
+            "--name", "piped.txt",
+            "--no-encrypt"
+        ], input=b"piped data")
+
+    # THEN (the stream was uploaded and registered under the given name)
+    assert result.exit_code == 0
+    assert dummy_bucket_store.call_args[-1] == ("piped.txt", b"piped data")
+    payload = dummy_drs_filer.request_history[0].json()
+    assert payload["name"] == "piped.txt"
+    assert payload["size"] == len(b"piped data")
+
+
+def test_upload_stdin_needs_name(cli_runner, drs_config):
+
+    # WHEN
+    result = cli_runner.invoke(
+        cli, ["-c", drs_config, "upload", "-", "--no-encrypt"])
+
+    # THEN
+    assert result.exit_code != 0
+    assert "--name" in result.output
+
+
+def test_upload_batch(
+        cli_runner, tmp_path,
+        dummy_bucket_store, dummy_drs_filer,
+        drs_config, client_sk):
+
+    # GIVEN
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        _write(tmp_path / name, "test")
+
+    # WHEN
+    result = cli_runner.invoke(
+        cli, [
+            "-c", drs_config,
+            "upload-batch",
+            str(tmp_path / "*.txt"),
+            "--client-sk", client_sk,
+            "--workers", "2",
+            "--format", "jsonl",
+        ])
+
+    # THEN (a) check that command exited normally
+    assert result.exit_code == 0
+
+    # THEN (b) check that every file was mapped to a DRS ID
+    mapping = sorted((json.loads(line) for line in result.stdout.splitlines()),
+                     key=lambda m: m["filename"])
+    assert [(m["filename"], m["drs_id"]) for m in mapping] == [
+        (str(tmp_path / name), "dummy_id")
+        for name in ["a.txt", "b.txt", "c.txt"]]
+
+    # THEN (c) check that service info was fetched once for all files
+    methods = [r.method for r in dummy_drs_filer.request_history]
+    assert methods.count("GET") == 1
+    assert methods.count("POST") == 3
+
+
+def test_upload_batch_rejects_duplicate_names(
+        cli_runner, tmp_path, dummy_bucket_store, dummy_drs_filer,
+        drs_config, client_sk):
+
+    # GIVEN
+    for name in ["a", "b"]:
+        (tmp_path / name).mkdir()
+        _write(tmp_path / name / "sample.bam", "test")
+
+    # WHEN
+    result = cli_runner.invoke(
+        cli, [
+            "-c", drs_config,
+            "upload-batch",
+            str(tmp_path / "a" / "sample.bam"),
+            str(tmp_path / "b" / "sample.bam"),
+            "--client-sk", client_sk,
+        ])
+
+    # THEN (nothing was uploaded)
+    assert result.exit_code != 0
+    assert "same object" in result.output
+    assert dummy_drs_filer.request_history == []
+
+
+def test_invalid_limits(cli_runner, tmp_path):
+
+    # GIVEN
+    config = tmp_path / "drs-client.yaml"
+    config.write_text("limits:\n  bytes_per_second: -1\n")
+
+    # WHEN
+    result = cli_runner.invoke(cli, ["-c", str(config), "abort-uploads"])
+
+    # THEN
+    assert result.exit_code != 0
+    assert "Invalid configuration" in result.output
+
+
+@pytest.mark.parametrize("args", [["--help"], ["download", "--help"]])
+def test_help_starts_quickly(tmp_path, args):
+
+    # GIVEN (a new interpreter, running the CLI as its console script does)
+    code = (
+        "import sys\n"
+        "from drs_client.client import cli\n"
+        f"try:\n    cli({args!r})\nexcept SystemExit:\n    pass\n"
+        "print(*sorted(m for m in "
+        "('boto3', 'botocore', 'requests', 'crypt4gh') "
+        "if m in sys.modules))\n")
+
+    # WHEN
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=tmp_path, check=True,
+        capture_output=True, text=True)
+
+    # THEN (none of the slow imports were needed)
+    assert result.stdout.splitlines()[-1] == ""
+
+
 def test_key_needed_for_encrypted_upload(cli_runner, tmp_path):
 
     # GIVEN
@@ -201,6 +392,71 @@ def test_download_file(
     assert os.environ.get("CRYPT4GH_PUBKEY") is not None
 
 
+def test_download_native(
+        cli_runner, tmp_path, requests_mock, mock_boto3, drs_config,
+        dummy_subprocess_run):
+
+    # GIVEN
+    mock_boto3.objects["obj.crypt4gh"] = b"data"
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyzzyx", json={
+        "id": "xyzzyx",
+        "name": "obj.crypt4gh",
+        "size": 4,
+        "access_methods": [{
+            "type": "s3",
+            "access_url": {"url": "s3://BUCKET/obj.crypt4gh"}}],
+    })
+
+    subprocess_calls = len(dummy_subprocess_run.call_args)
+
+    # WHEN
+    result = cli_runner.invoke(
+        cli, [
+            "-c", drs_config,
+            "download",
+            "xyzzyx",
+            "-o", str(tmp_path),
+        ]
+    )
+
+    # THEN (the object was fetched in process)
+    assert result.exit_code == 0
+    assert (tmp_path / "obj.crypt4gh").read_bytes() == b"data"
+    assert len(dummy_subprocess_run.call_args) == subprocess_calls
+
+
+def test_download_decrypted_to_stdout(
+        cli_runner, requests_mock, mock_boto3, drs_config, client_sk,
+        encrypt_for_client):
+
+    # GIVEN
+    data = encrypt_for_client(b"plaintext")
+    mock_boto3.objects["obj.crypt4gh"] = data
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyzzyx", json={
+        "id": "xyzzyx",
+        "name": "obj.crypt4gh",
+        "size": len(data),
+        "access_methods": [{
+            "type": "s3",
+            "access_url": {"url": "s3://BUCKET/obj.crypt4gh"}}],
+    })
+
+    # WHEN
+    result = cli_runner.invoke(
+        cli, [
+            "-c", drs_config,
+            "download",
+            "xyzzyx",
+            "--sk", client_sk,
+            "--stdout",
+        ]
+    )
+
+    # THEN (only the plaintext was written)
+    assert result.exit_code == 0
+    assert result.stdout_bytes == b"plaintext"
+
+
 def _write(fname, text):
     with open(fname, "wt") as fp:
         fp.write(text)
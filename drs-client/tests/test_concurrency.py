@@ -0,0 +1,149 @@
+import threading
+
+import pytest
+
+from drs_client.concurrency import AdaptiveConcurrency
+from drs_client.telemetry import Recorder
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _complete(controller, clock, latency, throttled=False):
+    started = controller.acquire()
+    clock.now += latency
+    controller.release(started, throttled=throttled)
+
+
+def test_limit_grows_while_latency_is_stable():
+
+    # GIVEN
+    clock = FakeClock()
+    controller = AdaptiveConcurrency(16, initial=2, clock=clock)
+
+    # WHEN (two rounds of requests at the same latency)
+    for _ in range(6):
+        _complete(controller, clock, 1.0)
+
+    # THEN (by about one request per round)
+    assert controller.limit == 4
+
+
+def test_limit_stays_within_bounds():
+
+    # GIVEN
+    clock = FakeClock()
+    controller = AdaptiveConcurrency(3, initial=3, min_limit=2, clock=clock)
+
+    # WHEN
+    for _ in range(10):
+        _complete(controller, clock, 1.0)
+    high = controller.limit
+    for _ in range(10):
+        _complete(controller, clock, 1.0, throttled=True)
+
+    # THEN
+    assert (high, controller.limit) == (3, 2)
+
+
+def test_throttling_backs_off_once_per_round():
+
+    # GIVEN (requests in flight when the server starts throttling)
+    clock = FakeClock()
+    controller = AdaptiveConcurrency(16, initial=8, clock=clock)
+    started = [controller.acquire() for _ in range(4)]
+    clock.now += 1.0
+
+    # WHEN
+    for start in started:
+        controller.release(start, throttled=True)
+
+    # THEN (they saw the same congestion, and backed off once)
+    assert controller.limit == 4
+
+    # WHEN (a request started after the backoff is throttled too)
+    clock.now += 0.1
+    _complete(controller, clock, 1.0, throttled=True)
+
+    # THEN
+    assert controller.limit == 2
+
+
+def test_rising_latency_backs_off():
+
+    # GIVEN
+    clock = FakeClock()
+    controller = AdaptiveConcurrency(16, initial=8, clock=clock)
+    _complete(controller, clock, 1.0)
+    limit = controller.limit
+
+    # WHEN (latency rises well above the baseline)
+    for _ in range(10):
+        _complete(controller, clock, 10.0)
+
+    # THEN
+    assert controller.limit < limit
+
+
+def test_failures_leave_limit_unchanged():
+
+    # GIVEN
+    controller = AdaptiveConcurrency(16, initial=8)
+
+    # WHEN
+    with pytest.raises(IOError):
+        with controller.slot():
+            raise IOError("connection reset")
+
+    # THEN
+    assert controller.limit == 8
+
+
+def test_slot_classifies_exceptions():
+
+    # GIVEN
+    recorder = Recorder()
+    controller = AdaptiveConcurrency(
+        16, initial=8, stage="s3.put", recorder=recorder,
+        is_throttling=lambda exc: "SlowDown" in str(exc))
+
+    # WHEN
+    with pytest.raises(RuntimeError):
+        with controller.slot():
+            raise RuntimeError("SlowDown")
+
+    # THEN (the decision is visible in the telemetry)
+    stats = recorder.snapshot()["s3.put"]
+    assert (stats.concurrency, stats.backoffs) == (4, 1)
+    assert 'stage_concurrency_limit{stage="s3.put"} 4' \
+        in recorder.openmetrics()
+
+
+def test_requests_wait_for_a_slot():
+
+    # GIVEN (a controller allowing a single request in flight)
+    controller = AdaptiveConcurrency(1)
+    holding = controller.slot()
+    holding.__enter__()
+    entered = threading.Event()
+
+    def request():
+        with controller.slot():
+            entered.set()
+
+    thread = threading.Thread(target=request)
+
+    # WHEN
+    thread.start()
+    waited = not entered.wait(0.05)
+    holding.__exit__(None, None, None)
+    thread.join(1)
+
+    # THEN
+    assert waited and entered.is_set()
@@ -0,0 +1,166 @@
+from io import BytesIO
+import hashlib
+
+import pytest
+
+from crypt4gh_common import EncryptionError
+from drs_client.download import (
+    download_decrypted, download_object, DownloadError, read_range)
+from drs_client.store import TransferSettings
+
+DATA = b"encrypted object data"
+
+
+def _drs_object(url="s3://bucket/obj.crypt4gh", checksum=None, data=DATA):
+    return {
+        "id": "xyzzyx",
+        "name": "obj.crypt4gh",
+        "size": len(data),
+        "checksums": [{
+            "checksum": checksum or hashlib.sha256(data).hexdigest(),
+            "type": "sha-256",
+        }],
+        "access_methods": [{"type": "s3", "access_url": {"url": url}}],
+    }
+
+
+@pytest.fixture
+def stored_object(mock_boto3):
+    mock_boto3.objects["obj.crypt4gh"] = DATA
+    return mock_boto3
+
+
+def test_download_object(tmp_path, requests_mock, stored_object):
+
+    # GIVEN
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyzzyx",
+                      json=_drs_object())
+
+    # WHEN
+    path = download_object(
+        "xyzzyx", "https://DRS", None, dest_dir=tmp_path, verify=True)
+
+    # THEN
+    assert path == str(tmp_path / "obj.crypt4gh")
+    assert (tmp_path / "obj.crypt4gh").read_bytes() == DATA
+
+
+def test_download_object_checksum_mismatch(
+        tmp_path, requests_mock, stored_object):
+
+    # GIVEN
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyzzyx",
+                      json=_drs_object(checksum="0" * 64))
+
+    # WHEN/THEN
+    with pytest.raises(DownloadError, match="Checksum mismatch"):
+        download_object(
+            "xyzzyx", "https://DRS", None, dest_dir=tmp_path, verify=True)
+
+
+def test_download_object_without_s3_access(tmp_path, requests_mock):
+
+    # GIVEN
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyzzyx",
+                      json=_drs_object(url="https://example.com/obj"))
+
+    # WHEN/THEN
+    with pytest.raises(DownloadError, match="no S3 access method"):
+        download_object("xyzzyx", "https://DRS", None, dest_dir=tmp_path)
+
+
+@pytest.fixture
+def encrypted_object(mock_boto3, encrypt_for_client):
+    plaintext = bytes(range(256)) * 1000
+    data = encrypt_for_client(plaintext)
+    mock_boto3.objects["obj.crypt4gh"] = data
+    return encrypt_for_client.seckey, plaintext, data
+
+
+def test_download_decrypted(requests_mock, encrypted_object):
+
+    # GIVEN
+    seckey, plaintext, data = encrypted_object
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyzzyx",
+                      json=_drs_object(data=data))
+    output = BytesIO()
+
+    # WHEN (parts of two segments, so that the object spans several parts)
+    size = download_decrypted(
+        "xyzzyx", "https://DRS", None, seckey, output,
+        transfer=TransferSettings(part_size=2 * 65564), verify=True)
+
+    # THEN
+    assert output.getvalue() == plaintext
+    assert size == len(plaintext)
+
+
+def test_download_object_decrypted(
+        tmp_path, requests_mock, encrypted_object):
+
+    # GIVEN
+    seckey, plaintext, data = encrypted_object
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyzzyx",
+                      json=_drs_object(data=data))
+
+    # WHEN
+    path = download_object(
+        "xyzzyx", "https://DRS", None, dest_dir=tmp_path, seckey=seckey)
+
+    # THEN (only the plaintext was saved)
+    assert path == str(tmp_path / "obj")
+    assert (tmp_path / "obj").read_bytes() == plaintext
+    assert not (tmp_path / "obj.crypt4gh").exists()
+
+
+def test_download_decrypted_wrong_key(requests_mock, encrypted_object):
+
+    # GIVEN
+    _, _, data = encrypted_object
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyzzyx",
+                      json=_drs_object(data=data))
+
+    # WHEN/THEN
+    with pytest.raises(EncryptionError):
+        download_decrypted(
+            "xyzzyx", "https://DRS", None, bytes(32), BytesIO())
+
+
+@pytest.mark.parametrize("offset,length", [
+    (0, 10),
+    (65530, 20),  # Across a segment boundary
+    (255990, 1000),  # Past the end of the object
+    (10, 0),
+])
+def test_read_range(requests_mock, encrypted_object, offset, length):
+
+    # GIVEN
+    seckey, plaintext, data = encrypted_object
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyzzyx",
+                      json=_drs_object(data=data))
+
+    # WHEN
+    result = read_range(
+        "xyzzyx", "https://DRS", None, seckey, offset, length)
+
+    # THEN
+    assert result == plaintext[offset:offset + length]
+
+
+def test_read_range_fetches_needed_segments(
+        requests_mock, encrypted_object, mock_boto3):
+
+    # GIVEN (a range within the third segment)
+    seckey, plaintext, data = encrypted_object
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyzzyx",
+                      json=_drs_object(data=data))
+
+    # WHEN
+    result = read_range(
+        "xyzzyx", "https://DRS", None, seckey, 2 * 65536 + 100, 50)
+
+    # THEN (only the header and that segment were fetched)
+    assert result == plaintext[2 * 65536 + 100:2 * 65536 + 150]
+    header_fetch, segment_fetch = mock_boto3.ranges
+    start, end = segment_fetch
+    assert end - start + 1 == 65564
@@ -1,6 +1,11 @@
 import datetime
 
+import pytest
+from requests import HTTPError
+
+from drs_client import drs
 from drs_client.drs import DRSClient, DRSMetadata, _create_request_data
+from drs_client.telemetry import default_recorder
 
 
 def _is_iso8601(s):
@@ -25,6 +30,22 @@ def test_drs_metadata(tmp_path):
     assert drs_metadata.size == 14
 
 
+def test_drs_metadata_extra_checksums(tmp_path):
+    # GIVEN
+    fname = tmp_path / "test.txt"
+    _write(fname, "test file data")
+
+    # WHEN
+    drs_metadata = DRSMetadata.from_file(
+        fname, checksum_types=("sha-256", "md5"))
+    rdata = _create_request_data(drs_metadata)
+
+    # THEN
+    assert drs_metadata.checksums == {
+        "md5": "5f6cab6a42503a2044a5d43377e71769"}
+    assert [c["type"] for c in rdata["checksums"]] == ["sha-256", "md5"]
+
+
 def test_create_request_data():
 
     # GIVEN
@@ -76,6 +97,98 @@ def test_get_service_info(dummy_drs_filer, service_info_crypt4gh):
     assert actual == service_info_crypt4gh
 
 
+def test_get_service_info_revalidates(requests_mock, service_info_crypt4gh):
+
+    # GIVEN (a server that tags service info with an ETag)
+    url = "https://DRS/ga4gh/drs/v1/service-info"
+    requests_mock.get(url, json=service_info_crypt4gh,
+                      headers={"ETag": '"v1"'})
+    drs_client = DRSClient("https://DRS")
+    drs_client.get_service_info()
+    requests_mock.get(url, status_code=304)
+
+    # WHEN
+    actual = drs_client.get_service_info()
+
+    # THEN (the cached copy was revalidated)
+    assert actual == service_info_crypt4gh
+    assert requests_mock.last_request.headers["If-None-Match"] == '"v1"'
+
+
+def test_post_metadata_many(requests_mock):
+
+    # GIVEN (a server that rejects one of the objects)
+    def register(request, context):
+        name = request.json()["name"]
+        if name == "bad":
+            context.status_code = 400
+            return "invalid"
+        return f'"id-{name}"'
+
+    requests_mock.post("https://DRS/ga4gh/drs/v1/objects", text=register)
+    drs_client = DRSClient("https://DRS")
+    metadata = [DRSMetadata(name=name, checksum="0", size=1, url="s3://b/o")
+                for name in ("a", "bad", "c")]
+
+    # WHEN
+    results = drs_client.post_metadata_many(metadata, workers=2)
+
+    # THEN (results are in input order, with per-object errors)
+    assert [r.drs_id for r in results] == ["id-a", None, "id-c"]
+    assert results[1].error is not None
+
+
+def test_registrations_adapt_concurrency(requests_mock):
+
+    # GIVEN
+    requests_mock.post("https://DRS/ga4gh/drs/v1/objects", status_code=503)
+    drs_client = DRSClient("https://DRS", pool_size=8, retries=0,
+                           adaptive=True)
+    default_recorder.reset()
+
+    # WHEN
+    with pytest.raises(HTTPError):
+        drs_client.post_metadata(
+            DRSMetadata(name="a", checksum="0", size=1, url="s3://b/o"))
+
+    # THEN (the server turned the registration down)
+    stats = default_recorder.snapshot()["drs.register"]
+    assert (stats.concurrency, stats.backoffs) == (1, 1)
+
+
+def test_requests_are_throttled(requests_mock, monkeypatch):
+
+    # GIVEN
+    requests_mock.get("https://DRS/ga4gh/drs/v1/objects/xyz", json={})
+    throttled = []
+    monkeypatch.setattr(drs.default_limiter, "throttle_request",
+                        lambda: throttled.append(True))
+
+    # WHEN
+    DRSClient("https://DRS").get_object("xyz")
+
+    # THEN
+    assert throttled == [True]
+
+
+@pytest.mark.parametrize("method,status,retried", [
+    ("GET", 500, True),
+    ("GET", 429, True),
+    ("GET", 404, False),
+    ("POST", 503, True),
+    ("POST", 429, True),
+    ("POST", 500, False),  # The object may have been registered
+])
+def test_retry_policy(method, status, retried):
+
+    # GIVEN
+    drs_client = DRSClient("https://DRS", retries=2)
+    retry = drs_client._session.get_adapter("https://DRS").max_retries
+
+    # WHEN/THEN
+    assert retry.is_retry(method, status) == retried
+
+
 def _write(fname, text):
     with open(fname, "wt") as fp:
         fp.write(text)
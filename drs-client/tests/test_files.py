@@ -1,4 +1,11 @@
-from drs_client.files import compute_sha256
+import hashlib
+from io import BytesIO
+
+import pytest
+
+from drs_client import files
+from drs_client.files import (
+    compute_digests, compute_sha256, DigestEngine, register_algorithm)
 
 
 def test_compute_sha256(tmp_path):
@@ -10,6 +17,54 @@ def test_compute_sha256(tmp_path):
     assert compute_sha256(fname) == "1be7aaf1938cc19af7d2fdeb48a11c381dff8a98d4c4b47b3b0a5044a5255c04"  # noqa
 
 
+def test_compute_digests_single_pass(tmp_path):
+    # GIVEN (a file spanning several chunks)
+    fname = tmp_path / "test.txt"
+    _write(fname, "test file data" * 1000)
+
+    # WHEN
+    result = compute_digests(fname, ("sha-256", "md5"), chunk_size=64)
+
+    # THEN
+    assert result.size == 14000
+    assert result.digests["sha-256"] == "3911b6867039bded4844cccc8aff942d7589fea0d545e7d15d56665c5f5b86dc"  # noqa
+    assert result.digests["md5"] == \
+        hashlib.md5(b"test file data" * 1000).hexdigest()
+    assert result.throughput >= 0
+
+
+def test_digest_engine_crc32c():
+    pytest.importorskip("crc32c")
+
+    # GIVEN
+    engine = DigestEngine(("crc32c",))
+
+    # WHEN (feed data from a file object)
+    engine.update_from_file(BytesIO(b"123456789"), chunk_size=4)
+
+    # THEN (the standard CRC-32C check value)
+    assert engine.result().digests["crc32c"] == "e3069283"
+
+
+def test_digest_engine_unknown_algorithm():
+    with pytest.raises(ValueError, match="Unsupported checksum type"):
+        DigestEngine(("sha-1024",))
+
+
+def test_register_algorithm(monkeypatch):
+    # GIVEN (a registry restored after the test)
+    monkeypatch.setattr(files, "_ALGORITHMS", dict(files._ALGORITHMS))
+    register_algorithm("sha-512", hashlib.sha512)
+
+    # WHEN
+    engine = DigestEngine(("sha-512",))
+    engine.update(b"abc")
+
+    # THEN
+    assert engine.result().digests["sha-512"] == \
+        hashlib.sha512(b"abc").hexdigest()
+
+
 def _write(fname, text):
     with open(fname, "wt") as fp:
         fp.write(text)
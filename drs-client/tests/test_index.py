@@ -0,0 +1,33 @@
+from drs_client.index import ObjectIndex
+
+
+def test_object_index(tmp_path):
+
+    # GIVEN
+    index = ObjectIndex(str(tmp_path / "cache" / "index.sqlite"))
+
+    # WHEN
+    index.record("abc", True, "https://DRS", "bucket", "f.crypt4gh", "id1")
+    index.close()
+    index = ObjectIndex(str(tmp_path / "cache" / "index.sqlite"))
+
+    # THEN (the object is found again, for the same upload mode only)
+    assert index.lookup("abc", True, "https://DRS", "bucket") == "id1"
+    assert index.lookup("abc", False, "https://DRS", "bucket") is None
+    assert index.lookup("abc", True, "https://DRS", "other") is None
+
+
+def test_file_digest(tmp_path):
+
+    # GIVEN
+    fname = tmp_path / "data.txt"
+    fname.write_bytes(b"data")
+    index = ObjectIndex(":memory:")
+
+    # WHEN
+    index.record_file(str(fname), "abc")
+
+    # THEN (the digest is known until the file changes)
+    assert index.file_digest(str(fname)) == "abc"
+    fname.write_bytes(b"other data")
+    assert index.file_digest(str(fname)) is None
@@ -0,0 +1,68 @@
+import os
+import stat
+
+from drs_client.journal import iter_journals, UploadJournal
+
+
+def test_journal_roundtrip(tmp_path):
+
+    # GIVEN
+    source = tmp_path / "source.dat"
+    source.write_bytes(b"data")
+    journal_dir = tmp_path / "journals"
+    journal = UploadJournal.open(journal_dir, source, "bucket", "obj")
+
+    # WHEN
+    journal.encryption = {"session_key": "00"}
+    journal.start("upload-id", 1024)
+    journal.record_part(2, '"etag-2"')
+    journal.record_part(1, '"etag-1"')
+    reopened = UploadJournal.open(journal_dir, source, "bucket", "obj")
+
+    # THEN
+    assert not reopened.stale
+    assert reopened.upload_id == "upload-id"
+    assert reopened.part_size == 1024
+    assert reopened.parts == {1: '"etag-1"', 2: '"etag-2"'}
+    assert reopened.encryption == {"session_key": "00"}
+    assert stat.S_IMODE(os.stat(journal.path).st_mode) == 0o600
+
+
+def test_journal_stale_when_source_changes(tmp_path):
+
+    # GIVEN
+    source = tmp_path / "source.dat"
+    source.write_bytes(b"data")
+    journal = UploadJournal.open(tmp_path, source, "bucket", "obj")
+    journal.start("upload-id", 1024)
+
+    # WHEN
+    source.write_bytes(b"other data")
+    reopened = UploadJournal.open(tmp_path, source, "bucket", "obj")
+
+    # THEN
+    assert reopened.stale
+    reopened.reset()
+    assert reopened.upload_id is None
+
+
+def test_iter_journals(tmp_path):
+
+    # GIVEN (one valid and one corrupt journal)
+    source = tmp_path / "source.dat"
+    source.write_bytes(b"data")
+    journal = UploadJournal.open(tmp_path, source, "bucket", "obj")
+    journal.start("upload-id", 1024)
+    (tmp_path / "corrupt.json").write_text("{")
+
+    # WHEN
+    journals = list(iter_journals(tmp_path))
+
+    # THEN
+    assert [j.upload_id for j in journals] == ["upload-id"]
+
+    # WHEN (delete the journal)
+    journals[0].delete()
+
+    # THEN
+    assert list(iter_journals(tmp_path)) == []
@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+
+from drs_client.progress import (
+    format_duration, format_size, JSONLinesDisplay, ProgressState,
+    ProgressTracker, TerminalDisplay)
+
+
+def test_tracker_aggregates_threads():
+
+    # GIVEN
+    tracker = ProgressTracker(total=1000, interval=0)
+    states = []
+    tracker.subscribe(states.append)
+
+    # WHEN (reports from several threads)
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(tracker, [10] * 100))
+    tracker.close()
+
+    # THEN (the final state has all bytes)
+    assert states[-1].done == 1000
+    assert states[-1].finished
+    assert states[-1].fraction == 1.0
+
+
+def test_tracker_total_may_grow():
+
+    # GIVEN
+    tracker = ProgressTracker()
+
+    # WHEN
+    tracker(5)
+    unknown = tracker.state()
+    tracker.add_total(20)
+
+    # THEN
+    assert unknown.total is None and unknown.fraction is None
+    assert tracker.state().fraction == 0.25
+
+
+def test_eta():
+    state = ProgressState(done=100, total=300, rate=50.0)
+    assert state.eta == 4.0
+
+
+def test_terminal_display():
+
+    # GIVEN
+    stream = io.StringIO()
+    display = TerminalDisplay(stream)
+
+    # WHEN
+    display(ProgressState(done=2_500_000, total=10_000_000, rate=1e6))
+    display(ProgressState(done=10_000_000, total=10_000_000, elapsed=10,
+                          finished=True))
+
+    # THEN (a single line, updated in place)
+    lines = stream.getvalue().split("\r")
+    assert lines[1].startswith("2.5 MB / 10.0 MB (25%)  1.0 MB/s  ETA 00:07")
+    assert lines[2].rstrip(" \n").endswith("in 00:10")
+    assert lines[2].endswith("\n")
+
+
+def test_json_lines_display():
+
+    # GIVEN
+    stream = io.StringIO()
+
+    # WHEN
+    JSONLinesDisplay(stream)(ProgressState(done=10, total=40, rate=5.0))
+
+    # THEN
+    record = json.loads(stream.getvalue())
+    assert record["done"] == 10 and record["total"] == 40
+    assert record["eta"] == 6.0
+
+
+def test_format():
+    assert format_size(999) == "999 B"
+    assert format_size(1_500_000_000) == "1.5 GB"
+    assert format_duration(3725) == "1:02:05"
@@ -1,68 +1,350 @@
+import io
+
 import pytest
 
-from drs_client import store
-from drs_client.store import BucketStore
+from drs_client import store as store_module
+from drs_client.journal import UploadJournal
+from drs_client.store import (
+    _iter_parts, BucketStore, DEFAULT_PART_SIZE, fitting_part_size,
+    TransferSettings)
+from drs_client.telemetry import default_recorder
 
 
-class MockBotoClient:
+def test_upload_file(tmp_path, mock_boto3):
 
-    upload_file_call_args = []
-    download_file_call_args = []
+    # GIVEN
+    fname = tmp_path / "test.txt"
+    _touch(fname)
 
-    def generate_presigned_url(self, *args, **kwds):
-        return "http://example.com/myfile.txt?Expiry=3600"
+    store = BucketStore("bucket")
 
-    def upload_file(self, *args, **kwds):
-        self.upload_file_call_args.append((args, kwds))
+    # WHEN
+    obj_url = store.upload_file(fname, "file.txt")
 
-    def download_file(self, *args, **kwds):
-        self.download_file_call_args.append((args, kwds))
+    # THEN
+    assert obj_url == "http://example.com/myfile.txt?Expiry=3600"
+    assert mock_boto3.objects["file.txt"] == b""
 
 
-@pytest.fixture
-def mock_boto3(monkeypatch):
+def test_upload_file_multipart(tmp_path, mock_boto3):
 
-    client = MockBotoClient()
+    # GIVEN
+    fname = tmp_path / "test.txt"
+    fname.write_bytes(b"abcdefg")
 
-    def configure_client(*args, **kwargs):
-        return client
+    store = BucketStore("bucket", transfer=TransferSettings(part_size=3))
 
-    monkeypatch.setattr(store, "_configure_client", configure_client)
-    return client
+    # WHEN
+    store.upload_file(fname)
 
+    # THEN
+    assert mock_boto3.objects["test.txt"] == b"abcdefg"
+    assert mock_boto3.attempts == {b"abc": 1, b"def": 1, b"g": 1}
 
-def test_upload_file(tmp_path, mock_boto3):
 
-    # GIVEN
-    fname = tmp_path / "test.txt"
-    _touch(fname)
+def test_upload_stream_single_part(mock_boto3):
 
+    # GIVEN
     store = BucketStore("bucket")
 
     # WHEN
-    obj_url = store.upload_file(fname, "file.txt")
+    obj_url = store.upload_stream(iter([b"ab", b"cd"]), "file.txt")
 
     # THEN
     assert obj_url == "http://example.com/myfile.txt?Expiry=3600"
-    assert len(mock_boto3.upload_file_call_args) == 1
-    assert mock_boto3.upload_file_call_args[0][0] == (
-        fname, "bucket", "file.txt"
-    )
+    assert mock_boto3.objects["file.txt"] == b"abcd"
+    assert mock_boto3.attempts == {}
+
+
+def test_upload_stream_multipart(mock_boto3):
+
+    # GIVEN
+    store = BucketStore("bucket")
+
+    # WHEN
+    store.upload_stream(iter([b"ab", b"cd", b"e"]), "file.txt", part_size=2)
+
+    # THEN
+    assert mock_boto3.objects["file.txt"] == b"abcde"
+    assert mock_boto3.attempts == {b"ab": 1, b"cd": 1, b"e": 1}
+
+
+def test_upload_stream_aborts_on_error(mock_boto3):
+
+    # GIVEN
+    store = BucketStore(
+        "bucket", transfer=TransferSettings(retry_backoff=0))
+
+    # WHEN/THEN
+    with pytest.raises(IOError):
+        store.upload_stream(iter([b"abcd", b"fail"]), "file.txt",
+                            part_size=4)
+    assert mock_boto3.aborted == ["upload-file.txt"]
+    assert mock_boto3.attempts[b"fail"] == 4
+    assert "file.txt" not in mock_boto3.objects
+
+
+@pytest.mark.parametrize("use_threads", [True, False])
+def test_upload_stream_retries_part(mock_boto3, use_threads):
+
+    # GIVEN
+    store = BucketStore("bucket", transfer=TransferSettings(
+        retry_backoff=0, use_threads=use_threads))
+    default_recorder.reset()
+
+    # WHEN
+    store.upload_stream(
+        iter([b"abcde", b"flaky", b"vwxyz"]), "file.txt", part_size=5)
+
+    # THEN (only the failed part was sent twice)
+    assert mock_boto3.objects["file.txt"] == b"abcdeflakyvwxyz"
+    assert mock_boto3.attempts == {b"abcde": 1, b"flaky": 2, b"vwxyz": 1}
+    stats = default_recorder.snapshot()["s3.put"]
+    assert (stats.count, stats.nbytes, stats.retries) == (3, 15, 1)
+
+
+def test_upload_stream_adapts_concurrency(mock_boto3):
+
+    # GIVEN
+    store = BucketStore("bucket", transfer=TransferSettings(
+        retry_backoff=0, max_concurrency=8, adaptive_concurrency=True))
+    default_recorder.reset()
+
+    # WHEN (the server turns down a part)
+    store.upload_stream(
+        iter([b"abcd", b"busy", b"wxyz"]), "file.txt", part_size=4)
+
+    # THEN (the upload backed off, and went through)
+    assert mock_boto3.objects["file.txt"] == b"abcdbusywxyz"
+    stats = default_recorder.snapshot()["s3.put"]
+    assert stats.backoffs == 1
+    assert 1 <= stats.concurrency < 8
+
+
+@pytest.mark.parametrize("use_threads", [False, True])
+def test_upload_stream_progress(mock_boto3, use_threads):
+
+    # GIVEN
+    store = BucketStore("bucket", transfer=TransferSettings(
+        use_threads=use_threads))
+    reported = []
+
+    # WHEN
+    store.upload_stream(
+        iter([b"ab", b"cd", b"e"]), "file.txt", part_size=2,
+        progress=reported.append)
+
+    # THEN (every stored part was reported)
+    assert sorted(reported) == [1, 2, 2]
+
+
+def test_upload_stream_bounded_inflight(mock_boto3):
+
+    # GIVEN (room for a single part in flight)
+    store = BucketStore("bucket", transfer=TransferSettings(
+        part_size=1, max_concurrency=4, max_inflight_bytes=1))
+
+    # WHEN
+    store.upload_stream(iter([b"a", b"b", b"c", b"d"]), "file.txt")
+
+    # THEN
+    assert mock_boto3.objects["file.txt"] == b"abcd"
+
+
+def test_upload_stream_resumes_from_journal(tmp_path, mock_boto3):
+
+    # GIVEN (an upload that fails on its second part)
+    source = tmp_path / "source.dat"
+    source.write_bytes(b"abcdeflakyvwxyz")
+    store = BucketStore("bucket", transfer=TransferSettings(
+        part_retries=0, use_threads=False))
+    journal = UploadJournal.open(tmp_path, source, "bucket", "file.txt")
+    with pytest.raises(IOError):
+        store.upload_stream(iter([b"abcde", b"flaky", b"vwxyz"]),
+                            "file.txt", part_size=5, journal=journal)
+    assert mock_boto3.aborted == []
+
+    # WHEN (rerun the upload, reading the data in other chunks)
+    journal = UploadJournal.open(tmp_path, source, "bucket", "file.txt")
+    store.upload_stream(iter([b"abc", b"deflakyvw", b"xyz"]), "file.txt",
+                        part_size=5, journal=journal)
+
+    # THEN (parts were cut at the same offsets, and the first part was not
+    # sent again)
+    assert mock_boto3.objects["file.txt"] == b"abcdeflakyvwxyz"
+    assert mock_boto3.attempts == {b"abcde": 1, b"flaky": 2, b"vwxyz": 1}
+
+
+def test_upload_stream_restarts_vanished_upload(tmp_path, mock_boto3):
 
+    # GIVEN (a journal referring to an upload that no longer exists)
+    source = tmp_path / "source.dat"
+    source.write_bytes(b"abcd")
+    journal = UploadJournal.open(tmp_path, source, "bucket", "file.txt")
+    journal.start("upload-gone", 2)
+    journal.record_part(1, '"etag"')
+    store = BucketStore("bucket")
+
+    # WHEN
+    store.upload_stream(iter([b"ab", b"cd"]), "file.txt",
+                        part_size=2, journal=journal)
+
+    # THEN (all parts were sent to a new upload)
+    assert mock_boto3.objects["file.txt"] == b"abcd"
+    assert mock_boto3.attempts == {b"ab": 1, b"cd": 1}
+    assert journal.upload_id == "upload-file.txt"
+
+
+def test_transfer_settings_from_dict():
+
+    # WHEN
+    settings = TransferSettings.from_dict(
+        {"part_size": 16 * 1024 * 1024, "max_concurrency": 32})
+
+    # THEN
+    assert settings.part_size == 16 * 1024 * 1024
+    assert settings.max_concurrency == 32
+    assert settings.max_inflight_parts == 16
+
+    # WHEN/THEN
+    with pytest.raises(ValueError, match="Unknown transfer settings"):
+        TransferSettings.from_dict({"part_sise": 1})
+    with pytest.raises(ValueError, match="part_size must be between"):
+        TransferSettings.from_dict({"part_size": 1024 * 1024})
+
+
+def test_part_size_fits_max_parts():
+    assert fitting_part_size(1000) == DEFAULT_PART_SIZE
+    assert fitting_part_size(200 * 10 ** 9) == 20 * 1024 * 1024
+    assert fitting_part_size(200 * 10 ** 9, 64 * 1024 * 1024) == \
+        64 * 1024 * 1024
+
+
+def test_parts_of_unknown_streams_grow(monkeypatch):
+
+    # GIVEN
+    monkeypatch.setattr(store_module, "_PARTS_PER_SIZE", 2)
+
+    # WHEN
+    parts = list(_iter_parts(iter([b"x" * 7, b"x" * 13]), 2, grow=True))
+
+    # THEN (sizes double every two parts)
+    assert [len(part) for part in parts] == [2, 2, 4, 4, 8]
+
+
+def test_upload_stream_of_known_size(mock_boto3, monkeypatch):
+
+    # GIVEN (a stream that would take too many parts of the given size)
+    monkeypatch.setattr(store_module, "MAX_PARTS", 2)
+    store = BucketStore("bucket")
+
+    # WHEN
+    store.upload_stream(iter([b"ab", b"cd", b"e"]), "file.txt", part_size=2,
+                        size=5)
+
+    # THEN (larger parts were used; here, a single one)
+    assert mock_boto3.objects["file.txt"] == b"abcde"
+    assert mock_boto3.attempts == {}
+
+
+def test_download_file(tmp_path, mock_boto3):
+
+    # GIVEN
+    mock_boto3.objects["fileid"] = b"abcdefg"
+    store = BucketStore("bucket", transfer=TransferSettings(part_size=3))
+
+    # WHEN
+    store.download_file("fileid", tmp_path / "save.txt")
+
+    # THEN
+    assert (tmp_path / "save.txt").read_bytes() == b"abcdefg"
+    assert sorted(mock_boto3.ranges) == [(0, 2), (3, 5), (6, 6)]
+
+
+class RecordingLimiter:
+
+    def __init__(self):
+        self.nbytes = []
+
+    def throttle_bytes(self, nbytes):
+        self.nbytes.append(nbytes)
+
+
+def test_transfers_are_throttled(tmp_path, mock_boto3, monkeypatch):
+
+    # GIVEN
+    limiter = RecordingLimiter()
+    monkeypatch.setattr(store_module, "default_limiter", limiter)
+    store = BucketStore("bucket", transfer=TransferSettings(part_size=3))
+
+    # WHEN
+    store.upload_stream(iter([b"abcdefg"]), "fileid")
+    store.download_file("fileid", tmp_path / "save.txt")
+
+    # THEN (all bytes sent and received took tokens)
+    assert sum(limiter.nbytes) == 2 * len(b"abcdefg")
+
+
+def test_download_empty_file(tmp_path, mock_boto3):
+
+    # GIVEN
+    mock_boto3.objects["fileid"] = b""
+    store = BucketStore("bucket")
 
-def test_download_file(mock_boto3):
+    # WHEN
+    store.download_file("fileid", tmp_path / "save.txt")
+
+    # THEN
+    assert (tmp_path / "save.txt").read_bytes() == b""
+    assert mock_boto3.ranges == []
+
+
+def test_read_range(mock_boto3):
 
     # GIVEN
+    mock_boto3.objects["fileid"] = b"abcdefg"
     store = BucketStore("bucket")
 
+    # WHEN/THEN
+    assert store.read_range("fileid", 2, 5) == b"cde"
+
+
+def test_read_range_retries_short_reads(mock_boto3, monkeypatch):
+
+    # GIVEN
+    mock_boto3.objects["fileid"] = b"abcdefg"
+    get_object = mock_boto3.get_object
+    responses = []
+
+    def truncating_get_object(**kwds):
+        response = get_object(**kwds)
+        if not responses:
+            response["Body"] = io.BytesIO(response["Body"].read()[:-1])
+        responses.append(response)
+        return response
+
+    monkeypatch.setattr(mock_boto3, "get_object", truncating_get_object)
+    store = BucketStore(
+        "bucket", transfer=TransferSettings(retry_backoff=0))
+
     # WHEN
-    store.download_file("fileid", "path/to/save.txt")
+    data = store.read_range("fileid", 2, 5)
 
     # THEN
-    assert len(mock_boto3.download_file_call_args) == 1
-    assert mock_boto3.download_file_call_args[0][0] == (
-        "bucket", "fileid", "path/to/save.txt"
-    )
+    assert data == b"cde"
+    assert len(responses) == 2
+
+
+def test_read_range_fails_on_persistent_short_reads(mock_boto3):
+
+    # GIVEN
+    mock_boto3.objects["fileid"] = b"abc"
+    store = BucketStore(
+        "bucket", transfer=TransferSettings(retry_backoff=0, part_retries=1))
+
+    # WHEN/THEN
+    with pytest.raises(IOError, match="Short read"):
+        store.read_range("fileid", 2, 5)
 
 
 def _touch(fname):
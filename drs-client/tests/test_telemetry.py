@@ -0,0 +1,60 @@
+import pytest
+
+from drs_client.telemetry import Recorder, StageEvent, timed
+
+
+def test_recorder_aggregates_stages():
+
+    # GIVEN
+    recorder = Recorder()
+    events = []
+    recorder.subscribe(events.append)
+
+    # WHEN
+    with recorder.stage("s3.put", 100):
+        pass
+    with recorder.stage("s3.put") as span:
+        span.nbytes = 50
+    with pytest.raises(ValueError):
+        with recorder.stage("drs.register"):
+            raise ValueError()
+    recorder.retry("s3.put", 2)
+
+    # THEN
+    stats = recorder.snapshot()
+    assert stats["s3.put"].count == 2
+    assert stats["s3.put"].nbytes == 150
+    assert stats["s3.put"].retries == 2
+    assert stats["drs.register"].errors == 1
+    assert [event.stage for event in events] == \
+        ["s3.put", "s3.put", "drs.register"]
+
+
+def test_timed():
+
+    # GIVEN
+    recorder = Recorder()
+
+    # WHEN
+    chunks = list(timed([b"abc", b"de"], "encrypt", recorder))
+
+    # THEN (one operation per chunk)
+    assert chunks == [b"abc", b"de"]
+    stats = recorder.snapshot()["encrypt"]
+    assert (stats.count, stats.nbytes) == (2, 5)
+
+
+def test_openmetrics():
+
+    # GIVEN
+    recorder = Recorder()
+    recorder.record(StageEvent("hash", wall=0.5, cpu=0.25, nbytes=1000))
+
+    # WHEN
+    text = recorder.openmetrics()
+
+    # THEN
+    assert 'drs_client_stage_bytes_total{stage="hash"} 1000' in text
+    assert 'drs_client_stage_cpu_seconds_total{stage="hash"} 0.25' in text
+    assert "# UNIT drs_client_stage_wall_seconds seconds" in text
+    assert text.endswith("# EOF\n")
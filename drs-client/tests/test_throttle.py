@@ -0,0 +1,92 @@
+import pytest
+
+from drs_client import throttle
+from drs_client.telemetry import Recorder, THROTTLE_BYTES
+from drs_client.throttle import Limiter, RateLimits, TokenBucket
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_unlimited_bucket():
+    assert TokenBucket().reserve(10 ** 12) == 0.0
+
+
+def test_bucket_allows_bursts_up_to_capacity():
+
+    # GIVEN
+    clock = FakeClock()
+    bucket = TokenBucket(rate=100, capacity=50, clock=clock)
+
+    # WHEN
+    delays = [bucket.reserve(25) for _ in range(3)]
+
+    # THEN (the third reservation waits for the tokens it lacks)
+    assert delays == [0.0, 0.0, 0.25]
+
+
+def test_bucket_serves_callers_in_turn():
+
+    # GIVEN (an empty bucket)
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, clock=clock)
+    bucket.reserve(10)
+
+    # WHEN (several callers ask at once, one larger than the capacity)
+    delays = [bucket.reserve(5), bucket.reserve(20), bucket.reserve(5)]
+
+    # THEN (each waits for those before it)
+    assert delays == [0.5, 2.5, 3.0]
+
+
+def test_bucket_refills_over_time():
+
+    # GIVEN
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, clock=clock)
+    bucket.reserve(10)
+
+    # WHEN
+    clock.now = 100.0
+
+    # THEN (to its capacity only)
+    assert bucket.reserve(10) == 0.0
+    assert bucket.reserve(1) == pytest.approx(0.1)
+
+
+def test_limiter_records_waits(monkeypatch):
+
+    # GIVEN
+    recorder = Recorder()
+    monkeypatch.setattr(throttle, "default_recorder", recorder)
+    monkeypatch.setattr(throttle.time, "sleep", lambda delay: None)
+    limiter = Limiter()
+    limiter.configure(RateLimits(bytes_per_second=1000, burst=0.5))
+
+    # WHEN
+    limiter.throttle_bytes(400)
+    limiter.throttle_bytes(400)
+    limiter.throttle_request()
+
+    # THEN (only the wait is recorded, and requests are not limited)
+    stats = recorder.snapshot()
+    assert stats[THROTTLE_BYTES].count == 1
+    assert stats[THROTTLE_BYTES].nbytes == 400
+    assert len(stats) == 1
+
+
+def test_limits_from_dict():
+    limits = RateLimits.from_dict({"bytes_per_second": 1e6})
+    assert limits.bytes_per_second == 1e6
+    assert limits.requests_per_second is None
+
+    with pytest.raises(ValueError, match="Unknown limits: bandwidth"):
+        RateLimits.from_dict({"bandwidth": 1e6})
+    with pytest.raises(ValueError, match="must not be negative"):
+        RateLimits.from_dict({"requests_per_second": -1})
@@ -1,12 +1,18 @@
 from base64 import b64encode
+from io import BytesIO
+import hashlib
+import os
 
 import click
 import pytest
 
 from crypt4gh_common import get_pubkey, get_seckey
 
-from drs_client.upload import _get_server_pubkey, _load_crypt4gh_keys, KeyError
+from drs_client.upload import (
+    _get_server_pubkey, _load_crypt4gh_keys, KeyError, upload_and_register)
 from drs_client.drs import DRSClient
+from drs_client.index import ObjectIndex
+from drs_client.store import TransferSettings
 
 
 def test_get_server_pubkey(dummy_drs_filer, service_info_crypt4gh):
@@ -22,6 +28,19 @@ def test_get_server_pubkey(dummy_drs_filer, service_info_crypt4gh):
         service_info_crypt4gh["crypt4gh"]["pubkey"]
 
 
+def test_get_server_pubkey_is_cached(dummy_drs_filer):
+
+    # GIVEN (the key was fetched by another client of the same server)
+    _get_server_pubkey(DRSClient("https://DRS"))
+    requests = len(dummy_drs_filer.request_history)
+
+    # WHEN
+    _get_server_pubkey(DRSClient("https://DRS"))
+
+    # THEN (service info was not fetched again)
+    assert len(dummy_drs_filer.request_history) == requests
+
+
 def test_get_server_pubkey_not_advertised(dummy_drs_filer_plain):
 
     # GIVEN
@@ -57,3 +76,202 @@ def test_load_crypt4gh(dummy_drs_filer, server_pk, client_sk):
     expected_client_seckey = get_seckey(client_sk)
     assert server_pubkey == expected_server_pubkey
     assert client_seckey == expected_client_seckey
+
+
+def test_upload_and_register_resumes(
+        tmp_path, monkeypatch, mock_boto3, dummy_drs_filer, client_sk):
+
+    # GIVEN (an encrypted upload that fails on its second part)
+    fname = tmp_path / "upload.dat"
+    fname.write_bytes(b"x" * 200000)
+    journal_dir = tmp_path / "journals"
+    transfer = TransferSettings(
+        part_size=70000, part_retries=0, use_threads=False)
+
+    sent = []
+    upload_part = mock_boto3.upload_part
+
+    def failing_upload_part(**kwds):
+        sent.append(kwds["PartNumber"])
+        if sent == [1, 2]:
+            raise IOError("connection reset")
+        return upload_part(**kwds)
+
+    monkeypatch.setattr(mock_boto3, "upload_part", failing_upload_part)
+    with pytest.raises(IOError):
+        upload_and_register(
+            fname, "https://DRS", None, "bucket", client_sk=client_sk,
+            transfer=transfer, journal_dir=journal_dir)
+
+    # WHEN (rerun the upload)
+    drs_id = upload_and_register(
+        fname, "https://DRS", None, "bucket", client_sk=client_sk,
+        transfer=transfer, journal_dir=journal_dir)
+
+    # THEN (a) the first part was not sent again
+    assert drs_id == "dummy_id"
+    assert sent == [1, 2, 2, 3]
+
+    # THEN (b) the registered checksum and size match the stored object
+    data = mock_boto3.objects["upload.dat.crypt4gh"]
+    payload = dummy_drs_filer.last_request.json()
+    assert payload["size"] == len(data)
+    assert payload["checksums"][0]["checksum"] == \
+        hashlib.sha256(data).hexdigest()
+
+    # THEN (c) the journal was cleaned up
+    assert list(journal_dir.iterdir()) == []
+
+
+def test_resume_with_other_encryption_workers(
+        tmp_path, monkeypatch, mock_boto3, dummy_drs_filer, client_sk):
+
+    # GIVEN (an upload encrypting serially that fails on its third part;
+    # parallel encryption produces chunks of another size)
+    fname = tmp_path / "upload.dat"
+    fname.write_bytes(os.urandom(3_000_000))
+    journal_dir = tmp_path / "journals"
+    transfer = TransferSettings(part_size=700_000, part_retries=0,
+                                use_threads=False, encryption_workers=1)
+
+    sent = []
+    upload_part = mock_boto3.upload_part
+
+    def failing_upload_part(**kwds):
+        sent.append(kwds["PartNumber"])
+        if sent == [1, 2, 3]:
+            raise IOError("connection reset")
+        return upload_part(**kwds)
+
+    monkeypatch.setattr(mock_boto3, "upload_part", failing_upload_part)
+    with pytest.raises(IOError):
+        upload_and_register(
+            fname, "https://DRS", None, "bucket", client_sk=client_sk,
+            transfer=transfer, journal_dir=journal_dir)
+
+    # WHEN (rerun the upload with several encryption workers)
+    transfer.encryption_workers = 4
+    upload_and_register(
+        fname, "https://DRS", None, "bucket", client_sk=client_sk,
+        transfer=transfer, journal_dir=journal_dir)
+
+    # THEN (the stored object is the one registered)
+    assert sent[:4] == [1, 2, 3, 3]
+    data = mock_boto3.objects["upload.dat.crypt4gh"]
+    payload = dummy_drs_filer.last_request.json()
+    assert payload["size"] == len(data)
+    assert payload["checksums"][0]["checksum"] == \
+        hashlib.sha256(data).hexdigest()
+
+
+def test_upload_and_register_dedup(
+        tmp_path, mock_boto3, dummy_drs_filer, client_sk):
+
+    # GIVEN (a file that was uploaded before)
+    fname = tmp_path / "upload.dat"
+    fname.write_bytes(b"reference data")
+    index = ObjectIndex(":memory:")
+    drs_id = upload_and_register(
+        fname, "https://DRS", None, "bucket", client_sk=client_sk,
+        dedup=True, index=index)
+    requests = dummy_drs_filer.call_count
+
+    # WHEN (a copy is uploaded, with and without the local index)
+    copy = tmp_path / "copy.dat"
+    copy.write_bytes(b"reference data")
+    from_index = upload_and_register(
+        copy, "https://DRS", None, "bucket", client_sk=client_sk,
+        dedup=True, index=index)
+    from_bucket = upload_and_register(
+        copy, "https://DRS", None, "bucket", client_sk=client_sk,
+        dedup=True)
+
+    # THEN (the existing object was returned, and nothing was uploaded)
+    assert from_index == from_bucket == drs_id
+    assert "copy.dat.crypt4gh" not in mock_boto3.objects
+    assert not any(r.method == "POST"
+                   for r in dummy_drs_filer.request_history[requests:])
+
+
+def test_upload_and_register_dedup_per_server(
+        tmp_path, mock_boto3, dummy_drs_filer, service_info_crypt4gh,
+        client_sk):
+
+    # GIVEN (a file registered with another server, in the same bucket)
+    dummy_drs_filer.post(
+        "https://other-DRS/ga4gh/drs/v1/objects", text="\"other_id\"")
+    dummy_drs_filer.get(
+        "https://other-DRS/ga4gh/drs/v1/service-info",
+        json=service_info_crypt4gh)
+    fname = tmp_path / "upload.dat"
+    fname.write_bytes(b"reference data")
+    other_id = upload_and_register(
+        fname, "https://other-DRS", None, "bucket", client_sk=client_sk,
+        dedup=True)
+
+    # WHEN
+    drs_id = upload_and_register(
+        fname, "https://DRS", None, "bucket", client_sk=client_sk,
+        dedup=True)
+
+    # THEN (the object was registered with this server too, which the
+    # marker now points to)
+    assert other_id == "other_id"
+    assert drs_id == "dummy_id"
+    marker, = (metadata for key, metadata in mock_boto3.metadata.items()
+               if key.startswith(".dedup/"))
+    assert marker["drs-url"] == "https://DRS"
+
+
+def test_upload_and_register_skips_unchanged_files(
+        tmp_path, monkeypatch, mock_boto3, dummy_drs_filer, client_sk):
+
+    # GIVEN (a file that was uploaded before)
+    fname = tmp_path / "upload.dat"
+    fname.write_bytes(b"reference data")
+    index = ObjectIndex(":memory:")
+    drs_id = upload_and_register(
+        fname, "https://DRS", None, "bucket", client_sk=client_sk,
+        index=index)
+    requests = dummy_drs_filer.call_count
+
+    # WHEN (it is uploaded again, unchanged)
+    monkeypatch.setattr("drs_client.upload.compute_sha256", None)
+    again = upload_and_register(
+        fname, "https://DRS", None, "bucket", client_sk=client_sk,
+        dedup=True, index=index)
+
+    # THEN (it was neither hashed nor uploaded again)
+    assert again == drs_id
+    assert index.file_digest(str(fname)) == \
+        hashlib.sha256(b"reference data").hexdigest()
+    assert not any(r.method == "POST"
+                   for r in dummy_drs_filer.request_history[requests:])
+
+
+def test_upload_and_register_stream(
+        mock_boto3, dummy_drs_filer, client_sk):
+
+    # GIVEN (a stream of unknown size, spanning several parts)
+    data = b"streamed data" * 10000
+    transfer = TransferSettings(part_size=50000)
+
+    # WHEN
+    upload_and_register(
+        BytesIO(data), "https://DRS", None, "bucket", client_sk=client_sk,
+        transfer=transfer, name="stream.dat")
+
+    # THEN (the encrypted stream was stored and registered)
+    stored = mock_boto3.objects["stream.dat.crypt4gh"]
+    assert stored.startswith(b"crypt4gh")
+    payload = dummy_drs_filer.last_request.json()
+    assert payload["size"] == len(stored)
+    assert payload["checksums"][0]["checksum"] == \
+        hashlib.sha256(stored).hexdigest()
+
+
+def test_upload_and_register_stream_needs_name(mock_boto3, client_sk):
+    with pytest.raises(ValueError):
+        upload_and_register(
+            BytesIO(b"data"), "https://DRS", None, "bucket",
+            encrypt=False)